@@ -1,5 +1,6 @@
 import React, { useState, useEffect } from 'react';
 import { Database, Server, Plus, Search, CheckCircle, AlertCircle, RefreshCw, Loader2, Upload, File, X } from 'lucide-react';
+import { api, IngestJob } from '../../utils/api';
 
 interface DatabaseSelectorProps {
   dbType: string;
@@ -37,6 +38,7 @@ const DatabaseSelector: React.FC<DatabaseSelectorProps> = ({
   const [files, setFiles] = useState<File[]>([]);
   const [uploading, setUploading] = useState(false);
   const [uploadStatus, setUploadStatus] = useState<'idle' | 'success' | 'error'>('idle');
+  const [uploadProgress, setUploadProgress] = useState<IngestJob['progress'] | null>(null);
   const [dragActive, setDragActive] = useState(false);
 
   // MongoDB connection and database listing - exactly like app.py
@@ -216,9 +218,17 @@ const DatabaseSelector: React.FC<DatabaseSelectorProps> = ({
       });
 
       if (response.ok) {
-        setUploadStatus('success');
-        setFiles([]);
-        setSuccessMessage('Files uploaded and processed successfully!');
+        // ไฟล์ถูกรับแล้ว การประมวลผลทำต่อเบื้องหลัง: รอ job จนเสร็จ
+        const job: IngestJob = await response.json();
+        const finished = await api.waitForJob(job.job_id, update => setUploadProgress(update.progress));
+        if (finished.status === 'done') {
+          setUploadStatus('success');
+          setFiles([]);
+          setSuccessMessage('Files uploaded and processed successfully!');
+        } else {
+          setUploadStatus('error');
+          setErrorMessage(`Processing failed: ${finished.error ?? 'unknown error'}`);
+        }
       } else {
         setUploadStatus('error');
         setErrorMessage('Upload failed. Please try again.');
@@ -229,6 +239,7 @@ const DatabaseSelector: React.FC<DatabaseSelectorProps> = ({
       setErrorMessage('Upload failed. Please check your connection and try again.');
     } finally {
       setUploading(false);
+      setUploadProgress(null);
     }
   };
 
@@ -793,7 +804,11 @@ const DatabaseSelector: React.FC<DatabaseSelectorProps> = ({
               {uploading ? (
                 <>
                   <Loader2 className="w-4 h-4 animate-spin" />
-                  <span>กำลังอัปโหลด...</span>
+                  <span>
+                    {uploadProgress
+                      ? `กำลังประมวลผล... ${uploadProgress.chunks ?? 0} chunks`
+                      : 'กำลังอัปโหลด...'}
+                  </span>
                 </>
               ) : (
                 <>
@@ -1,5 +1,6 @@
 import React, { useState, useCallback } from 'react';
 import { Upload, File, X, CheckCircle, AlertCircle } from 'lucide-react';
+import { api, IngestJob } from '../../utils/api';
 
 interface FileUploaderProps {
   dbType: string;
@@ -9,6 +10,7 @@ const FileUploader: React.FC<FileUploaderProps> = ({ dbType }) => {
   const [files, setFiles] = useState<File[]>([]);
   const [uploading, setUploading] = useState(false);
   const [uploadStatus, setUploadStatus] = useState<'idle' | 'success' | 'error'>('idle');
+  const [uploadProgress, setUploadProgress] = useState<IngestJob['progress'] | null>(null);
   const [dragActive, setDragActive] = useState(false);
 
   const handleDragEnter = useCallback((e: React.DragEvent) => {
@@ -63,8 +65,15 @@ const FileUploader: React.FC<FileUploaderProps> = ({ dbType }) => {
       });
 
       if (response.ok) {
-        setUploadStatus('success');
-        setFiles([]);
+        // ไฟล์ถูกรับแล้ว การประมวลผลทำต่อเบื้องหลัง: รอ job จนเสร็จ
+        const job: IngestJob = await response.json();
+        const finished = await api.waitForJob(job.job_id, update => setUploadProgress(update.progress));
+        if (finished.status === 'done') {
+          setUploadStatus('success');
+          setFiles([]);
+        } else {
+          setUploadStatus('error');
+        }
       } else {
         setUploadStatus('error');
       }
@@ -73,6 +82,7 @@ const FileUploader: React.FC<FileUploaderProps> = ({ dbType }) => {
       setUploadStatus('error');
     } finally {
       setUploading(false);
+      setUploadProgress(null);
     }
   };
 
@@ -152,7 +162,9 @@ const FileUploader: React.FC<FileUploaderProps> = ({ dbType }) => {
           {uploading ? (
             <>
               <div className="animate-spin rounded-full h-4 w-4 border-b-2 border-white"></div>
-              <span>Uploading...</span>
+              <span>
+                {uploadProgress ? `Processing... ${uploadProgress.chunks ?? 0} chunks` : 'Uploading...'}
+              </span>
             </>
           ) : (
             <>
@@ -1,5 +1,38 @@
 const API_BASE_URL = '/api';
 
+// /upload และ /upsert คืน job ทันที (202) แล้ว ingest ต่อเบื้องหลัง
+export interface IngestJob {
+  job_id: string;
+  session_id: string;
+  status: 'queued' | 'running' | 'done' | 'failed';
+  files: string[];
+  progress: {
+    files?: number;
+    units?: number;
+    embedded?: number;
+    chunks?: number;
+    unchanged?: number;
+  };
+  result: Record<string, unknown> | null;
+  error: string | null;
+}
+
+const JOB_POLL_INTERVAL_MS = 2000;
+
+const isFinished = (job: IngestJob) => job.status === 'done' || job.status === 'failed';
+
+const pollJob = async (jobId: string, onProgress?: (job: IngestJob) => void): Promise<IngestJob> => {
+  while (true) {
+    const response = await fetch(`${API_BASE_URL}/jobs/${jobId}`);
+    const job: IngestJob = await response.json();
+    onProgress?.(job);
+    if (!response.ok || isFinished(job)) {
+      return job;
+    }
+    await new Promise(resolve => setTimeout(resolve, JOB_POLL_INTERVAL_MS));
+  }
+};
+
 export const api = {
   toggleAI: async (enabled: boolean) => {
     const response = await fetch(`${API_BASE_URL}/toggle_switch`, {
@@ -26,6 +59,26 @@ export const api = {
     return response.json();
   },
 
+  // ติดตาม job ผ่าน SSE จนเสร็จ (ถ้าเปิด SSE ไม่ได้จะ poll GET /jobs/{id} แทน)
+  waitForJob: (jobId: string, onProgress?: (job: IngestJob) => void): Promise<IngestJob> =>
+    new Promise((resolve, reject) => {
+      const source = new EventSource(`${API_BASE_URL}/jobs/${jobId}/events`);
+      source.onmessage = (event) => {
+        const job: IngestJob = JSON.parse(event.data);
+        onProgress?.(job);
+        if (isFinished(job)) {
+          source.close();
+          resolve(job);
+        }
+      };
+      source.onerror = () => {
+        // proxy ไม่รองรับ SSE หรือ connection หลุดกลางทาง: อ่านสถานะต่อด้วยการ poll
+        source.close();
+        // poll ไม่สำเร็จ (เช่น network หลุด) ส่ง error ให้ผู้เรียกแทนการรอค้าง
+        pollJob(jobId, onProgress).then(resolve, reject);
+      };
+    }),
+
   query: async (sessionId: string, question: string, emotional: string) => {
     const response = await fetch(`${API_BASE_URL}/query`, {
       method: 'POST',
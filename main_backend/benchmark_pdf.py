@@ -0,0 +1,82 @@
+import glob
+import time
+import argparse
+import pymupdf
+import pdfplumber
+from pdf_engine import iter_pdf_pages
+from image_store import add_image
+
+def read_pdf_two_pass(path):
+    """read_pdf แบบเดิม: pdfplumber อ่านข้อความ + extract_tables ทุกหน้า แล้วเปิดไฟล์อีกรอบด้วย PyMuPDF เพื่อดึงรูป"""
+    pages, tables, images = [], [], []
+    with pdfplumber.open(path) as pdf:
+        for page in pdf.pages:
+            page_text = page.extract_text()
+            if page_text:
+                pages.append(page_text.strip())
+            tables.extend(page.extract_tables() or [])
+    doc = pymupdf.open(path)
+    for page_index in range(len(doc)):
+        for img in doc.load_page(page_index).get_images(full=True):
+            images.append(doc.extract_image(img[0])["image"])
+    doc.close()
+    return pages, tables, images
+
+def read_pdf_single_pass(path):
+    """เปิดไฟล์ครั้งเดียวด้วย PDF engine: ข้อความ ตาราง (เฉพาะหน้าที่มีเส้นตาราง) และรูป (ไม่ซ้ำกันตาม sha256)"""
+    pages, tables, images = [], [], {}
+    for record in iter_pdf_pages(path, image_data=True):
+        if record["text"]:
+            pages.append(record["text"])
+        tables.extend(record["tables"])
+        for image in record["images"]:
+            if "data" in image:
+                add_image(images, image["data"])
+    return pages, tables, images
+
+def read_text_pdfplumber(path):
+    """ข้อความสำหรับ ingest แบบเดิม (pdfplumber ทีละหน้า)"""
+    pages = []
+    with pdfplumber.open(path) as pdf:
+        for page in pdf.pages:
+            pages.append((page.extract_text() or "").strip())
+            page.close()
+    return pages
+
+def read_text_engine(path):
+    return [record["text"] for record in iter_pdf_pages(path, tables=False)]
+
+def best_of(function, path, repeat):
+    seconds = []
+    for _ in range(repeat):
+        started = time.perf_counter()
+        result = function(path)
+        seconds.append(time.perf_counter() - started)
+    return min(seconds), result
+
+def run_benchmark(paths, repeat=3):
+    rows = []
+    for path in paths:
+        full_old, (_, old_tables, old_images) = best_of(read_pdf_two_pass, path, repeat)
+        full_new, (pages, new_tables, new_images) = best_of(read_pdf_single_pass, path, repeat)
+        text_old, _ = best_of(read_text_pdfplumber, path, repeat)
+        text_new, _ = best_of(read_text_engine, path, repeat)
+        rows.append({
+            "file": path,
+            "pages": len(pages),
+            "read_pdf_s": f"{full_old:.3f} -> {full_new:.3f} ({full_old / full_new:.1f}x)",
+            "ingest_text_s": f"{text_old:.3f} -> {text_new:.3f} ({text_old / text_new:.1f}x)",
+            "tables": f"{len(old_tables)} -> {len(new_tables)}",
+            "images": f"{len(old_images)} -> {len(new_images)}",
+        })
+    return rows
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Compare the two-pass pdfplumber + PyMuPDF reader with the single-pass PDF engine")
+    parser.add_argument("files", nargs="*", help="PDF files (default: ../test/OCR/test_data/*.pdf)")
+    parser.add_argument("--repeat", type=int, default=3, help="runs per file, the fastest is reported")
+    args = parser.parse_args()
+
+    paths = args.files or sorted(glob.glob("../test/OCR/test_data/*.pdf"))
+    for row in run_benchmark(paths, args.repeat):
+        print(" | ".join(f"{key}: {value}" for key, value in row.items()))
@@ -0,0 +1,69 @@
+import time
+import asyncio
+import argparse
+import numpy as np
+from vector_store import InMemoryVectorStore, HashingEmbedder
+
+def word_chunks(text, max_words=120, stride=70):
+    """แบ่งเป็น window ของคำ (ไม่ใช้ tokenizer ของ OpenAI เพื่อให้รันได้แบบ offline)"""
+    words = text.split()
+    return [" ".join(words[i:i + max_words]) for i in range(0, max(len(words) - max_words + stride, 1), stride)]
+
+def synthetic_corpus(documents=2000, words=200, vocabulary=5000, seed=0):
+    rng = np.random.default_rng(seed)
+    vocab = [f"คำ{i}" if i % 2 else f"term{i}" for i in range(vocabulary)]
+    return [" ".join(rng.choice(vocab, size=words)) for _ in range(documents)]
+
+async def run_benchmark(texts, queries=200, top_k=4, batch_size=256, dim=512):
+    store = InMemoryVectorStore("benchmark", HashingEmbedder(dim))
+    chunks = [chunk for text in texts for chunk in word_chunks(text)]
+    ids = [f"vec-{i}_chunk{i}" for i in range(len(chunks))]
+
+    started = time.perf_counter()
+    for start in range(0, len(chunks), batch_size):
+        await store.upsert(ids[start:start + batch_size], chunks[start:start + batch_size])
+    ingest_seconds = time.perf_counter() - started
+
+    rng = np.random.default_rng(1)
+    # คำถามจำลอง: ช่วงคำสั้นๆ จาก chunk ที่สุ่มมา; นับ hit เมื่อมี chunk ใน top_k ที่มีข้อความนั้น (รวม chunk ที่ซ้อนกัน)
+    picks = rng.choice(len(chunks), size=min(queries, len(chunks)), replace=False)
+    latencies, hits = [], 0
+    for pick in picks:
+        words = chunks[pick].split()
+        question = " ".join(words[:12])
+        started = time.perf_counter()
+        passages = await store.search(question, top_k)
+        latencies.append((time.perf_counter() - started) * 1000)
+        hits += any(question in text for _, text in passages)
+
+    latencies = np.array(latencies)
+    return {
+        "chunks": len(chunks),
+        "ingest_seconds": round(ingest_seconds, 3),
+        "ingest_chunks_per_second": round(len(chunks) / ingest_seconds, 1) if ingest_seconds else None,
+        "queries": len(picks),
+        "query_ms_p50": round(float(np.percentile(latencies, 50)), 3),
+        "query_ms_p95": round(float(np.percentile(latencies, 95)), 3),
+        "hit_rate_at_k": round(hits / len(picks), 4),
+        "store": store.stats(),
+    }
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Offline ingest -> query benchmark of the in-memory vector store")
+    parser.add_argument("--files", nargs="*", help="text files to ingest (default: synthetic corpus)")
+    parser.add_argument("--documents", type=int, default=2000)
+    parser.add_argument("--queries", type=int, default=200)
+    parser.add_argument("--k", type=int, default=4)
+    parser.add_argument("--dim", type=int, default=512)
+    args = parser.parse_args()
+
+    if args.files:
+        texts = []
+        for path in args.files:
+            with open(path, "r", encoding="utf-8", errors="ignore") as f:
+                texts.append(f.read())
+    else:
+        texts = synthetic_corpus(args.documents)
+    report = asyncio.run(run_benchmark(texts, args.queries, args.k, dim=args.dim))
+    for key, value in report.items():
+        print(f"{key}: {value}")
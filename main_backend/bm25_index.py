@@ -0,0 +1,259 @@
+import os
+import re
+import json
+import math
+import logging
+import threading
+from collections import Counter
+from pathlib import Path
+from bson import json_util
+from pythainlp.tokenize import word_tokenize
+from pythainlp.corpus.common import thai_stopwords
+from collection_meta import get_collection_version, has_local_update
+from matrix_cache import SCAN_BATCH_SIZE
+
+# --- ตั้งค่า inverted index (BM25) ---
+BM25_INDEX_DIR = os.getenv("BM25_INDEX_DIR", "./bm25_indexes")
+BM25_K1 = float(os.getenv("BM25_K1", "1.5"))
+BM25_B = float(os.getenv("BM25_B", "0.75"))
+
+THAI_STOPWORDS = set(thai_stopwords())
+# คำภาษาอังกฤษ/ตัวเลข/URL เก็บเป็นคำเดียวทั้งก้อน (เช่น CS101, reg.example.ac.th/a) ไม่ให้ตัวตัดคำไทยแยก
+EXACT_TERM_PATTERN = re.compile(r"https?://[^\s\u0e00-\u0e7f]+|[A-Za-z0-9][A-Za-z0-9_.:/@#+\-]*")
+
+# index ที่โหลดไว้ในหน่วยความจำ: key = "<db>.<collection>"
+# -> {"ids", "lengths", "postings": {term: {position: tf}}, "version"}
+_loaded_indexes = {}
+_lock = threading.Lock()
+# key ของ index ที่กำลังสร้างใหม่ใน thread เบื้องหลัง
+_rebuilding = set()
+
+def tokenize_for_bm25(text):
+    if not text:
+        return []
+    tokens = []
+    for match in EXACT_TERM_PATTERN.findall(text):
+        term = match.rstrip(".,:;/-").lower()
+        if term:
+            tokens.append(term)
+    thai_text = EXACT_TERM_PATTERN.sub(" ", text)
+    for word in word_tokenize(thai_text, keep_whitespace=False):
+        word = word.strip()
+        if len(word) < 2 or word in THAI_STOPWORDS or not re.search(r"[\u0e00-\u0e7f]", word):
+            continue
+        tokens.append(word)
+    return tokens
+
+def _index_key(collection):
+    return collection.full_name
+
+def _index_path(key):
+    return Path(BM25_INDEX_DIR) / f"{key}.bm25.json"
+
+def _persist(key, entry):
+    path = _index_path(key)
+    path.parent.mkdir(parents=True, exist_ok=True)
+    tmp_path = path.with_name(path.name + ".tmp")
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        json.dump({
+            "version": entry["version"],
+            "ids": entry["ids"],
+            "lengths": entry["lengths"],
+            "postings": {term: list(docs.items()) for term, docs in entry["postings"].items()},
+        }, f, ensure_ascii=False, default=json_util.default)
+    os.replace(tmp_path, path)
+
+def _positions(entry):
+    return entry.setdefault("positions", {doc_id: pos for pos, doc_id in enumerate(entry["ids"]) if doc_id is not None})
+
+def _mark_removed(entry, doc_id):
+    """ทำเครื่องหมายตำแหน่งของ doc_id ว่าลบ (ids[pos] = None) แทนการไล่ลบ posting ของทุกคำ"""
+    pos = _positions(entry).pop(doc_id, None)
+    if pos is not None:
+        entry["ids"][pos] = None
+        entry["lengths"][pos] = 0
+
+def _compact(entry):
+    """ตัดตำแหน่งที่ถูกลบออกและเรียงตำแหน่งใหม่ (ใช้ posting เดิม ไม่ต้องตัดคำใหม่)"""
+    remap, ids, lengths = {}, [], []
+    for pos, doc_id in enumerate(entry["ids"]):
+        if doc_id is not None:
+            remap[pos] = len(ids)
+            ids.append(doc_id)
+            lengths.append(entry["lengths"][pos])
+    postings = {}
+    for term, docs in entry["postings"].items():
+        kept = {remap[pos]: tf for pos, tf in docs.items() if pos in remap}
+        if kept:
+            postings[term] = kept
+    entry.update(ids=ids, lengths=lengths, postings=postings, positions={doc_id: pos for pos, doc_id in enumerate(ids)})
+
+def _add_documents(entry, ids, token_lists):
+    """เพิ่มเอกสาร (ตัดคำแล้ว) เข้า entry; ถ้า _id ซ้ำของเดิม ตำแหน่งเดิมจะถูกทำเครื่องหมายว่าลบ"""
+    positions = _positions(entry)
+    for doc_id, tokens in zip(ids, token_lists):
+        _mark_removed(entry, doc_id)
+        pos = len(entry["ids"])
+        entry["ids"].append(doc_id)
+        entry["lengths"].append(len(tokens))
+        positions[doc_id] = pos
+        for term, tf in Counter(tokens).items():
+            entry["postings"].setdefault(term, {})[pos] = tf
+
+def build_bm25_from_documents(collection, ids, texts, version=None):
+    """สร้าง inverted index ใหม่ทั้งหมดจากข้อความที่มีอยู่แล้ว (ใช้ตอน /upload) แล้วบันทึกลงดิสก์"""
+    key = _index_key(collection)
+    entry = {"ids": [], "lengths": [], "postings": {}, "version": version or get_collection_version(collection)}
+    _add_documents(entry, ids, [tokenize_for_bm25(text) for text in texts])
+    with _lock:
+        _loaded_indexes[key] = entry
+        _persist(key, entry)
+    print(f"BM25 index {key}: {len(entry['positions'])} documents, {len(entry['postings'])} terms")
+    return entry
+
+def build_bm25_index(collection):
+    """สแกน raw_text ของ collection ทั้งหมดแล้วสร้าง index ใหม่"""
+    # อ่าน version ก่อนสแกน ถ้ามีการเขียนระหว่างสแกน index จะถูกสร้างใหม่อีกรอบ
+    version = get_collection_version(collection)
+    ids, texts = [], []
+    for doc in collection.find({}, {"raw_text": 1}, batch_size=SCAN_BATCH_SIZE):
+        ids.append(doc["_id"])
+        texts.append(doc.get("raw_text", ""))
+    return build_bm25_from_documents(collection, ids, texts, version)
+
+def _rebuild_in_background(collection):
+    """ตัดคำและสร้าง index ใหม่ใน thread แยก (ครั้งละงานเดียวต่อ collection) การค้นไม่ต้องรอ"""
+    key = _index_key(collection)
+    with _lock:
+        if key in _rebuilding:
+            return
+        _rebuilding.add(key)
+    logging.warning(f"BM25 index {key} is missing or out of sync with the collection, rebuilding in the background")
+
+    def rebuild():
+        try:
+            build_bm25_index(collection)
+        except Exception as e:
+            logging.error(f"Error rebuilding BM25 index {key}: {e}")
+        finally:
+            with _lock:
+                _rebuilding.discard(key)
+
+    threading.Thread(target=rebuild, name=f"bm25-rebuild-{key}", daemon=True).start()
+
+def _read_bm25(key):
+    """อ่าน index ที่บันทึกไว้บนดิสก์ คืน None ถ้าไม่มี"""
+    path = _index_path(key)
+    if not path.exists():
+        return None
+    with _lock:
+        with open(path, "r", encoding="utf-8") as f:
+            saved = json.load(f, object_hook=json_util.object_hook)
+    return {
+        "ids": saved["ids"],
+        "lengths": saved["lengths"],
+        "postings": {term: {int(pos): tf for pos, tf in docs} for term, docs in saved["postings"].items()},
+        "version": saved.get("version"),
+    }
+
+def _load_bm25(collection, check_version=True, wait=False):
+    """
+    โหลด index จากหน่วยความจำ/ดิสก์ ถ้าไม่มีหรือ version ไม่ตรงกับ collection ให้สร้างใหม่:
+    wait=False (ทางค้นหา) สร้างใน thread เบื้องหลังแล้วใช้ index เดิมไปก่อน (None ถ้ายังไม่มี ค้นด้วย vector อย่างเดียว)
+    wait=True (thread ของงาน ingest) สร้างเสร็จก่อนคืนค่า
+    ระหว่างที่ process นี้กำลังอัปเดต index เอง (local_update) ไม่ต้องตรวจ version
+    """
+    key = _index_key(collection)
+    check_version = check_version and not has_local_update(collection)
+    version = get_collection_version(collection) if check_version else None
+    entry = _loaded_indexes.get(key)
+    if entry is not None and (not check_version or entry["version"] == version):
+        return entry
+    if entry is None:
+        entry = _read_bm25(key)
+        if entry is not None:
+            _loaded_indexes[key] = entry
+            if not check_version or entry["version"] == version:
+                return entry
+    if wait:
+        logging.warning(f"BM25 index {key} is out of sync with the collection, rebuilding")
+        return build_bm25_index(collection)
+    _rebuild_in_background(collection)
+    return entry
+
+def add_to_bm25(collection, ids, texts, version=None, persist=True):
+    """
+    เพิ่ม/แทนที่เอกสารใน index เดิม (ใช้ตอน /upsert) แล้วใช้ version ที่ endpoint เพิ่งเขียน
+    persist=False แก้เฉพาะ index ในหน่วยความจำ (publish ระหว่าง streaming) ต้องเรียก persist_bm25 ภายหลัง
+    """
+    key = _index_key(collection)
+    entry = _load_bm25(collection, check_version=False, wait=True)
+    # ตัดคำนอก lock การค้นจะได้ไม่ต้องรอ
+    token_lists = [tokenize_for_bm25(text) for text in texts]
+    with _lock:
+        _add_documents(entry, ids, token_lists)
+        entry["version"] = version or get_collection_version(collection)
+        if persist:
+            _persist(key, entry)
+    return entry
+
+def persist_bm25(collection):
+    """เขียน index ที่อยู่ในหน่วยความจำลงดิสก์ (หลัง add_to_bm25(..., persist=False))"""
+    key = _index_key(collection)
+    entry = _loaded_indexes.get(key)
+    if entry is not None:
+        with _lock:
+            _persist(key, entry)
+    return entry
+
+def remove_from_bm25(collection, ids, version=None):
+    """ลบเอกสารออกจาก index เดิม (ใช้ตอน /upload ลบ chunk ที่ไม่มีในไฟล์แล้ว) ไม่ต้องตัดคำทั้ง collection ใหม่"""
+    key = _index_key(collection)
+    entry = _load_bm25(collection, check_version=False, wait=True)
+    with _lock:
+        for doc_id in ids:
+            _mark_removed(entry, doc_id)
+        if len(_positions(entry)) * 2 < len(entry["ids"]):
+            _compact(entry)
+        entry["version"] = version or get_collection_version(collection)
+        _persist(key, entry)
+    return entry
+
+def drop_bm25(collection):
+    key = _index_key(collection)
+    with _lock:
+        _loaded_indexes.pop(key, None)
+        path = _index_path(key)
+        if path.exists():
+            path.unlink()
+
+def search_bm25(collection, query, top_k=20):
+    """
+    คืนค่า [(score, _id), ...] เรียงจากคะแนนมากไปน้อย
+    อ่านเฉพาะ posting ของคำในคำถาม ไม่ต้องแตะเอกสารที่ไม่มีคำเหล่านั้น
+    """
+    terms = set(tokenize_for_bm25(query))
+    if not terms:
+        return []
+    entry = _load_bm25(collection)
+    if entry is None:
+        return []
+    # index อาจถูกเพิ่ม/ลบเอกสารจาก thread ของงาน ingest ระหว่างค้น
+    with _lock:
+        ids, lengths, postings = entry["ids"], entry["lengths"], entry["postings"]
+        live = [length for doc_id, length in zip(ids, lengths) if doc_id is not None]
+        if not live:
+            return []
+        n_docs = len(live)
+        avg_len = sum(live) / n_docs or 1.0
+        scores = {}
+        for term in terms:
+            docs = {pos: tf for pos, tf in postings.get(term, {}).items() if ids[pos] is not None}
+            if not docs:
+                continue
+            idf = math.log((n_docs - len(docs) + 0.5) / (len(docs) + 0.5) + 1)
+            for pos, tf in docs.items():
+                norm = BM25_K1 * (1 - BM25_B + BM25_B * lengths[pos] / avg_len)
+                scores[pos] = scores.get(pos, 0.0) + idf * tf * (BM25_K1 + 1) / (tf + norm)
+        ranked = sorted(scores.items(), key=lambda item: item[1], reverse=True)[:top_k]
+        return [(score, ids[pos]) for pos, score in ranked]
@@ -0,0 +1,124 @@
+import os
+import uuid
+import threading
+from collections import Counter
+from contextlib import contextmanager
+from datetime import datetime, timedelta
+from vector_codec import embedding_length
+
+# ข้อมูลประกอบของแต่ละ collection (version stamp ฯลฯ) เก็บรวมไว้ที่ file_agent_db.collection_meta
+META_DB_NAME = "file_agent_db"
+META_COLLECTION_NAME = "collection_meta"
+# migration ที่ไม่มี heartbeat นานเกินนี้ถือว่า process ที่รันหยุดไปแล้ว (เริ่มใหม่/ทำต่อได้)
+MIGRATION_STALE_SECONDS = float(os.getenv("MIGRATION_STALE_SECONDS", "120"))
+
+# collection ที่ process นี้กำลังเปลี่ยน version แล้วอัปเดต index ในหน่วยความจำตาม (full_name -> จำนวนงานที่ค้างอยู่)
+_local_updates = Counter()
+_local_updates_lock = threading.Lock()
+
+def _meta_collection(collection):
+    return collection.database.client[META_DB_NAME][META_COLLECTION_NAME]
+
+def get_collection_meta(collection):
+    return _meta_collection(collection).find_one({"_id": collection.full_name}) or {}
+
+def get_collection_version(collection):
+    """
+    คืน version stamp ปัจจุบันของ collection
+    collection เก่าที่ยังไม่เคยมี stamp จะใช้จำนวนเอกสารแทน
+    """
+    version = get_collection_meta(collection).get("version")
+    if version:
+        return version
+    return f"count-{collection.estimated_document_count()}"
+
+def bump_collection_version(collection, **fields):
+    """เรียกทุกครั้งที่เขียนข้อมูลลง collection เพื่อให้ cache/index ที่ค้างอยู่รู้ว่าต้องโหลดใหม่"""
+    version = uuid.uuid4().hex
+    _meta_collection(collection).update_one(
+        {"_id": collection.full_name},
+        {"$set": {"version": version, "updated_at": datetime.now(), **fields}},
+        upsert=True
+    )
+    return version
+
+@contextmanager
+def local_update(collection):
+    """
+    ครอบช่วง bump_collection_version -> อัปเดต FAISS/BM25 index ในหน่วยความจำ ของ process เดียวกัน
+    ระหว่างนั้น version ใน MongoDB ใหม่กว่า index อยู่ชั่วครู่ การค้นไม่ต้องสร้าง index ใหม่
+    """
+    key = collection.full_name
+    with _local_updates_lock:
+        _local_updates[key] += 1
+    try:
+        yield
+    finally:
+        with _local_updates_lock:
+            _local_updates[key] -= 1
+            if not _local_updates[key]:
+                del _local_updates[key]
+
+def has_local_update(collection):
+    return collection.full_name in _local_updates
+
+# model ที่คาดว่าใช้ตามมิติของ vector (สำหรับ collection เก่าที่ไม่ได้บันทึก model ไว้)
+DEFAULT_MODEL_BY_DIMENSION = {
+    1536: "text-embedding-3-small",
+    3072: "text-embedding-3-large",
+}
+
+def get_embedding_settings(collection, default_model="text-embedding-3-small"):
+    """
+    คืน {"model", "dimension", "field", "short_dimension"} ที่ collection นี้ใช้ตอน ingest
+    ถ้ายังไม่เคยบันทึกไว้ จะเดาจากมิติของเอกสารตัวอย่างแล้วบันทึกครั้งเดียว
+    """
+    meta = get_collection_meta(collection)
+    field = meta.get("embedding_field", "embedding")
+    if meta.get("embedding_model") and meta.get("dimension"):
+        return {"model": meta["embedding_model"], "dimension": meta["dimension"], "field": field,
+                "short_dimension": meta.get("short_dimension")}
+    sample = collection.find_one({field: {"$exists": True}}, {field: 1})
+    if not sample:
+        return {"model": default_model, "dimension": None, "field": field, "short_dimension": None}
+    dimension = embedding_length(sample[field])
+    model = DEFAULT_MODEL_BY_DIMENSION.get(dimension, default_model)
+    _meta_collection(collection).update_one(
+        {"_id": collection.full_name},
+        {"$set": {"embedding_model": model, "dimension": dimension, "embedding_field": field}},
+        upsert=True
+    )
+    return {"model": model, "dimension": dimension, "field": field, "short_dimension": meta.get("short_dimension")}
+
+def get_embedding_field(collection):
+    return get_collection_meta(collection).get("embedding_field", "embedding")
+
+def set_embedding_migration(collection, migration):
+    _meta_collection(collection).update_one(
+        {"_id": collection.full_name},
+        {"$set": {"migration": migration}},
+        upsert=True
+    )
+
+def touch_embedding_migration(collection, owner):
+    """heartbeat ของ migration ที่ process owner กำลังรัน"""
+    _meta_collection(collection).update_one(
+        {"_id": collection.full_name, "migration.owner": owner, "migration.status": "running"},
+        {"$set": {"migration.heartbeat_at": datetime.now()}}
+    )
+
+def migration_is_stale(migration):
+    # migration จากก่อนมี heartbeat ใช้เวลาเริ่มแทน
+    heartbeat = migration.get("heartbeat_at") or migration.get("started_at")
+    return heartbeat is None or heartbeat < datetime.now() - timedelta(seconds=MIGRATION_STALE_SECONDS)
+
+def get_running_migration(collection):
+    """
+    migration ที่กำลังรันอยู่ หรือ None
+    สถานะ running ที่ heartbeat ขาดเกิน MIGRATION_STALE_SECONDS (process ตาย/restart กลางทาง) ไม่นับว่ารันอยู่:
+    upsert หยุดเขียน vector ของ model ใหม่ และเริ่ม migration ใหม่ได้ (model เดิมทำต่อจาก vector ที่เขียนไว้แล้ว)
+    """
+    migration = get_collection_meta(collection).get("migration")
+    if migration and migration.get("status") == "running" and not migration_is_stale(migration):
+        return migration
+    return None
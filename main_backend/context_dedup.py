@@ -0,0 +1,144 @@
+import os
+import re
+import threading
+import numpy as np
+from matrix_cache import normalize_rows
+
+# MMR: 1.0 = เลือกตามความเกี่ยวข้องอย่างเดียว, ค่าน้อยลง = ลงโทษ chunk ที่ซ้ำกับที่เลือกไปแล้วมากขึ้น
+MMR_LAMBDA = float(os.getenv("MMR_LAMBDA", "0.7"))
+# จำนวน candidate ที่นำมาเลือกด้วย MMR = top_k * ค่านี้
+MMR_CANDIDATES_FACTOR = int(os.getenv("MMR_CANDIDATES_FACTOR", "3"))
+# รวม chunk ที่อยู่ติดกัน (window ที่ซ้อนกัน) เป็นข้อความเดียว
+MERGE_ADJACENT_CHUNKS = os.getenv("MERGE_ADJACENT_CHUNKS", "true").lower() in ("1", "true", "yes")
+# ข้อความที่ซ้อนกันต้องยาวอย่างน้อยเท่านี้ (ตัวอักษร) จึงถือว่าเป็น window ต่อเนื่องกัน
+MIN_OVERLAP_CHARS = 20
+
+# _id ของ chunk: "{row_hash}_chunk{n}" (ingest_pipeline; row_hash = sha256 24 หลักของแถว/ย่อหน้า/หน้า)
+# source คือ row_hash chunk ที่รวมกันได้จึงต้องมาจากแถวเดียวกันเท่านั้น
+# id แบบเก่า "vec-<row>_chunk<n>" นับเลข chunk ต่อทั้ง collection (ไม่ใช่ต่อแถว) จึงไม่ถูกรวม
+CHUNK_ID_PATTERN = re.compile(r"^(?P<source>(?:.+-)?[0-9a-f]{24})_chunk(?P<index>\d+)$")
+
+def parse_chunk_id(doc_id):
+    """คืน (source, chunk_index) หรือ None ถ้า _id ไม่ได้มาจากการแบ่ง chunk"""
+    match = CHUNK_ID_PATTERN.match(str(doc_id))
+    if not match:
+        return None
+    return match.group("source"), int(match.group("index"))
+
+def mmr_select(hits, vectors_by_id, top_k=4, mmr_lambda=MMR_LAMBDA):
+    """
+    Maximal marginal relevance: เลือกทีละ chunk ที่คะแนนเกี่ยวข้องสูง แต่คล้ายกับ chunk ที่เลือกไปแล้วน้อย
+    hits: [(score, _id), ...] เรียงจากคะแนนมากไปน้อย; chunk ที่ไม่มี vector จะใช้คะแนนอย่างเดียว
+    """
+    if mmr_lambda >= 1 or len(hits) <= 1:
+        return hits[:top_k]
+    scores = np.array([score for score, _ in hits], dtype=np.float32)
+    spread = scores.max() - scores.min()
+    relevance = (scores - scores.min()) / spread if spread > 0 else np.ones_like(scores)
+    dim = next((len(v) for v in vectors_by_id.values() if v is not None), 0)
+    vectors = normalize_rows([
+        vectors_by_id[doc_id] if vectors_by_id.get(doc_id) is not None and len(vectors_by_id[doc_id]) == dim
+        else np.zeros(dim, dtype=np.float32)
+        for _, doc_id in hits
+    ])
+    similarity = vectors @ vectors.T
+    selected = [0]
+    remaining = list(range(1, len(hits)))
+    while remaining and len(selected) < top_k:
+        redundancy = similarity[np.ix_(remaining, selected)].max(axis=1)
+        marginal = mmr_lambda * relevance[remaining] - (1 - mmr_lambda) * redundancy
+        best = remaining[int(np.argmax(marginal))]
+        selected.append(best)
+        remaining.remove(best)
+    return [hits[i] for i in selected]
+
+def _overlap_length(first, second):
+    """ความยาวของต้น second ที่ยาวที่สุดซึ่งเป็นท้ายของ first พอดี (prefix function ของ second + แยก + first)"""
+    text = second + "\0" + first[-len(second):]
+    prefix = [0] * len(text)
+    for i in range(1, len(text)):
+        k = prefix[i - 1]
+        while k and text[i] != text[k]:
+            k = prefix[k - 1]
+        if text[i] == text[k]:
+            k += 1
+        prefix[i] = k
+    return prefix[-1] if text else 0
+
+def _merge_texts(first, second):
+    """
+    ต่อ second หลัง first โดยตัดส่วนที่ซ้อนกัน (ท้าย first ต้องตรงกับต้น second ทุกตัวอักษร); คืน None ถ้าไม่ซ้อนกัน
+    ตัวอักษรที่ถอดไม่ได้ (U+FFFD) ตรงขอบ window ซึ่งตัด token กลางตัวอักษร ไม่นับในการเทียบ
+    """
+    first, second = first.rstrip("\ufffd"), second.lstrip("\ufffd")
+    overlap = _overlap_length(first, second) if first and second else 0
+    if overlap < MIN_OVERLAP_CHARS:
+        return None
+    return first + second[overlap:]
+
+def merge_adjacent_chunks(chunks):
+    """
+    chunks: [(score, _id, text), ...] ตามลำดับความเกี่ยวข้อง
+    chunk จากแถวเดียวกัน (row_hash เดียวกัน) ที่เลข chunk ติดกันและข้อความซ้อนกันจะถูกรวมเป็นข้อความเดียว (เรียงตามลำดับในแถว)
+    คืน [(score, [_id, ...], text), ...] โดยใช้คะแนนสูงสุดของกลุ่ม
+    """
+    groups = []
+    by_position = {}
+    for score, doc_id, text in chunks:
+        parsed = parse_chunk_id(doc_id)
+        group = {"score": score, "ids": [doc_id], "text": text, "first": parsed, "last": parsed}
+        groups.append(group)
+        if parsed:
+            by_position[parsed] = group
+
+    changed = True
+    while changed:
+        changed = False
+        for group in groups:
+            if group.get("merged") or not group["last"]:
+                continue
+            source, index = group["last"]
+            following = by_position.get((source, index + 1))
+            if following is None or following is group or following.get("merged"):
+                continue
+            merged_text = _merge_texts(group["text"], following["text"])
+            if merged_text is None:
+                continue
+            group["text"] = merged_text
+            group["ids"].extend(following["ids"])
+            group["score"] = max(group["score"], following["score"])
+            group["last"] = following["last"]
+            by_position[following["last"]] = group
+            following["merged"] = True
+            changed = True
+    return [(group["score"], group["ids"], group["text"]) for group in groups if not group.get("merged")]
+
+class DedupStats:
+    """สถิติรวมของ token ที่ประหยัดได้จากการตัด chunk ซ้ำ"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.contexts = 0
+        self.tokens_before = 0
+        self.tokens_after = 0
+        self.merged_chunks = 0
+
+    def record(self, tokens_before, tokens_after, merged_chunks):
+        with self._lock:
+            self.contexts += 1
+            self.tokens_before += tokens_before
+            self.tokens_after += tokens_after
+            self.merged_chunks += merged_chunks
+
+    def stats(self):
+        saved = self.tokens_before - self.tokens_after
+        return {
+            "contexts": self.contexts,
+            "tokens_before": self.tokens_before,
+            "tokens_after": self.tokens_after,
+            "tokens_saved": saved,
+            "saved_ratio": round(saved / self.tokens_before, 4) if self.tokens_before else 0.0,
+            "merged_chunks": self.merged_chunks,
+        }
+
+dedup_stats = DedupStats()
@@ -0,0 +1,48 @@
+import os
+import argparse
+from pathlib import Path
+from dotenv import load_dotenv
+from pymongo import MongoClient, UpdateOne
+from vector_codec import encode_embedding, decode_embedding
+from collection_meta import get_embedding_field, bump_collection_version
+
+current_directory = os.getcwd()
+env_path = Path(current_directory).parent / 'venv' / '.env'
+load_dotenv(dotenv_path=env_path, override=True)
+
+def convert_collection_embeddings(collection, storage_format="binary", batch_size=1000):
+    """
+    แปลง embedding ที่มีอยู่แล้วใน collection ไปเป็นรูปแบบ storage_format ("binary" หรือ "array")
+    ตัวอ่านรองรับทั้ง 2 รูปแบบ จึงแปลงได้ขณะระบบยังตอบคำถามอยู่
+    """
+    field = get_embedding_field(collection)
+    # binData = BSON type 5, array = BSON type 4
+    source_type = "array" if storage_format == "binary" else "binData"
+    converted = 0
+    while True:
+        # หยิบทีละ batch จากเอกสารที่ยังเป็นรูปแบบเดิม จนไม่เหลือ
+        batch = list(collection.find({field: {"$type": source_type}}, {field: 1}).limit(batch_size))
+        if not batch:
+            break
+        operations = [
+            UpdateOne({"_id": doc["_id"]}, {"$set": {field: encode_embedding(decode_embedding(doc[field]), storage_format)}})
+            for doc in batch
+        ]
+        collection.bulk_write(operations, ordered=False)
+        converted += len(operations)
+        print(f"Converted {converted} embeddings of {collection.full_name} to {storage_format}")
+    if converted:
+        bump_collection_version(collection, storage_format=storage_format)
+    print(f"✅ Converted {converted} embeddings of {collection.full_name} to {storage_format}")
+    return converted
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Convert stored embeddings between BSON arrays and packed float32 binData")
+    parser.add_argument("--db", required=True)
+    parser.add_argument("--collection", required=True)
+    parser.add_argument("--to", choices=["binary", "array"], default="binary")
+    parser.add_argument("--batch-size", type=int, default=1000)
+    args = parser.parse_args()
+
+    mongo_client = MongoClient(os.getenv("MONGO_URL"))
+    convert_collection_embeddings(mongo_client[args.db][args.collection], args.to, args.batch_size)
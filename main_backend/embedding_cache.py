@@ -0,0 +1,144 @@
+import os
+import asyncio
+import hashlib
+import logging
+import sqlite3
+import threading
+from datetime import datetime
+import numpy as np
+from vector_codec import encode_embedding, decode_embedding
+
+# --- cache ของ embedding ตอน ingest (key = model + token ids ของ chunk) ---
+# mongo: file_agent_db.embedding_cache (main.py ผูกให้), disk: ไฟล์ sqlite ที่ EMBEDDING_CACHE_PATH, off: ไม่ใช้
+EMBEDDING_CACHE = os.getenv("EMBEDDING_CACHE", "mongo").lower()
+EMBEDDING_CACHE_PATH = os.getenv("EMBEDDING_CACHE_PATH", "./embedding_cache.sqlite3")
+# ลบ embedding ที่ไม่ได้เขียนใหม่นานเกินกี่วัน (เฉพาะ mongo, 0 = เก็บตลอด)
+EMBEDDING_CACHE_TTL_DAYS = int(os.getenv("EMBEDDING_CACHE_TTL_DAYS", "180"))
+
+def chunk_cache_key(model, tokens):
+    """hash ของสิ่งที่ส่งให้ API จริง (model + token ids) chunk เดียวกันจากไฟล์ไหนก็ได้ key เดียวกัน"""
+    digest = hashlib.sha256(model.encode("utf-8") + b"\n")
+    digest.update(np.asarray(tokens, dtype="<u4").tobytes())
+    return digest.hexdigest()
+
+class _MongoStore:
+    def __init__(self, collection):
+        self.collection = collection
+        if EMBEDDING_CACHE_TTL_DAYS:
+            try:
+                collection.create_index("created_at", expireAfterSeconds=EMBEDDING_CACHE_TTL_DAYS * 86400)
+            except Exception as e:
+                logging.warning(f"Could not create TTL index on {collection.full_name}: {e}")
+
+    def get_many(self, keys):
+        return {doc["_id"]: decode_embedding(doc["embedding"])
+                for doc in self.collection.find({"_id": {"$in": keys}}, {"embedding": 1})}
+
+    def put_many(self, model, items):
+        from pymongo import ReplaceOne
+        now = datetime.now()
+        self.collection.bulk_write([
+            ReplaceOne({"_id": key}, {"_id": key, "model": model, "embedding": encode_embedding(vector, "binary"), "created_at": now}, upsert=True)
+            for key, vector in items
+        ], ordered=False)
+
+class _DiskStore:
+    def __init__(self, path):
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        with self._lock:
+            self._db.execute("CREATE TABLE IF NOT EXISTS embeddings (key TEXT PRIMARY KEY, model TEXT, embedding BLOB)")
+            self._db.commit()
+
+    def get_many(self, keys):
+        found = {}
+        with self._lock:
+            # sqlite จำกัดจำนวน parameter ต่อ query
+            for start in range(0, len(keys), 500):
+                part = keys[start:start + 500]
+                rows = self._db.execute(
+                    f"SELECT key, embedding FROM embeddings WHERE key IN ({','.join('?' * len(part))})", part
+                ).fetchall()
+                found.update((key, np.frombuffer(blob, dtype="<f4")) for key, blob in rows)
+        return found
+
+    def put_many(self, model, items):
+        with self._lock:
+            self._db.executemany(
+                "INSERT OR REPLACE INTO embeddings (key, model, embedding) VALUES (?, ?, ?)",
+                [(key, model, np.asarray(vector, dtype="<f4").tobytes()) for key, vector in items]
+            )
+            self._db.commit()
+
+class ChunkEmbeddingCache:
+    """
+    Cache embedding ของ chunk ตอน ingest แบบ content-addressed
+    อัปโหลดไฟล์เดิมซ้ำ (หรือแก้แค่บางแถว) จะเรียก embeddings API เฉพาะ chunk ที่ไม่เคยเห็น
+    """
+
+    def __init__(self):
+        self._store = None
+        self.hits = 0
+        self.misses = 0
+
+    def attach_mongo(self, collection):
+        if EMBEDDING_CACHE == "mongo":
+            self._store = _MongoStore(collection)
+
+    def _get_store(self):
+        if self._store is None and EMBEDDING_CACHE == "disk":
+            self._store = _DiskStore(EMBEDDING_CACHE_PATH)
+        return self._store
+
+    async def embed(self, token_lists, model, embed_missing, stats=None):
+        """
+        คืน embeddings ของ token_lists ตามลำดับ: ดึงจาก cache ก่อน ที่เหลือเรียก embed_missing(token_lists) ครั้งเดียว
+        stats (dict) ถ้าส่งมาจะถูกบวก "hits"/"misses" ของการเรียกครั้งนี้
+        """
+        store = self._get_store()
+        if store is None:
+            embeddings = await embed_missing(token_lists)
+            self._count(stats, 0, len(token_lists))
+            return embeddings
+
+        keys = [chunk_cache_key(model, tokens) for tokens in token_lists]
+        try:
+            cached = await asyncio.to_thread(store.get_many, list(set(keys)))
+        except Exception as e:
+            logging.warning(f"Embedding cache lookup failed: {e}")
+            cached = {}
+
+        # chunk ที่ซ้ำกันใน batch เดียวกันก็ embed ครั้งเดียว
+        missing = {}
+        for key, tokens in zip(keys, token_lists):
+            if key not in cached and key not in missing:
+                missing[key] = tokens
+        if missing:
+            new_embeddings = await embed_missing(list(missing.values()))
+            fresh = dict(zip(missing, new_embeddings))
+            try:
+                await asyncio.to_thread(store.put_many, model, list(fresh.items()))
+            except Exception as e:
+                logging.warning(f"Embedding cache write failed: {e}")
+            cached.update(fresh)
+
+        self._count(stats, len(keys) - len(missing), len(missing))
+        return [cached[key] if isinstance(cached[key], list) else cached[key].tolist() for key in keys]
+
+    def _count(self, stats, hits, misses):
+        self.hits += hits
+        self.misses += misses
+        if stats is not None:
+            stats["hits"] = stats.get("hits", 0) + hits
+            stats["misses"] = stats.get("misses", 0) + misses
+
+    def stats(self):
+        total = self.hits + self.misses
+        return {
+            "backend": EMBEDDING_CACHE if self._store is not None else "off",
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": round(self.hits / total, 4) if total else None,
+        }
+
+chunk_embedding_cache = ChunkEmbeddingCache()
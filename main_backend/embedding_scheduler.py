@@ -0,0 +1,170 @@
+import os
+import time
+import heapq
+import random
+import asyncio
+import logging
+import itertools
+
+# --- ตั้งค่าการเรียก embeddings API (ใช้ร่วมกันทั้งการ ingest และคำถาม) ---
+EMBED_MAX_CONCURRENCY = int(os.getenv("EMBED_MAX_CONCURRENCY", "8"))
+EMBED_TPM = int(os.getenv("EMBED_TPM", "1000000"))      # tokens ต่อนาทีตาม tier ของ API key
+EMBED_RPM = int(os.getenv("EMBED_RPM", "3000"))         # requests ต่อนาที
+EMBED_MAX_RETRIES = int(os.getenv("EMBED_MAX_RETRIES", "5"))
+EMBED_BACKOFF_BASE = float(os.getenv("EMBED_BACKOFF_BASE", "0.5"))   # วินาที
+EMBED_BACKOFF_MAX = float(os.getenv("EMBED_BACKOFF_MAX", "30"))
+
+# ค่าน้อยได้คิวก่อน: คำถามของผู้ใช้ต้องไม่รอหลัง batch ของการอัปโหลดไฟล์
+PRIORITY_QUERY = 0
+PRIORITY_INGEST = 1
+
+def estimate_tokens(texts):
+    """ประมาณจำนวน token แบบไม่ต้องใช้ tokenizer (ภาษาไทยราว 1 token ต่อตัวอักษร จึงนับตัวอักษรเป็นขอบบน)"""
+    return sum(len(text) for text in texts) or 1
+
+def _is_retryable(error):
+    # error จาก openai: 429, 5xx, timeout, connection ส่งใหม่ได้; 400/401 ส่งใหม่ก็ไม่ผ่าน
+    status = getattr(error, "status_code", None)
+    if status is not None:
+        return status == 429 or status >= 500
+    return isinstance(error, (asyncio.TimeoutError, ConnectionError)) or type(error).__name__ in (
+        "APIConnectionError", "APITimeoutError", "RateLimitError", "InternalServerError")
+
+def _retry_after(error):
+    response = getattr(error, "response", None)
+    try:
+        return float(response.headers.get("retry-after"))
+    except Exception:
+        return None
+
+class _Bucket:
+    """token bucket: เติม limit หน่วยต่อนาที จุได้ไม่เกิน limit"""
+
+    def __init__(self, per_minute):
+        self.capacity = float(per_minute)
+        self.rate = per_minute / 60.0
+        self.level = self.capacity
+        self.updated = time.monotonic()
+
+    def refill(self):
+        now = time.monotonic()
+        self.level = min(self.capacity, self.level + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def wait_time(self, amount):
+        # request ที่ใหญ่กว่าทั้ง bucket ให้ผ่านเมื่อ bucket เต็ม (ไม่อย่างนั้นจะรอตลอดไป)
+        amount = min(amount, self.capacity)
+        return max(0.0, (amount - self.level) / self.rate)
+
+class EmbeddingScheduler:
+    """
+    คิวกลางของการเรียก embeddings API ทั้ง process
+    - จำกัดจำนวน request พร้อมกัน และงบ tokens/requests ต่อนาที
+    - คิวเรียงตาม priority (คำถามก่อน ingest) แล้วตามลำดับที่เข้ามา
+    - request ที่ล้มเหลวแบบชั่วคราวถูกส่งใหม่เฉพาะ request นั้น (exponential backoff + jitter)
+    """
+
+    def __init__(self, max_concurrency=EMBED_MAX_CONCURRENCY, tpm=EMBED_TPM, rpm=EMBED_RPM,
+                 max_retries=EMBED_MAX_RETRIES):
+        self.max_concurrency = max_concurrency
+        self.max_retries = max_retries
+        self._tokens = _Bucket(tpm)
+        self._requests = _Bucket(rpm)
+        self._waiters = []
+        self._sequence = itertools.count()
+        self._active = 0
+        self._timer = None
+        self.requests = 0
+        self.retries = 0
+        self.rate_limited = 0
+        self.failures = 0
+        self.tokens_sent = 0
+        self.wait_ms_total = {PRIORITY_QUERY: 0.0, PRIORITY_INGEST: 0.0}
+        self.granted = {PRIORITY_QUERY: 0, PRIORITY_INGEST: 0}
+
+    def _schedule(self):
+        # เรียกทุกครั้งที่มีงานเข้า/ออก: ยกเลิก timer ที่รอไว้แล้วคำนวณใหม่
+        if self._timer is not None:
+            self._timer.cancel()
+        self._dispatch()
+
+    def _dispatch(self):
+        self._timer = None
+        while self._waiters and self._active < self.max_concurrency:
+            priority, _, tokens, future = self._waiters[0]
+            if future.done():  # ถูกยกเลิกไปแล้ว
+                heapq.heappop(self._waiters)
+                continue
+            self._tokens.refill()
+            self._requests.refill()
+            delay = max(self._tokens.wait_time(tokens), self._requests.wait_time(1))
+            if delay > 0:
+                # รองบของคิวหัวแถวก่อน ไม่ปล่อยงานที่ priority ต่ำกว่าแซง
+                self._timer = asyncio.get_running_loop().call_later(delay, self._dispatch)
+                return
+            heapq.heappop(self._waiters)
+            self._tokens.level -= min(tokens, self._tokens.capacity)
+            self._requests.level -= 1
+            self._active += 1
+            future.set_result(None)
+
+    async def _acquire(self, tokens, priority):
+        future = asyncio.get_running_loop().create_future()
+        heapq.heappush(self._waiters, (priority, next(self._sequence), tokens, future))
+        self._schedule()
+        started = time.perf_counter()
+        try:
+            await future
+        except asyncio.CancelledError:
+            if future.done() and not future.cancelled():
+                self._release()
+            raise
+        self.wait_ms_total[priority] += (time.perf_counter() - started) * 1000
+        self.granted[priority] += 1
+
+    def _release(self):
+        self._active -= 1
+        self._schedule()
+
+    async def run(self, request, tokens, priority=PRIORITY_INGEST):
+        """
+        เรียก request() (coroutine function ที่ยิง API หนึ่งครั้ง) ภายใต้ limit ของ scheduler
+        tokens คือจำนวน token ของ input ที่จะหักจากงบต่อนาที
+        """
+        for attempt in range(self.max_retries + 1):
+            await self._acquire(tokens, priority)
+            try:
+                self.requests += 1
+                self.tokens_sent += tokens
+                return await request()
+            except Exception as e:
+                if not _is_retryable(e) or attempt == self.max_retries:
+                    self.failures += 1
+                    raise
+                if getattr(e, "status_code", None) == 429:
+                    self.rate_limited += 1
+                self.retries += 1
+                delay = _retry_after(e)
+                if delay is None:
+                    delay = min(EMBED_BACKOFF_BASE * 2 ** attempt, EMBED_BACKOFF_MAX) * (0.5 + random.random())
+                logging.warning(f"Embedding request failed ({e}), retry {attempt + 1}/{self.max_retries} in {delay:.1f}s")
+            finally:
+                self._release()
+            await asyncio.sleep(delay)
+
+    def stats(self):
+        return {
+            "requests": self.requests,
+            "retries": self.retries,
+            "rate_limited": self.rate_limited,
+            "failures": self.failures,
+            "tokens_sent": self.tokens_sent,
+            "active": self._active,
+            "waiting": sum(1 for *_, future in self._waiters if not future.done()),
+            "avg_wait_ms_query": round(self.wait_ms_total[PRIORITY_QUERY] / self.granted[PRIORITY_QUERY], 2)
+            if self.granted[PRIORITY_QUERY] else None,
+            "avg_wait_ms_ingest": round(self.wait_ms_total[PRIORITY_INGEST] / self.granted[PRIORITY_INGEST], 2)
+            if self.granted[PRIORITY_INGEST] else None,
+        }
+
+embedding_scheduler = EmbeddingScheduler()
@@ -0,0 +1,305 @@
+import os
+import json
+import logging
+import threading
+from pathlib import Path
+import numpy as np
+from bson import json_util
+from collection_meta import get_collection_version, get_embedding_field, has_local_update
+from matrix_cache import normalize_rows, SCAN_BATCH_SIZE
+from vector_codec import decode_embedding
+
+try:
+    import faiss
+except ImportError:  # faiss-cpu ไม่ได้ติดตั้ง -> ใช้ brute force แทน
+    faiss = None
+
+# --- ตั้งค่า index ---
+FAISS_INDEX_DIR = os.getenv("FAISS_INDEX_DIR", "./faiss_indexes")
+FAISS_INDEX_TYPE = os.getenv("FAISS_INDEX_TYPE", "hnsw")      # hnsw | flat
+FAISS_HNSW_M = int(os.getenv("FAISS_HNSW_M", "32"))
+FAISS_EF_CONSTRUCTION = int(os.getenv("FAISS_EF_CONSTRUCTION", "80"))
+FAISS_EF_SEARCH = int(os.getenv("FAISS_EF_SEARCH", "64"))
+# สัดส่วนของ vector ที่ถูกลบ (tombstone) ที่ทำให้สร้าง index ใหม่จาก vector ที่เหลือ
+FAISS_COMPACT_FRACTION = float(os.getenv("FAISS_COMPACT_FRACTION", "0.1"))
+
+# index ที่โหลดไว้ในหน่วยความจำ: key = "<db>.<collection>" -> {"index", "ids", "version"}
+# ids[pos] = None คือ vector ที่ถูกลบแล้ว (HNSW ลบ vector ออกจาก index ไม่ได้ การค้นใช้ IDSelector ข้ามตำแหน่งนั้น)
+_loaded_indexes = {}
+_lock = threading.Lock()
+# key ของ index ที่กำลังสร้างใหม่ใน thread เบื้องหลัง
+_rebuilding = set()
+
+def faiss_available():
+    return faiss is not None
+
+def _index_key(collection):
+    return collection.full_name
+
+def _index_paths(key):
+    base = Path(FAISS_INDEX_DIR)
+    return base / f"{key}.index", base / f"{key}.ids.json"
+
+def _new_index(dim):
+    if FAISS_INDEX_TYPE == "flat":
+        return faiss.IndexFlatIP(dim)
+    index = faiss.IndexHNSWFlat(dim, FAISS_HNSW_M, faiss.METRIC_INNER_PRODUCT)
+    index.hnsw.efConstruction = FAISS_EF_CONSTRUCTION
+    index.hnsw.efSearch = FAISS_EF_SEARCH
+    return index
+
+def _persist(key, entry):
+    index_path, ids_path = _index_paths(key)
+    index_path.parent.mkdir(parents=True, exist_ok=True)
+    # เขียนไฟล์ชั่วคราวก่อนแล้วค่อย replace กันไฟล์เสียถ้า process ตายกลางทาง
+    tmp_index = index_path.with_name(index_path.name + ".tmp")
+    tmp_ids = ids_path.with_name(ids_path.name + ".tmp")
+    faiss.write_index(entry["index"], str(tmp_index))
+    with open(tmp_ids, "w", encoding="utf-8") as f:
+        # _id แบบ ObjectId เขียนเป็น {"$oid": ...} อ่านกลับได้ชนิดเดิม (ใช้ $in กับ collection ได้ตรงๆ)
+        json.dump({"ids": entry["ids"], "version": entry["version"]}, f, default=json_util.default)
+    os.replace(tmp_index, index_path)
+    os.replace(tmp_ids, ids_path)
+
+def _filter_same_dim(ids, embeddings):
+    """เก็บเฉพาะ vector ที่มีมิติเท่ากับตัวแรก (กันกรณี embedding ปนกันหลายขนาด)"""
+    kept_ids, kept_vecs = [], []
+    dim = None
+    for doc_id, emb in zip(ids, embeddings):
+        if emb is None or len(emb) == 0:
+            continue
+        if dim is None:
+            dim = len(emb)
+        if len(emb) != dim:
+            continue
+        kept_ids.append(doc_id)
+        kept_vecs.append(emb)
+    return kept_ids, kept_vecs
+
+def build_index_from_documents(collection, ids, embeddings, version=None):
+    """สร้าง index ใหม่ทั้งหมดจาก ids/embeddings ที่มีอยู่แล้ว (ใช้ตอน /upload) แล้วบันทึกลงดิสก์"""
+    if not faiss_available():
+        return None
+    key = _index_key(collection)
+    version = version or get_collection_version(collection)
+    ids, embeddings = _filter_same_dim(ids, embeddings)
+    if not ids:
+        drop_index(collection)
+        return None
+    matrix = normalize_rows(embeddings)
+    index = _new_index(matrix.shape[1])
+    index.add(matrix)
+    entry = {"index": index, "ids": ids, "version": version}
+    with _lock:
+        _loaded_indexes[key] = entry
+        _persist(key, entry)
+    print(f"FAISS index {key}: {index.ntotal} vectors ({FAISS_INDEX_TYPE})")
+    return entry
+
+def build_index(collection):
+    """สแกน collection ทั้งหมดแล้วสร้าง index ใหม่"""
+    # อ่าน version ก่อนสแกน ถ้ามีการเขียนระหว่างสแกน index จะถูกสร้างใหม่อีกรอบ
+    version = get_collection_version(collection)
+    ids, embeddings = [], []
+    field = get_embedding_field(collection)
+    for doc in collection.find({}, {field: 1}, batch_size=SCAN_BATCH_SIZE):
+        ids.append(doc["_id"])
+        embeddings.append(decode_embedding(doc.get(field)))
+    return build_index_from_documents(collection, ids, embeddings, version)
+
+def _rebuild_in_background(collection):
+    """สร้าง index ใหม่ใน thread แยก (ครั้งละงานเดียวต่อ collection) การค้นไม่ต้องรอ"""
+    key = _index_key(collection)
+    with _lock:
+        if key in _rebuilding:
+            return
+        _rebuilding.add(key)
+    logging.warning(f"FAISS index {key} is missing or out of sync with the collection, rebuilding in the background")
+
+    def rebuild():
+        try:
+            build_index(collection)
+        except Exception as e:
+            logging.error(f"Error rebuilding FAISS index {key}: {e}")
+        finally:
+            with _lock:
+                _rebuilding.discard(key)
+
+    threading.Thread(target=rebuild, name=f"faiss-rebuild-{key}", daemon=True).start()
+
+def _read_index(key):
+    """อ่าน index ที่บันทึกไว้บนดิสก์ คืน None ถ้าไม่มีหรือไฟล์ไม่ตรงกัน"""
+    index_path, ids_path = _index_paths(key)
+    if not (index_path.exists() and ids_path.exists()):
+        return None
+    with _lock:
+        index = faiss.read_index(str(index_path))
+        with open(ids_path, "r", encoding="utf-8") as f:
+            saved = json.load(f, object_hook=json_util.object_hook)
+    if FAISS_INDEX_TYPE != "flat" and hasattr(index, "hnsw"):
+        index.hnsw.efSearch = FAISS_EF_SEARCH
+    ids = saved.get("ids", []) if isinstance(saved, dict) else saved
+    if index.ntotal != len(ids):
+        return None
+    return {"index": index, "ids": ids, "version": saved.get("version") if isinstance(saved, dict) else None}
+
+def _load_index(collection, check_version=True, wait=False):
+    """
+    โหลด index จากหน่วยความจำ/ดิสก์ ตรวจกับ version stamp ของ collection
+    ถ้าไม่มีหรือ version ไม่ตรง (มีการเขียนข้อมูลจาก process อื่น) ให้สร้างใหม่:
+    wait=False (ทางค้นหา) สร้างใน thread เบื้องหลังแล้วใช้ index เดิมไปก่อน (None ถ้ายังไม่มี ผู้เรียกใช้ brute force)
+    wait=True (thread ของงาน ingest) สร้างเสร็จก่อนคืนค่า
+    ระหว่างที่ process นี้กำลังอัปเดต index เอง (local_update) ไม่ต้องตรวจ version
+    """
+    key = _index_key(collection)
+    check_version = check_version and not has_local_update(collection)
+    version = get_collection_version(collection) if check_version else None
+    entry = _loaded_indexes.get(key)
+    if entry is not None and (not check_version or entry["version"] == version):
+        return entry
+    if entry is None:
+        entry = _read_index(key)
+        if entry is not None:
+            _loaded_indexes[key] = entry
+            if not check_version or entry["version"] == version:
+                return entry
+    if wait:
+        logging.warning(f"FAISS index {key} is out of sync with the collection, rebuilding")
+        return build_index(collection)
+    _rebuild_in_background(collection)
+    return entry
+
+def add_to_index(collection, ids, embeddings, version=None, persist=True):
+    """
+    เพิ่ม vector ใหม่เข้า index เดิม (ใช้ตอน /upsert)
+    version คือ stamp ที่ endpoint เพิ่งเขียน ใช้แทน stamp เดิมของ index หลังเพิ่มเสร็จ
+    persist=False แก้เฉพาะ index ในหน่วยความจำ (publish ระหว่าง streaming) ต้องเรียก persist_index ภายหลัง
+    """
+    if not faiss_available():
+        return None
+    key = _index_key(collection)
+    entry = _load_index(collection, check_version=False, wait=True)
+    if entry is None:
+        return None
+    # _load_index อาจ rebuild จาก collection ซึ่งมีเอกสารใหม่อยู่แล้ว
+    existing = set(entry["ids"])
+    new_ids, new_vecs = [], []
+    for doc_id, emb in zip(ids, embeddings):
+        if doc_id in existing or len(emb) != entry["index"].d:
+            continue
+        new_ids.append(doc_id)
+        new_vecs.append(emb)
+    if new_ids:
+        with _lock:
+            entry["index"].add(normalize_rows(new_vecs))
+            entry["ids"].extend(new_ids)
+    with _lock:
+        entry["version"] = version or get_collection_version(collection)
+        if persist:
+            _persist(key, entry)
+    return entry
+
+def persist_index(collection):
+    """เขียน index ที่อยู่ในหน่วยความจำลงดิสก์ (หลัง add_to_index(..., persist=False))"""
+    if not faiss_available():
+        return None
+    key = _index_key(collection)
+    entry = _loaded_indexes.get(key)
+    if entry is not None:
+        with _lock:
+            _persist(key, entry)
+    return entry
+
+def _compact(entry):
+    """
+    สร้าง index ใหม่จาก vector ที่ยังไม่ถูกลบ (ดึงจาก index เดิม ไม่ต้องสแกน collection)
+    สร้างนอก lock การค้นใช้ index เดิมได้ระหว่างรอ แล้วสลับเข้าไปพร้อม vector ที่ถูกเพิ่ม/ลบระหว่างนั้น
+    """
+    with _lock:
+        old_index = entry["index"]
+        total = old_index.ntotal
+        kept = [pos for pos, doc_id in enumerate(entry["ids"]) if doc_id is not None]
+    index = _new_index(old_index.d)
+    if kept:
+        index.add(old_index.reconstruct_n(0, total)[kept])
+    with _lock:
+        ids = [entry["ids"][pos] for pos in kept]
+        if old_index.ntotal > total:
+            index.add(old_index.reconstruct_n(total, old_index.ntotal - total))
+            ids.extend(entry["ids"][total:])
+        entry["index"], entry["ids"] = index, ids
+        entry.pop("search_params", None)
+
+def remove_from_index(collection, ids, version=None):
+    """
+    ลบ vector ออกจาก index เดิม (ใช้ตอน /upload ลบ chunk ที่ไม่มีในไฟล์แล้ว) แทนการสร้าง index ใหม่ทั้ง collection
+    ตำแหน่งที่ถูกลบเกิน FAISS_COMPACT_FRACTION ของ index จะถูกตัดออกโดยสร้าง index ใหม่จาก vector ที่เหลือ
+    """
+    if not faiss_available():
+        return None
+    key = _index_key(collection)
+    entry = _load_index(collection, check_version=False, wait=True)
+    if entry is None:
+        return None
+    wanted = set(ids)
+    with _lock:
+        for pos, doc_id in enumerate(entry["ids"]):
+            if doc_id in wanted:
+                entry["ids"][pos] = None
+        entry.pop("search_params", None)
+        compact = entry["ids"].count(None) > FAISS_COMPACT_FRACTION * entry["index"].ntotal
+    if compact:
+        _compact(entry)
+    with _lock:
+        entry["version"] = version or get_collection_version(collection)
+        _persist(key, entry)
+    return entry
+
+def drop_index(collection):
+    key = _index_key(collection)
+    with _lock:
+        _loaded_indexes.pop(key, None)
+        for path in _index_paths(key):
+            if path.exists():
+                path.unlink()
+
+def get_index_dimension(collection):
+    entry = _load_index(collection)
+    return entry["index"].d if entry is not None else None
+
+def _search_params(entry):
+    """
+    SearchParameters ที่มี IDSelector ข้ามตำแหน่งที่ถูกลบ (None ถ้าไม่มีตำแหน่งที่ถูกลบ)
+    เก็บ selector ไว้ใน entry ด้วย (SearchParameters ไม่ได้ถือ reference ของ selector เอง)
+    """
+    if "search_params" not in entry:
+        removed = [pos for pos, doc_id in enumerate(entry["ids"]) if doc_id is None]
+        params = None
+        selectors = ()
+        if removed:
+            selectors = (faiss.IDSelectorBatch(np.asarray(removed, dtype="int64")),)
+            selectors += (faiss.IDSelectorNot(selectors[0]),)
+            if hasattr(entry["index"], "hnsw"):
+                params = faiss.SearchParametersHNSW(sel=selectors[1], efSearch=entry["index"].hnsw.efSearch)
+            else:
+                params = faiss.SearchParameters(sel=selectors[1])
+        entry["search_params"] = (params, selectors)
+    return entry["search_params"][0]
+
+def search_index_many(collection, query_vectors, top_k=4):
+    """หลายคำถามใน index.search ครั้งเดียว คืนค่า list ของ [(score, _id), ...] ตามลำดับคำถาม"""
+    queries = normalize_rows(query_vectors)
+    entry = _load_index(collection)
+    if entry is None:
+        return [[] for _ in range(queries.shape[0])]
+    with _lock:
+        ids = entry["ids"]
+        # index ข้ามตำแหน่งที่ถูกลบเองระหว่างค้น จึงขอผลแค่ top_k
+        scores, positions = entry["index"].search(queries, top_k, params=_search_params(entry))
+    results = []
+    for row_scores, row_positions in zip(scores, positions):
+        results.append([
+            (float(score), ids[pos])
+            for score, pos in zip(row_scores, row_positions) if pos >= 0 and ids[pos] is not None
+        ])
+    return results
@@ -0,0 +1,82 @@
+import os
+import hashlib
+import logging
+import gridfs
+from pymongo.errors import DuplicateKeyError
+
+# --- รูปจากไฟล์ที่อัปโหลด (DOCX/PDF) ---
+# gridfs: ingest pipeline ดึงรูปจาก DOCX/PDF แล้วเก็บลง file_agent_db (bucket images) ครั้งเดียวต่อเนื้อหารูป (main.py ผูกให้)
+# off: ไม่ดึงรูปเลย
+IMAGE_STORE = os.getenv("IMAGE_STORE", "off").lower()
+IMAGE_BUCKET = "images"
+
+def image_digest(data):
+    return hashlib.sha256(data).hexdigest()
+
+def add_image(images, data):
+    """
+    เพิ่มรูป (bytes) ลง images (dict sha256 -> bytes เรียงตามลำดับที่พบ) ถ้ายังไม่มี คืน sha256
+    รูปเดียวกันที่ใช้ซ้ำหลายหน้า/หลายไฟล์จึงถูกเก็บและ embed ครั้งเดียว
+    """
+    digest = image_digest(data)
+    images.setdefault(digest, bytes(data))
+    return digest
+
+class ImageStore:
+    """เก็บรูปลง GridFS โดยใช้ sha256 ของรูปเป็น _id: อัปโหลดรูปเดิมซ้ำ (ไฟล์ไหนก็ได้) ไม่เขียนซ้ำ"""
+
+    def __init__(self):
+        self._bucket = None
+        self._files = None
+        self.stored = 0
+        self.reused = 0
+
+    def attach_mongo(self, db):
+        if IMAGE_STORE == "gridfs":
+            self._bucket = gridfs.GridFSBucket(db, bucket_name=IMAGE_BUCKET)
+            self._files = db[f"{IMAGE_BUCKET}.files"]
+
+    @property
+    def enabled(self):
+        return self._bucket is not None
+
+    def put_many(self, images, filename=None):
+        """เก็บ images (dict sha256 -> bytes) ที่ยังไม่มีใน GridFS คืน sha256 ที่เก็บอยู่แล้วหรือเก็บใหม่สำเร็จ"""
+        if self._bucket is None or not images:
+            return []
+        digests = list(images)
+        existing = {doc["_id"] for doc in self._files.find({"_id": {"$in": digests}}, {"_id": 1})}
+        self.reused += len(existing)
+        saved = list(existing)
+        for digest in digests:
+            if digest in existing:
+                continue
+            try:
+                self._bucket.upload_from_stream_with_id(digest, filename or digest, images[digest])
+                self.stored += 1
+            except (DuplicateKeyError, gridfs.errors.FileExists):
+                # อีก request เก็บรูปเดียวกันไปพร้อมกัน
+                self.reused += 1
+            except Exception as e:
+                logging.warning(f"Could not store image {digest} in GridFS: {e}")
+                continue
+            saved.append(digest)
+        return saved
+
+    def get(self, digest):
+        """bytes ของรูปจาก sha256 หรือ None"""
+        if self._bucket is None:
+            return None
+        try:
+            return self._bucket.open_download_stream(digest).read()
+        except gridfs.errors.NoFile:
+            return None
+
+    def stats(self):
+        return {
+            "backend": "gridfs" if self._bucket is not None else "off",
+            "stored": self.stored,
+            "reused": self.reused,
+        }
+
+image_store = ImageStore()
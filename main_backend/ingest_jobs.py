@@ -0,0 +1,214 @@
+import os
+import json
+import uuid
+import socket
+import asyncio
+import logging
+from datetime import datetime, timedelta
+from uploadfile import SpooledUpload
+
+# --- ตั้งค่า job ingest เบื้องหลัง (/upload, /upsert) ---
+# จำนวน job ที่รันพร้อมกันต่อ process (แต่ละ job ยังจำกัดการเรียก API ผ่าน embedding_scheduler)
+INGEST_WORKERS = int(os.getenv("INGEST_WORKERS", "2"))
+# เขียนความคืบหน้าลง MongoDB ทุกกี่วินาที (และเป็นรอบที่ SSE ส่งสถานะใหม่)
+INGEST_JOB_PROGRESS_SECONDS = float(os.getenv("INGEST_JOB_PROGRESS_SECONDS", "1"))
+# job ที่ยังไม่จบแต่ไม่มีความคืบหน้า/heartbeat นานเกินนี้ (process ที่รับ job ตายหรือถูก restart) ถูกปิดเป็น failed
+INGEST_JOB_STALE_SECONDS = float(os.getenv("INGEST_JOB_STALE_SECONDS", "60"))
+# ลบ job เก่าอัตโนมัติหลังกี่วัน (0 = เก็บตลอด)
+INGEST_JOB_TTL_DAYS = int(os.getenv("INGEST_JOB_TTL_DAYS", "7"))
+# SSE ส่ง comment ทุกกี่วินาทีเมื่อสถานะไม่เปลี่ยน กัน proxy ตัด connection
+SSE_KEEPALIVE_SECONDS = 15
+
+FINISHED_STATUSES = ("done", "failed")
+STALE_JOB_ERROR = "The worker running this job stopped before it finished"
+
+def _public(job):
+    """job document ในรูปที่ส่งให้ client (datetime เป็น ISO string)"""
+    view = {"job_id": job["_id"]}
+    for key, value in job.items():
+        if key != "_id":
+            view[key] = value.isoformat() if isinstance(value, datetime) else value
+    return view
+
+class IngestJobQueue:
+    """
+    คิว job ingest ใน process: request อ่านไฟล์เก็บไว้ (SpooledUpload) แล้วคืน job_id ทันที worker รัน pipeline ต่อเบื้องหลัง
+    สถานะและความคืบหน้าของแต่ละขั้นถูกเก็บใน MongoDB (file_agent_db.ingest_jobs) จึงดูได้จากทุก worker process
+    job บันทึก owner (process ที่รับ job) และ updated_at ถูกเขียนทุก INGEST_JOB_PROGRESS_SECONDS เป็น heartbeat
+    ไฟล์ของ job อยู่ในหน่วยความจำ/ไฟล์ชั่วคราวของ process นั้น job ที่ heartbeat ขาดจึงทำต่อไม่ได้ ถูกปิดเป็น failed
+    """
+
+    def __init__(self, workers=INGEST_WORKERS):
+        self.workers = workers
+        self.owner = f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}"
+        self.collection = None
+        self._queue = None
+        self._tasks = []
+        # job ที่ยังไม่จบของ process นี้ อ่านสถานะได้โดยไม่ต้อง query MongoDB
+        self._jobs = {}
+        self.completed = 0
+        self.failed = 0
+
+    def attach_mongo(self, collection):
+        self.collection = collection
+        if INGEST_JOB_TTL_DAYS:
+            try:
+                collection.create_index("created_at", expireAfterSeconds=INGEST_JOB_TTL_DAYS * 86400)
+            except Exception as e:
+                logging.warning(f"Could not create TTL index on {collection.full_name}: {e}")
+        # job ที่ค้างจาก process ก่อน restart
+        self.expire_stale_jobs()
+
+    def expire_stale_jobs(self, job_id=None):
+        """ปิด job ของ process อื่นที่ยังไม่จบแต่ heartbeat ขาดเกิน INGEST_JOB_STALE_SECONDS เป็น failed คืนจำนวน job"""
+        if self.collection is None:
+            return 0
+        now = datetime.now()
+        query = {
+            "status": {"$nin": list(FINISHED_STATUSES)},
+            "owner": {"$ne": self.owner},
+            "updated_at": {"$lt": now - timedelta(seconds=INGEST_JOB_STALE_SECONDS)},
+        }
+        if job_id is not None:
+            query["_id"] = job_id
+        try:
+            expired = self.collection.update_many(query, {"$set": {
+                "status": "failed", "error": STALE_JOB_ERROR, "finished_at": now, "updated_at": now,
+            }}).modified_count
+        except Exception as e:
+            logging.warning(f"Could not expire stale ingest jobs: {e}")
+            return 0
+        if expired and job_id is None:
+            logging.warning(f"Marked {expired} stale ingest jobs as failed")
+        return expired
+
+    def _start_workers(self):
+        # สร้างตอน submit ครั้งแรก เพื่อให้อยู่ใน event loop ของ server
+        if self._queue is None:
+            self._queue = asyncio.Queue()
+            self._tasks = [asyncio.create_task(self._worker()) for _ in range(self.workers)]
+            self._tasks.append(asyncio.create_task(self._report_progress()))
+
+    def _save(self, job, insert=False):
+        if self.collection is None:
+            return
+        try:
+            if insert:
+                self.collection.insert_one(dict(job))
+            else:
+                self.collection.update_one({"_id": job["_id"]}, {"$set": {k: v for k, v in job.items() if k != "_id"}})
+        except Exception as e:
+            logging.warning(f"Could not save ingest job {job['_id']}: {e}")
+
+    def _update(self, job, **fields):
+        job.update(fields)
+        job["updated_at"] = datetime.now()
+        self._save(job)
+
+    async def submit(self, kind, session_id, files, run, **fields):
+        """
+        อ่านไฟล์เก็บไว้ให้ job (ไฟล์เล็กอยู่ในหน่วยความจำ ไฟล์ใหญ่อยู่ในไฟล์ชั่วคราว) แล้วเข้าคิว คืน job (สถานะ queued)
+        UploadFile ถูกปิดเมื่อ request จบ จึงต้องอ่านก่อนคืน response
+        run(stored_files, progress) คือ coroutine function ที่ ingest จริง อัปเดต dict progress ระหว่างทำงาน และคืนผลสรุป
+        """
+        job_id = str(uuid.uuid4())
+        stored = []
+        try:
+            for upload_file in files:
+                stored.append(await SpooledUpload.from_upload(upload_file))
+        except Exception:
+            for stored_file in stored:
+                stored_file.close()
+            raise
+        now = datetime.now()
+        job = {
+            "_id": job_id,
+            "kind": kind,
+            "session_id": session_id,
+            "status": "queued",
+            "owner": self.owner,
+            "files": [upload_file.filename for upload_file in files],
+            **fields,
+            "progress": {},
+            "result": None,
+            "error": None,
+            "created_at": now,
+            "updated_at": now,
+        }
+        self._save(job, insert=True)
+        self._jobs[job_id] = job
+        self._start_workers()
+        await self._queue.put((job, stored, run))
+        return _public(job)
+
+    async def _worker(self):
+        while True:
+            job, stored, run = await self._queue.get()
+            try:
+                await self._run(job, stored, run)
+            finally:
+                for stored_file in stored:
+                    stored_file.close()
+                self._jobs.pop(job["_id"], None)
+                self._queue.task_done()
+
+    async def _report_progress(self):
+        """เขียนความคืบหน้าของ job ที่รันอยู่ และ heartbeat (updated_at) ของทุก job ที่ยังไม่จบใน process นี้"""
+        while True:
+            await asyncio.sleep(INGEST_JOB_PROGRESS_SECONDS)
+            for job in list(self._jobs.values()):
+                self._update(job)
+
+    async def _run(self, job, stored, run):
+        self._update(job, status="running", started_at=datetime.now())
+        try:
+            result = await run(stored, job["progress"])
+        except Exception as e:
+            logging.error(f"Ingest job {job['_id']} failed: {e}")
+            self.failed += 1
+            self._update(job, status="failed", error=str(e), finished_at=datetime.now())
+        else:
+            self.completed += 1
+            self._update(job, status="done", result=result, finished_at=datetime.now())
+
+    def get(self, job_id):
+        """สถานะของ job (job ของ process นี้อ่านจากหน่วยความจำ, ของ process อื่นอ่านจาก MongoDB) หรือ None"""
+        job = self._jobs.get(job_id)
+        if job is None and self.collection is not None:
+            job = self.collection.find_one({"_id": job_id})
+            if job and job["status"] not in FINISHED_STATUSES and self.expire_stale_jobs(job_id):
+                job = self.collection.find_one({"_id": job_id})
+        return _public(job) if job else None
+
+    async def events(self, job_id):
+        """Server-Sent Events ของ job: ส่งสถานะเมื่อเปลี่ยน จบเมื่อ job เสร็จ/ล้มเหลว"""
+        last_payload = None
+        idle = 0.0
+        while True:
+            job = self.get(job_id)
+            if job is None:
+                yield f"event: error\ndata: {json.dumps({'error': 'Job not found'})}\n\n"
+                return
+            payload = json.dumps(job, ensure_ascii=False, default=str)
+            if payload != last_payload:
+                yield f"data: {payload}\n\n"
+                last_payload = payload
+                idle = 0.0
+            elif idle >= SSE_KEEPALIVE_SECONDS:
+                yield ": keep-alive\n\n"
+                idle = 0.0
+            if job["status"] in FINISHED_STATUSES:
+                return
+            await asyncio.sleep(INGEST_JOB_PROGRESS_SECONDS)
+            idle += INGEST_JOB_PROGRESS_SECONDS
+
+    def stats(self):
+        return {
+            "workers": self.workers,
+            "queued": sum(1 for job in self._jobs.values() if job["status"] == "queued"),
+            "running": sum(1 for job in self._jobs.values() if job["status"] == "running"),
+            "completed": self.completed,
+            "failed": self.failed,
+        }
+
+ingest_jobs = IngestJobQueue()
@@ -0,0 +1,360 @@
+import os
+import json
+import time
+import asyncio
+import hashlib
+import logging
+from collections import deque
+from uploadfile import SpooledUpload, iter_file_units, plan_file_parts, parse_file_part, run_parser, PARSE_WORKERS
+from image_store import image_store
+
+# --- ตั้งค่า pipeline อ่านไฟล์ -> แบ่ง chunk -> embed -> เขียน ---
+# ขนาดคิวระหว่างแต่ละขั้น (จำนวน item ที่รอได้) ทำให้หน่วยความจำคงที่ไม่ว่าไฟล์จะใหญ่แค่ไหน
+PIPELINE_QUEUE_SIZE = int(os.getenv("PIPELINE_QUEUE_SIZE", "4"))
+# batch ละไม่เกินกี่ token (1 batch = embed 1 request และเขียนลง store 1 ครั้ง)
+PIPELINE_BATCH_TOKENS = int(os.getenv("PIPELINE_BATCH_TOKENS", "32000"))
+# จำนวน batch ที่ embed พร้อมกันได้
+PIPELINE_EMBED_CONCURRENCY = int(os.getenv("PIPELINE_EMBED_CONCURRENCY", "4"))
+
+_DONE = object()
+# ไฟล์ที่อ่านแบบ streaming ใน thread แทนการส่งเข้า process pool
+_STREAM = object()
+
+async def buffered(source, maxsize=PIPELINE_QUEUE_SIZE):
+    """
+    รัน async generator ต้นทางเป็น task แยก ส่งผลผ่านคิวที่จำกัดขนาด
+    ขั้นก่อนหน้าทำงานล่วงหน้าได้ไม่เกิน maxsize item แล้วรอ (backpressure)
+    """
+    queue = asyncio.Queue(maxsize)
+
+    async def pump():
+        try:
+            async for item in source:
+                await queue.put(item)
+            await queue.put(_DONE)
+        except Exception as e:
+            await queue.put(e)
+        finally:
+            await source.aclose()
+
+    task = asyncio.create_task(pump())
+    try:
+        while True:
+            item = await queue.get()
+            if item is _DONE:
+                break
+            if isinstance(item, Exception):
+                raise item
+            yield item
+    finally:
+        task.cancel()
+
+def row_fingerprint(metadata, row, occurrence=0):
+    """
+    fingerprint ระดับแถว/หน้า: ชื่อไฟล์ + เนื้อหา (แถวเดิมของไฟล์เดิมได้ค่าเดิมเสมอ ไม่ว่าจะย้ายไปอยู่ตำแหน่งไหน)
+    occurrence คือลำดับของแถวที่เนื้อหาซ้ำกันในไฟล์เดียวกัน (ย่อหน้า/แถวซ้ำได้ id แยกกัน ไม่เขียนทับกัน)
+    """
+    key = [metadata.get("file"), row] if not occurrence else [metadata.get("file"), row, occurrence]
+    payload = json.dumps(key, ensure_ascii=False, sort_keys=True, default=str)
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()[:24]
+
+class IngestDiff:
+    """
+    เทียบไฟล์ที่กำลัง ingest กับข้อมูลที่อยู่ใน store แล้ว (id ของ chunk มาจาก fingerprint ของแถว จึงเทียบด้วย id ได้เลย)
+    - ไฟล์ที่ sha256 ตรงกับที่ ingest ครบไปแล้ว ไม่ต้องอ่าน/แบ่ง chunk ใหม่
+    - chunk ที่ id มีอยู่แล้วใน store ไม่ต้อง embed/เขียนซ้ำ
+    store=None (หรือ store ที่ตอบไม่ได้ว่ามี id ไหนบ้าง) ทำแค่บันทึก fingerprint ไม่ข้ามอะไร
+    recorded_chunks(file, sha256) คืนจำนวน chunk ที่บันทึกไว้ตอน ingest ไฟล์นี้สำเร็จ หรือ None
+    ไฟล์ที่ parse ไม่สำเร็จ (fail_file) ไม่ถูกบันทึก fingerprint และ chunk เดิมของไฟล์นั้นไม่ถูกลบ
+    """
+
+    def __init__(self, store=None, recorded_chunks=None):
+        self.store = store
+        self.recorded_chunks = recorded_chunks
+        # id ของ chunk ทุกตัวในไฟล์ชุดนี้ (ทั้งใหม่และไม่เปลี่ยน) ใช้หา chunk ที่หายไปตอน /upload
+        self.seen = set()
+        self.unchanged = 0
+        self.skipped_files = []
+        self.files = {}
+        # ไฟล์ที่ parse ไม่ครบ -> ข้อความ error
+        self.failed = {}
+        # id เดิมของไฟล์ที่ parse ไม่ครบ (ไม่ลบ) / True = หา id ของไฟล์ไม่ได้ ต้องไม่ลบอะไรเลย
+        self.kept = set()
+        self.keep_all = False
+
+    async def skip_file(self, filename, file_hash):
+        self.files[filename] = {"file": filename, "sha256": file_hash, "chunks": 0}
+        if self.store is None or self.recorded_chunks is None:
+            return False
+        expected = await asyncio.to_thread(self.recorded_chunks, filename, file_hash)
+        if not expected:
+            return False
+        ids = await asyncio.to_thread(self.store.ids_for_file, filename, file_hash)
+        # ingest ครั้งก่อนไม่ครบ หรือ chunk ถูกลบไปแล้ว ต้องอ่านไฟล์ใหม่
+        if ids is None or len(ids) != expected:
+            return False
+        self.seen.update(ids)
+        self.unchanged += len(ids)
+        self.files[filename]["chunks"] = len(ids)
+        self.skipped_files.append(filename)
+        return True
+
+    async def new_chunks(self, batch):
+        unique = []
+        for chunk in batch:
+            # id ที่เจอแล้วในไฟล์ชุดนี้ไม่นับและไม่เขียนซ้ำ (จำนวน chunk ต่อไฟล์ต้องตรงกับจำนวน id ใน store)
+            if chunk["_id"] in self.seen:
+                continue
+            self.seen.add(chunk["_id"])
+            self.files[chunk["metadata"]["file"]]["chunks"] += 1
+            unique.append(chunk)
+        batch = unique
+        if not batch:
+            return batch
+        ids = [chunk["_id"] for chunk in batch]
+        existing = None
+        if self.store is not None:
+            existing = await asyncio.to_thread(self.store.existing_ids, ids)
+        if not existing:
+            return batch
+        fresh = [chunk for chunk in batch if chunk["_id"] not in existing]
+        self.unchanged += len(batch) - len(fresh)
+        return fresh
+
+    async def fail_file(self, filename, error):
+        """ไฟล์ที่ parse ไม่สำเร็จทั้งไฟล์หรือบางช่วงหน้า: ครั้งหน้าต้องอ่านใหม่ และ chunk เดิมยังต้องอยู่"""
+        if filename in self.failed:
+            return
+        self.failed[filename] = str(error)
+        if self.store is None:
+            return
+        ids = await asyncio.to_thread(self.store.ids_for_file, filename, None)
+        if ids is None:
+            self.keep_all = True
+        else:
+            self.kept.update(ids)
+
+    def stale_ids(self, previous_ids):
+        """chunk เดิมที่ไม่มีในไฟล์ชุดนี้แล้ว (ลบได้) ยกเว้น chunk ของไฟล์ที่ parse ไม่สำเร็จ"""
+        if self.keep_all:
+            return set()
+        return previous_ids - self.seen - self.kept
+
+    @property
+    def failed_files(self):
+        return [{"file": filename, "error": error} for filename, error in self.failed.items()]
+
+    def fingerprints(self):
+        return [entry for entry in self.files.values() if entry["file"] not in self.failed]
+
+def _record_parse_time(stats, filename, seconds):
+    for entry in stats["parse"]:
+        if entry["file"] == filename:
+            entry["seconds"] = round(entry["seconds"] + seconds, 3)
+            entry["parts"] += 1
+            return
+
+async def _stream_units(source, filename):
+    """CSV/Excel: อ่านทีละหน่วยใน thread (pandas อ่านเป็นก้อนอยู่แล้ว หน่วยความจำไม่โตตามขนาดไฟล์)"""
+    units = iter_file_units(source, filename)
+    try:
+        while True:
+            unit = await asyncio.to_thread(next, units, _DONE)
+            if unit is _DONE:
+                break
+            yield unit
+    finally:
+        units.close()
+
+async def parse_uploads(upload_files, spools, diff, stats):
+    """
+    ขั้นอ่านไฟล์: คืน (metadata, row) ทีละหน่วย metadata มี sha256 ของไฟล์ (file_hash) ติดไปด้วย
+    PDF (ทีละช่วงหน้า) และ DOCX ถูก parse ใน process pool ล่วงหน้าพร้อมกันหลายงาน ทั้งข้ามไฟล์และข้ามช่วงหน้า
+    แต่ผลถูกส่งต่อตามลำดับไฟล์/หน้าเสมอ (id ของ chunk และลำดับการเขียนจึงเหมือนเดิมทุกครั้ง)
+    stats["parse"] เก็บเวลาที่ใช้ parse ของแต่ละไฟล์ ไฟล์ที่ parse ไม่สำเร็จถูกบันทึกใน diff (diff.fail_file)
+    IMAGE_STORE=gridfs: รูปใน DOCX/PDF ถูกดึงในงาน parse เดียวกัน แล้วเก็บลง image_store ครั้งเดียวต่อเนื้อหารูป (stats["images"])
+    ไฟล์เล็กถูก parse จาก bytes ในหน่วยความจำ ไม่ต้องเขียนลงดิสก์ (SpooledUpload) ยกเว้นไฟล์ที่แบ่งเป็นหลายงาน (เขียนลงไฟล์ชั่วคราวก่อน)
+    ไฟล์ที่ spool ขึ้นใหม่ถูกเพิ่มใน spools ให้ผู้เรียกปิด
+    """
+    entries = []
+    for upload_file in upload_files:
+        spool = await SpooledUpload.from_upload(upload_file)
+        if spool is not upload_file:
+            spools.append(spool)
+        filename, source, file_hash = spool.filename, spool.source, spool.sha256
+        stats["files"] += 1
+        if await diff.skip_file(filename, file_hash):
+            continue
+        try:
+            parts = await asyncio.to_thread(plan_file_parts, source, filename)
+        except Exception as e:
+            logging.error(f"❌ Error processing file {filename}: {e}")
+            await diff.fail_file(filename, e)
+            continue
+        if parts is not None and len(parts) > 1 and not isinstance(source, str):
+            # หลายช่วงหน้า: ส่ง path ให้แต่ละงาน แทนการ pickle bytes ทั้งไฟล์ไปทุกงาน
+            source = await asyncio.to_thread(spool.spill)
+        stats["parse"].append({"file": filename, "seconds": 0.0, "parts": 0})
+        for part in (parts if parts is not None else [_STREAM]):
+            entries.append((filename, source, file_hash, part))
+
+    # งานที่ส่งเข้า pool ล่วงหน้าได้ไม่เกินนี้ (ผลของงานที่รอส่งต่อกินหน่วยความจำ)
+    window = max(1, PARSE_WORKERS) * 2
+    with_images = image_store.enabled
+    # sha256 ของรูปที่เก็บไปแล้วใน upload นี้ (รูปเดียวกันหลายไฟล์/หลายช่วงหน้าเก็บครั้งเดียว)
+    stored_images = set()
+    pending = deque()
+    remaining = iter(entries)
+    in_flight = 0
+
+    def submit():
+        nonlocal in_flight
+        while in_flight < window:
+            entry = next(remaining, None)
+            if entry is None:
+                return
+            filename, source, _, part = entry
+            if part is _STREAM:
+                pending.append((entry, None))
+            else:
+                pending.append((entry, asyncio.ensure_future(run_parser(parse_file_part, source, filename, part, with_images))))
+                in_flight += 1
+
+    try:
+        submit()
+        while pending:
+            (filename, source, file_hash, part), task = pending.popleft()
+            if task is None:
+                started = time.perf_counter()
+                try:
+                    async for metadata, row in _stream_units(source, filename):
+                        stats["units"] += 1
+                        yield {**metadata, "file_hash": file_hash}, row
+                except Exception as e:
+                    logging.error(f"❌ Error processing file {filename}: {e}")
+                    await diff.fail_file(filename, e)
+                _record_parse_time(stats, filename, time.perf_counter() - started)
+                continue
+            in_flight -= 1
+            try:
+                units, images, seconds = await task
+            except Exception as e:
+                # รวม BrokenProcessPool (worker ตาย) ไฟล์นี้ได้ไม่ครบทุกหน้า
+                logging.error(f"❌ Error processing file {filename} (pages {part}): {e}")
+                await diff.fail_file(filename, f"pages {part}: {e}" if part is not None else e)
+                units, images, seconds = [], {}, 0.0
+            submit()
+            _record_parse_time(stats, filename, seconds)
+            images = {digest: data for digest, data in images.items() if digest not in stored_images}
+            if images:
+                stored_images.update(images)
+                try:
+                    await asyncio.to_thread(image_store.put_many, images, filename)
+                except Exception as e:
+                    logging.warning(f"Could not store images of {filename}: {e}")
+                stats["images"] = len(stored_images)
+            for metadata, row in units:
+                stats["units"] += 1
+                yield {**metadata, "file_hash": file_hash}, row
+    finally:
+        for _, task in pending:
+            if task is not None:
+                task.cancel()
+
+async def chunk_batches(units, id_prefix="", max_tokens=PIPELINE_BATCH_TOKENS):
+    """
+    ขั้นแบ่ง chunk: รวม chunk จากหลายหน่วยเป็น batch ตามจำนวน token รวม
+    id ของ chunk คือ {row_hash}_chunk{ลำดับในแถว} อัปโหลดไฟล์เดิมซ้ำได้ id เดิม และ chunk ที่ติดกันในแถว/หน้าเดียวกันยังรวมกันได้ตอนค้น
+    แต่ละ chunk พก token ids ที่ได้จากการแบ่งไว้ ขั้น embed ใช้ต่อได้เลย
+    """
+    from embed_MongoDB import chunk_row_tokens
+    batch, batch_tokens = [], 0
+    # จำนวนครั้งที่พบแถวเนื้อหาเดียวกัน (ต่อไฟล์ เพราะ fingerprint รวมชื่อไฟล์)
+    occurrences = {}
+    async for metadata, row in units:
+        row_hash = row_fingerprint(metadata, row)
+        occurrence = occurrences.get(row_hash, 0)
+        occurrences[row_hash] = occurrence + 1
+        if occurrence:
+            row_hash = row_fingerprint(metadata, row, occurrence)
+        row_metadata = {**metadata, "row_hash": row_hash}
+        for chunk_index, (text, tokens) in enumerate(chunk_row_tokens(row)):
+            if batch and batch_tokens + len(tokens) > max_tokens:
+                yield batch
+                batch, batch_tokens = [], 0
+            batch.append({"_id": f"{id_prefix}{row_hash}_chunk{chunk_index}", "text": text, "tokens": tokens, "metadata": row_metadata})
+            batch_tokens += len(tokens)
+    if batch:
+        yield batch
+
+async def skip_unchanged(batches, diff):
+    """ตัด chunk ที่มีอยู่แล้วใน store ออกก่อนขั้น embed (batch ที่ไม่เหลืออะไรถูกข้ามไปเลย)"""
+    async for batch in batches:
+        batch = await diff.new_chunks(batch)
+        if batch:
+            yield batch
+
+async def embed_batches(batches, embed_chunks, stats, concurrency=PIPELINE_EMBED_CONCURRENCY):
+    """ขั้น embed: embed หลาย batch พร้อมกันได้ไม่เกิน concurrency แต่คืนผลตามลำดับเดิม เป็น (chunks, embeddings)"""
+
+    async def embed(batch):
+        embeddings = await embed_chunks(batch)
+        stats["embedded"] += len(batch)
+        return embeddings
+
+    pending = deque()
+    try:
+        async for batch in batches:
+            pending.append((batch, asyncio.create_task(embed(batch))))
+            if len(pending) >= concurrency:
+                batch, task = pending.popleft()
+                yield batch, await task
+        while pending:
+            batch, task = pending.popleft()
+            yield batch, await task
+    finally:
+        for _, task in pending:
+            task.cancel()
+
+def new_progress():
+    """
+    ตัวนับของ pipeline: ไฟล์ที่อ่าน, หน่วย (แถว/หน้า/ย่อหน้า) ที่ parse, chunk ที่ embed/เขียนแล้ว, chunk ที่ไม่เปลี่ยน,
+    รูปที่ไม่ซ้ำกัน (IMAGE_STORE=gridfs), เวลา parse ของแต่ละไฟล์
+    """
+    return {"files": 0, "units": 0, "embedded": 0, "chunks": 0, "unchanged": 0, "batches": 0, "images": 0, "parse": [], "failed_files": []}
+
+async def run_ingest_pipeline(upload_files, embed_chunks, write_batch, id_prefix="", diff=None, progress=None):
+    """
+    อ่าน -> แบ่ง chunk -> (ข้าม chunk ที่ไม่เปลี่ยน) -> embed -> เขียน แบบ streaming ทีละ batch
+    embed_chunks(chunks) คืน embeddings ของ chunk (dict ที่มี "text" และ "tokens")
+    write_batch(chunks, embeddings) ถูกเรียกทันทีที่ batch แรก embed เสร็จ จึงค้นเจอได้ก่อนอ่านไฟล์ครบ
+    diff (IngestDiff) ถ้าไม่ส่งมาจะเขียนทุก chunk
+    progress (dict) ถูกเติมตัวนับของ new_progress และอัปเดตระหว่างทำงาน ผู้เรียกอ่านความคืบหน้าได้ระหว่างรอ
+    คืนสถิติของการ ingest ("chunks" นับเฉพาะ chunk ที่เขียนใหม่)
+    """
+    started = time.perf_counter()
+    diff = diff or IngestDiff()
+    stats = progress if progress is not None else {}
+    stats.update(new_progress(), first_write_seconds=None)
+    spools = []
+    try:
+        units = buffered(parse_uploads(upload_files, spools, diff, stats))
+        batches = buffered(skip_unchanged(chunk_batches(units, id_prefix), diff))
+        async for chunks, embeddings in buffered(embed_batches(batches, embed_chunks, stats)):
+            await write_batch(chunks, embeddings)
+            stats["chunks"] += len(chunks)
+            stats["batches"] += 1
+            stats["unchanged"] = diff.unchanged
+            if stats["first_write_seconds"] is None:
+                stats["first_write_seconds"] = round(time.perf_counter() - started, 3)
+    finally:
+        for spool in spools:
+            spool.close()
+    stats["unchanged"] = diff.unchanged
+    stats["failed_files"] = diff.failed_files
+    stats["seconds"] = round(time.perf_counter() - started, 3)
+    print(f"Ingest pipeline: {stats['chunks']} chunks in {stats['batches']} batches ({stats['unchanged']} unchanged), "
+          f"first batch written after {stats['first_write_seconds']}s, total {stats['seconds']}s")
+    for entry in stats["parse"]:
+        print(f"  parsed {entry['file']} in {entry['seconds']}s ({entry['parts']} parts)")
+    return stats
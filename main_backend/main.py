@@ -1,9 +1,10 @@
 from fastapi import FastAPI, UploadFile, File, Form, BackgroundTasks, Request, Response, HTTPException
-from fastapi.responses import JSONResponse
+from fastapi.responses import JSONResponse, StreamingResponse
 from fastapi.middleware.cors import CORSMiddleware
 from pymongo import MongoClient
 import pandas as pd
 import os
+import json
 import time
 import uuid
 import asyncio
@@ -12,13 +13,24 @@ import logging
 from dotenv import load_dotenv
 from langchain_openai import ChatOpenAI
 from langchain_experimental.agents import create_pandas_dataframe_agent
-from pinecone import Pinecone, ServerlessSpec
 from langchain.callbacks.streaming_stdout import StreamingStdOutCallbackHandler
 from uploadfile import * 
 from embed_pinecone import *
 from retrival_Pinecone import *
 from embed_MongoDB import *
 from retrival_MongoDB import *
+from collection_meta import get_embedding_settings
+from migrate_embeddings import migrate_collection_embeddings, get_running_migration
+from matrix_cache import matrix_cache
+from query_cache import query_embedding_cache, reset_openai_client, QUERY_CACHE_PERSIST
+from vector_store import get_vector_store, vector_store_stats, PineconeVectorStore, OpenAIEmbedder
+from ingest_pipeline import run_ingest_pipeline, IngestDiff
+from ingest_jobs import ingest_jobs
+from embedding_scheduler import embedding_scheduler
+from embedding_cache import chunk_embedding_cache
+from image_store import image_store
+from pinecone_local import get_pinecone_client, PINECONE_LOCAL
+from pinecone_ingest import ensure_index
 from Prompt import *
 from token_reduceContext import *
 from send_email import *
@@ -84,7 +96,7 @@ OPENAI_API_KEY = os.getenv("OPENAI_API_KEY")
 MONGO_URL = os.getenv("MONGO_URL")
 PINECONE_API_KEY = os.getenv("PINECONE_API_KEY")
 PINECONE_ENV = os.getenv("PINECONE_ENV")
-EMBEDDING_MODEL = os.getenv("EMBEDDING_MODEL")
+EMBEDDING_MODEL = os.getenv("EMBEDDING_MODEL", os.getenv("EMBEDDING", "text-embedding-3-small"))
 HF_TOKEN = os.getenv("HF_TOKEN")
 TYPHOON_API_KEY = os.getenv("TYPHOON_API_KEY")
 TYPHOON_API_URL = os.getenv("TYPHOON_API_URL", "https://api.opentyphoon.ai/v1")
@@ -120,17 +132,23 @@ def reload_environment_variables():
     api_key_aiforthai_emotional = os.getenv("api_key_aiforthai_emotional", api_key_aiforthai_emotional)
     EMAIL_ADMIN = os.getenv("EMAIL_ADMIN", EMAIL_ADMIN)
     EMAIL_PASS = os.getenv("EMAIL_PASS", EMAIL_PASS)
+    reset_openai_client()
     
     logger.info("Environment variables reloaded successfully")
 
 # MongoDB setup
 mongo_client = MongoClient(MONGO_URL)
 db = mongo_client["file_agent_db"]
+if QUERY_CACHE_PERSIST:
+    query_embedding_cache.attach_store(db["query_embedding_cache"])
+chunk_embedding_cache.attach_mongo(db["embedding_cache"])
 logs_collection = db["upload_logs"]
+ingest_jobs.attach_mongo(db["ingest_jobs"])
+image_store.attach_mongo(db)
 
 # Pinecone setup
-if PINECONE_API_KEY:
-    pc = Pinecone(api_key=PINECONE_API_KEY, environment=PINECONE_ENV)
+if PINECONE_API_KEY or PINECONE_LOCAL:
+    pc = get_pinecone_client(PINECONE_API_KEY, PINECONE_ENV)
 
 # FastAPI
 app = FastAPI(title="AI Assistant Backend API", version="1.0.0")
@@ -420,11 +438,10 @@ async def get_pinecone_indexes(request: Request):
         
         # Initialize Pinecone like app.py does
         try:
-            pc = Pinecone(api_key=api_key, environment=environment)
+            pc = get_pinecone_client(api_key, environment)
             
             # Get list of indexes like app.py
-            indexes = pc.list_indexes()
-            index_names = [index.name for index in indexes]
+            index_names = pc.list_indexes().names()
             
             return {"indexes": index_names}
         except Exception as pinecone_error:
@@ -704,94 +721,188 @@ async def send_facebook_message_api(request: Request):
         logger.error(f"Error sending Facebook message: {e}")
         return JSONResponse(content={"error": str(e)}, status_code=500)
 
+def _session_log(session_id, db_type, files, **fields):
+    return {
+        "session_id": session_id,
+        "db_type": db_type,
+        "files": [f.filename for f in files],
+        **fields,
+        "timestamp": pd.Timestamp.now().isoformat()
+    }
+
+def _recorded_chunks(target):
+    """คืนฟังก์ชันหาจำนวน chunk ของไฟล์ (ชื่อ + sha256) จาก upload_logs ที่ ingest เข้า target เดียวกันสำเร็จแล้ว"""
+    def lookup(filename, file_hash):
+        found = logs_collection.find_one(
+            {**target, "file_fingerprints": {"$elemMatch": {"file": filename, "sha256": file_hash}}},
+            {"file_fingerprints.$": 1}
+        )
+        return found["file_fingerprints"][0].get("chunks") if found else None
+    return lookup
+
+def _ingest_request_error(db_type, db_name=None, collection_name=None, index_name=None):
+    """ตรวจ parameter ของ /upload, /upsert ก่อนรับงาน คืน JSONResponse ถ้าไม่ครบ"""
+    if db_type == "MongoDB":
+        if not db_name or not collection_name:
+            return JSONResponse(content={"error": "Missing db_name or collection_name for MongoDB"}, status_code=400)
+    elif db_type == "Pinecone":
+        if not index_name:
+            return JSONResponse(content={"error": "Missing index_name for Pinecone"}, status_code=400)
+    elif db_type == "Memory":
+        if not collection_name:
+            return JSONResponse(content={"error": "Missing collection_name for Memory store"}, status_code=400)
+    else:
+        return JSONResponse(content={"error": f"Unsupported db_type: {db_type}"}, status_code=400)
+    return None
+
+# งาน ingest ที่เขียนข้อมูลชุดเดียวกัน (collection / index+namespace) ทำทีละงานใน process นี้:
+# store ของข้อมูลชุดเดียวกันเป็น object เดียว chunk ที่รอ publish และชุด id ที่ /upload ลบจึงไม่ปนกันระหว่างงาน
+_ingest_target_locks = {}
+
+async def ingest_files(files, db_type, session_id, replace=False,
+                       db_name=None, collection_name=None, index_name=None, namespace=None, progress=None):
+    """ingest_files ที่รองานอื่นซึ่งเขียนข้อมูลชุดเดียวกันให้เสร็จก่อน"""
+    key = (db_type, db_name, collection_name) if db_type != "Pinecone" else (db_type, index_name, namespace)
+    lock = _ingest_target_locks.setdefault(key, asyncio.Lock())
+    async with lock:
+        return await _ingest_files(files, db_type, session_id, replace, db_name, collection_name, index_name, namespace, progress)
+
+async def _ingest_files(files, db_type, session_id, replace=False,
+                        db_name=None, collection_name=None, index_name=None, namespace=None, progress=None):
+    """
+    ingest ไฟล์ที่อัปโหลดแบบ streaming (อ่าน -> แบ่ง chunk -> embed -> เขียน ทีละ batch ผ่านคิวที่จำกัดขนาด)
+    หน่วยความจำไม่โตตามขนาดไฟล์ และ batch แรกค้นเจอได้ก่อนอ่านไฟล์ครบ
+    id ของ chunk มาจาก fingerprint ของแถว (ชื่อไฟล์ + เนื้อหา) chunk ที่มีอยู่แล้วจึงไม่ถูก embed/เขียนซ้ำ
+    replace=True (/upload) ทำให้ store มีแค่ไฟล์ชุดนี้: เขียน chunk ใหม่ก่อน แล้วค่อยลบ chunk ที่ไม่มีในไฟล์ชุดนี้แล้ว
+    ข้อมูลเดิมจึงค้นได้ตลอดระหว่างอัปโหลด (Pinecone และ collection ที่เปลี่ยน embedding model ยังล้างทั้งหมดตอนเขียน batch แรก)
+    progress (dict) ถูกอัปเดตตัวนับของแต่ละขั้นระหว่างทำงาน
+    คืน JSONResponse เมื่อข้อมูลไม่ครบ/ไม่มีข้อความ, ไม่เช่นนั้นคืนสรุปผล (จำนวน chunk, hit/miss ของ embedding cache)
+    """
+    error = _ingest_request_error(db_type, db_name, collection_name, index_name)
+    if error is not None:
+        return error
+    diff_store = None
+    if db_type == "MongoDB":
+        log = _session_log(session_id, "MongoDB", files, db_name=db_name, collection_name=collection_name)
+        target = {"db_type": "MongoDB", "db_name": db_name, "collection_name": collection_name}
+        store = get_vector_store(log, mongo_client)
+        # /upsert ใช้ model เดียวกับข้อมูลเดิมใน collection, /upload ใช้ EMBEDDING_MODEL
+        settings = get_embedding_settings(store.collection, EMBEDDING_MODEL)
+        model = EMBEDDING_MODEL if replace else settings["model"]
+        embedder = OpenAIEmbedder(model)
+        # vector เดิมที่มาจาก model อื่นใช้ต่อไม่ได้ ต้องล้างแล้ว embed ใหม่ทั้งหมด
+        if settings["model"] == model:
+            diff_store = store
+    elif db_type == "Pinecone":
+        log = _session_log(session_id, "Pinecone", files, index_name=index_name, namespace=namespace)
+        target = {"db_type": "Pinecone", "index_name": index_name, "namespace": namespace}
+        # store สร้างตอน batch แรก หลังสร้าง index ตามมิติของ embedding แล้ว
+        store = None
+        # model ต้องตรงกับที่ใช้ตอนถาม (retrival_Pinecone.embed)
+        embedder = OpenAIEmbedder(embed)
+    elif db_type == "Memory":
+        # ใช้ทดสอบ ingest -> query ทั้งเส้นทางได้โดยไม่ต้องมี MongoDB collection/Pinecone/OpenAI embeddings
+        log = _session_log(session_id, "Memory", files, collection_name=collection_name)
+        target = {"db_type": "Memory", "collection_name": collection_name}
+        store = get_vector_store(log, mongo_client)
+        embedder = store.embedder
+        diff_store = store
+
+    diff = IngestDiff(diff_store, _recorded_chunks(target))
+    # id ของ chunk ที่มีอยู่ก่อน /upload ครั้งนี้ (None = ต้องล้างทั้งหมดตอนเขียน batch แรก)
+    previous_ids = None
+    if replace and diff_store is not None:
+        previous_ids = await asyncio.to_thread(diff_store.all_ids)
+    cleared = not replace or previous_ids is not None
+    # ผลการเขียนรวมทุก batch (เฉพาะ MongoDB ที่ bulk_write แยกได้ว่า insert/modify/fail กี่ document)
+    writes = None
+
+    async def write_batch(chunks, embeddings):
+        nonlocal store, cleared, writes
+        if store is None:
+            await asyncio.to_thread(ensure_index, pc, index_name, len(embeddings[0]))
+            store = get_vector_store(log, mongo_client)
+        if not cleared:
+            await asyncio.to_thread(store.clear)
+            cleared = True
+        report = await store.upsert(
+            [chunk["_id"] for chunk in chunks],
+            [clean_text(chunk["text"]) for chunk in chunks],
+            embeddings=embeddings,
+            metadata=[chunk["metadata"] for chunk in chunks],
+            publish=False
+        )
+        if "modified" in report:
+            writes = writes or {"inserted": 0, "modified": 0, "failed": 0}
+            for key in writes:
+                writes[key] += report[key]
+
+    stats = await run_ingest_pipeline(files, embedder.embed_chunks, write_batch, diff=diff, progress=progress)
+    if not stats["chunks"] and not stats["unchanged"]:
+        return JSONResponse(content={"error": "No valid text data found"}, status_code=400)
+    if store is not None:
+        await asyncio.to_thread(store.publish)
+    deleted = 0
+    if previous_ids is not None:
+        # ลบหลังเขียนครบ: chunk ที่หายไปจากไฟล์ชุดนี้ (แถวที่ถูกแก้/ลบ, ไฟล์ที่ไม่ได้อัปโหลดมาแล้ว)
+        deleted = await store.delete(diff.stale_ids(previous_ids))
+    # fingerprint บันทึกเมื่อ ingest สำเร็จเท่านั้น อัปโหลดไฟล์เดิมครั้งหน้าจึงข้ามได้ทั้งไฟล์
+    log["file_fingerprints"] = diff.fingerprints()
+    logs_collection.insert_one(log)
+    return {
+        "chunks": stats["chunks"],
+        "unchanged": stats["unchanged"],
+        "deleted": deleted,
+        "skipped_files": diff.skipped_files,
+        "failed_files": diff.failed_files,
+        "parse": stats["parse"],
+        # รูปที่ไม่ซ้ำกันจาก DOCX/PDF ที่เก็บลง image_store (IMAGE_STORE=gridfs)
+        "images": stats["images"],
+        "writes": writes,
+        # chunk ที่ไม่เปลี่ยนจากการอัปโหลดครั้งก่อนไม่ต้องเรียก embeddings API (Memory store embed เองไม่ผ่าน cache)
+        "embedding_cache": getattr(embedder, "cache_stats", None),
+    }
+
+async def submit_ingest_job(kind, files, db_type, replace=False, **target):
+    """
+    รับไฟล์แล้วคืน job ทันที (202) การ ingest ทำต่อใน worker เบื้องหลัง
+    ดูสถานะที่ GET /jobs/{job_id} หรือ GET /jobs/{job_id}/events (SSE); session_id ใช้ query ได้เมื่อ job เสร็จ
+    """
+    if not files or len(files) == 0:
+        return JSONResponse(content={"error": "No files uploaded"}, status_code=400)
+    error = _ingest_request_error(db_type, target.get("db_name"), target.get("collection_name"), target.get("index_name"))
+    if error is not None:
+        return error
+
+    session_id = str(uuid.uuid4())
+
+    async def run(stored_files, progress):
+        start_time = time.perf_counter()
+        response = await ingest_files(stored_files, db_type, session_id, replace=replace, progress=progress, **target)
+        if isinstance(response, JSONResponse):
+            raise ValueError(json.loads(response.body)["error"])
+        processing_time = time.perf_counter() - start_time
+        print(f"{processing_time:.2f} seconds")
+        return {"session_id": session_id, **response, "seconds": round(processing_time, 2)}
+
+    job = await ingest_jobs.submit(kind, session_id, files, run, db_type=db_type, **target)
+    return JSONResponse(content=job, status_code=202)
+
 @app.post("/upsert")
 async def upsert_data(
     db_type: str = Form(...),
     db_name: str = Form(None),
     collection_name: str = Form(None),
+    index_name: str = Form(None),
+    namespace: str = Form(None),
     files: list[UploadFile] = File(...)
 ):
     try:
-        # ตรวจสอบว่าอัปโหลดไฟล์หรือไม่
-        if not files or len(files) == 0:
-            return JSONResponse(content={"error": "No files uploaded"}, status_code=400)
-
-        # เริ่มนับเวลา
-        start_time = time.perf_counter()
-
-        # แปลงไฟล์ที่อัปโหลด
-        result_file = await Up_File(files)
-
-        # --- สร้าง DataFrame จาก result_file โดยรองรับทุกกรณี ---
-        if "dataframe" in result_file and result_file["dataframe"]:
-            df = pd.DataFrame(result_file["dataframe"])
-        elif "pages" in result_file and result_file["pages"]:
-            df = pd.DataFrame({"page": result_file["pages"]})
-        elif "paragraphs" in result_file and result_file["paragraphs"]:
-            df = pd.DataFrame({"paragraph": result_file["paragraphs"]})
-        else:
-            return JSONResponse(content={"error": "No valid text data found"}, status_code=400)
-
-        if df.empty:
-            return JSONResponse(content={"error": "Uploaded file is empty"}, status_code=400)
-
-        session_id = str(uuid.uuid4())
-
-        if db_type == "MongoDB":
-            if not db_name or not collection_name:
-                return JSONResponse(content={"error": "Missing db_name or collection_name for MongoDB"}, status_code=400)
-
-            file_db = mongo_client[db_name]
-            collection = file_db[collection_name]
-
-            # เตรียม metadata อ้างอิง row
-            metadata_list = []
-            for i, row in df.iterrows():
-                metadata = row.to_dict()
-                metadata_list.append((f"vec-{i}", metadata))
-
-            # สร้าง embeddings และ text chunk
-            embeddings, chunk_text_list = await embed_result_all(df, EMBEDDING_MODEL)
-
-            assert len(embeddings) == len(chunk_text_list), "Embeddings and chunk_text_list length mismatch!"
-
-            documents = []
-            for idx, (embedding, raw_text) in enumerate(zip(embeddings, chunk_text_list)):
-                embedding_float = [float(x) for x in embedding]
-                clean_raw = clean_text(raw_text)
-                row_idx = idx if idx < len(metadata_list) else 0
-                vec_id, metadata = metadata_list[row_idx]
-                documents.append({
-                    "_id": f"{session_id}-{vec_id}_chunk{idx}",  # unique id ต่อ session
-                    "embedding": embedding_float,
-                    "metadata": metadata,
-                    "raw_text": clean_raw
-                })
-
-            # upsert: insert ถ้าใหม่, update ถ้าซ้ำ
-            for doc in documents:
-                collection.update_one({"_id": doc["_id"]}, {"$set": doc}, upsert=True)
-
-            # วัดเวลา
-            end_time = time.perf_counter()
-            processing_time = end_time - start_time
-            print(f"{processing_time:.2f} seconds")
-
-            # log
-            log = {
-                "session_id": session_id,
-                "db_type": "MongoDB",
-                "files": [f.filename for f in files],
-                "db_name": db_name,
-                "collection_name": collection_name,
-                "timestamp": pd.Timestamp.now().isoformat()
-            }
-            logs_collection.insert_one(log)
-
-        else:
-            return JSONResponse(content={"error": f"Unsupported db_type: {db_type}"}, status_code=400)
-
-        return {"session_id": session_id}
+        # chunk ใหม่ถูกเพิ่ม chunk ที่มีอยู่แล้วถูกข้าม (ไม่ลบของเดิม)
+        return await submit_ingest_job(
+            "upsert", files, db_type,
+            db_name=db_name, collection_name=collection_name, index_name=index_name, namespace=namespace
+        )
 
     except Exception as e:
         logging.error(f"Error in /upsert endpoint: {str(e)}")
@@ -809,140 +920,36 @@ async def upload_files(
     collection_name: str = Form(None)
 ):
     try:
-        # ตรวจสอบว่าอัปโหลดไฟล์หรือไม่
-        if not files or len(files) == 0:
-            return JSONResponse(content={"error": "No files uploaded"}, status_code=400)
-
-        # เริ่มนับเวลา
-        start_time = time.perf_counter()
-
-        # แปลงไฟล์ที่อัปโหลด
-        result_file = await Up_File(files)
-
-        # --- สร้าง DataFrame จาก result_file โดยรองรับทุกกรณี ---
-        if "dataframe" in result_file and result_file["dataframe"]:
-            df = pd.DataFrame(result_file["dataframe"])
-        elif "pages" in result_file and result_file["pages"]:
-            df = pd.DataFrame({"page": result_file["pages"]})
-        elif "paragraphs" in result_file and result_file["paragraphs"]:
-            df = pd.DataFrame({"paragraph": result_file["paragraphs"]})
-        elif "images_b64" in result_file and result_file["paragraphs"]:
-            df = pd.DataFrame({"images_b64": result_file["images_b64"]})
-        else:
-            return JSONResponse(content={"error": "No valid text data found"}, status_code=400)
-
-        if df.empty:
-            return JSONResponse(content={"error": "Uploaded file is empty"}, status_code=400)
-
-        session_id = str(uuid.uuid4())
-
-        # wait update in the future
-        # if db_type == "Pinecone":
-        #     # ✅ เช็กว่า index_name มีค่าหรือไม่
-        #     if not index_name:
-        #         return JSONResponse(content={"error": "Missing index_name for Pinecone"}, status_code=400)
-
-        #     if index_name in pc.list_indexes().names():
-        #         pc.delete_index(index_name)
-
-        #     spec = ServerlessSpec(cloud="aws", region=PINECONE_ENV)
-        #     pc.create_index(name=index_name, dimension=1536, metric="cosine", spec=spec)
-        #     index = pc.Index(index_name)
-
-        #     embeddings = await embed_all_rows(df)  # ✅ สมมติว่าฟังก์ชันนี้แก้แล้ว ไม่เช็กผิด
-        #     vectors = [{
-        #         "id": f"vec-{i}",
-        #         "values": embeddings[i],
-        #         "metadata": df.iloc[i].to_dict()
-        #     } for i in range(len(embeddings))]
-
-        #     index.upsert(vectors=vectors, namespace=namespace)
-
-        #     # Log ลง MongoDB
-        #     log = {
-        #         "session_id": session_id,
-        #         "db_type": "Pinecone",
-        #         "files": [f.filename for f in files],
-        #         "index_name": index_name,
-        #         "namespace": namespace,
-        #         "timestamp": pd.Timestamp.now().isoformat()
-        #     }
-        #     logs_collection.insert_one(log)
-
-        #     agent = create_pandas_dataframe_agent(
-        #         ChatOpenAI(temperature=0, model="gpt-4"),
-        #         df,
-        #         verbose=True,
-        #         allow_dangerous_code=True
-        #     )
-        #     agents[session_id] = agent
-
-        if db_type == "MongoDB":
-            if not db_name or not collection_name:
-                return JSONResponse(content={"error": "Missing db_name or collection_name for MongoDB"}, status_code=400)
-
-            file_db = mongo_client[db_name]
-            collection = file_db[collection_name]
-
-            # เตรียมข้อมูลหลัก (metadata อ้างอิง row เดิมไว้ก่อน)
-            metadata_list = []
-            for i, row in df.iterrows():
-                metadata = row.to_dict()
-                metadata_list.append((f"vec-{i}", metadata))
-
-            # สร้าง embeddings และได้ text chunk ทั้งหมด
-            embeddings, chunk_text_list = await embed_result_all(df, EMBEDDING_MODEL)
-
-            # (กรณีต้องการ clean database เดิมก่อน)
-            collection.delete_many({})  
-
-            # ตรวจสอบจำนวน chunk และ embedding ว่าตรงกันจริง
-            assert len(embeddings) == len(chunk_text_list), "Embeddings and chunk_text_list length mismatch!"
-
-            documents = []
-            for idx, (embedding, raw_text) in enumerate(zip(embeddings, chunk_text_list)):
-                embedding_float = [float(x) for x in embedding]
-                clean_raw = clean_text(raw_text)
-                # กำหนด id/metadata แบบ simple: เอาจาก chunk index และ metadata row ต้นทาง
-                row_idx = idx if idx < len(metadata_list) else 0  # เผื่อกรณี chunk มากกว่า row
-                vec_id, metadata = metadata_list[row_idx]
-                documents.append({
-                    "_id": f"{vec_id}_chunk{idx}",
-                    "embedding": embedding_float,
-                    "metadata": metadata,
-                    "raw_text": clean_raw
-                })
-
-            # เพิ่มข้อมูลลง MongoDB
-            if documents:
-                collection.insert_many(documents)
-
-            # วัดเวลาที่ใช้ในการประมวลผล
-            end_time = time.perf_counter()
-            processing_time = end_time - start_time
-            print(f"{processing_time:.2f} seconds")
-
-            # บันทึก log การประมวลผล
-            log = {
-                "session_id": session_id,
-                "db_type": "MongoDB",
-                "files": [f.filename for f in files],
-                "db_name": db_name,
-                "collection_name": collection_name,
-                "timestamp": pd.Timestamp.now().isoformat()
-            }
-            logs_collection.insert_one(log)
-
-        else:
-            return JSONResponse(content={"error": f"Unsupported db_type: {db_type}"}, status_code=400)
-
-        return {"session_id": session_id}
+        # ข้อมูลของ collection/namespace/store ถูกแทนที่ด้วยไฟล์ชุดนี้ (เขียน/ลบเฉพาะส่วนที่เปลี่ยน)
+        return await submit_ingest_job(
+            "upload", files, db_type, replace=True,
+            db_name=db_name, collection_name=collection_name, index_name=index_name, namespace=namespace
+        )
 
     except Exception as e:
         # การจับข้อผิดพลาด
         logging.error(f"Error in /upload endpoint: {str(e)}")
         return JSONResponse(content={"error": f"Internal server error: {str(e)}"}, status_code=500)
 
+@app.get("/jobs/{job_id}")
+async def get_job(job_id: str):
+    """สถานะ/ความคืบหน้าของ job ingest (progress: files, units, embedded, chunks, unchanged)"""
+    job = ingest_jobs.get(job_id)
+    if job is None:
+        return JSONResponse(content={"error": "Job not found"}, status_code=404)
+    return job
+
+@app.get("/jobs/{job_id}/events")
+async def job_events(job_id: str):
+    """สถานะของ job แบบ Server-Sent Events (ส่งเมื่อเปลี่ยน จบเมื่อ job เสร็จ/ล้มเหลว)"""
+    if ingest_jobs.get(job_id) is None:
+        return JSONResponse(content={"error": "Job not found"}, status_code=404)
+    return StreamingResponse(
+        ingest_jobs.events(job_id),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    )
+
 
 @app.post("/query")
 async def query(session_id: str, question: str,emotional:str):
@@ -951,27 +958,13 @@ async def query(session_id: str, question: str,emotional:str):
         if not log:
             return JSONResponse(content={"error": "No matching log found"}, status_code=404)
 
-        db_type = log.get("db_type")
-
-        if db_type == "Pinecone":
-            index_name = log["index_name"]
-            namespace = log["namespace"]
-
-            context = await retrieve_context_from_pinecone(question, index_name, namespace)
-                
-        elif db_type == "MongoDB":
-            db_name = log["db_name"]
-            collection_name = log["collection_name"]
-            file_db = mongo_client[db_name]
-            collection = file_db[collection_name]
-
-            context_bf = await retrieve_context_from_mongodb(collection, question)
-            num_tokens_context = count_tokens(context_bf, model="sentence-transformers/LaBSE")
-            context = reduce_context(context_bf, num_tokens_context)
-
-        else:
+        try:
+            store = get_vector_store(log, mongo_client)
+        except ValueError:
             return JSONResponse(content={"error": "Invalid db_type"}, status_code=400)
 
+        context = await store.retrieve_context(question)
+
         prompt = Prompt_Template(context,question,emotional) 
 
         llm = ChatOpenAI(
@@ -995,13 +988,49 @@ async def query(session_id: str, question: str,emotional:str):
         return JSONResponse(content={"error": f"Error processing query: {str(e)}"}, status_code=500)
 
 
+@app.post("/collections/migrate-embeddings")
+async def migrate_embeddings(
+    background_tasks: BackgroundTasks,
+    db_name: str = Form(...),
+    collection_name: str = Form(...),
+    target_model: str = Form(...)
+):
+    """เริ่ม re-embed collection ด้วย model ใหม่เป็นงานเบื้องหลัง (คำถามยังใช้ model เดิมจนกว่าจะเสร็จ)"""
+    try:
+        collection = mongo_client[db_name][collection_name]
+        if get_running_migration(collection):
+            return JSONResponse(content={"error": "Migration already running for this collection"}, status_code=409)
+        background_tasks.add_task(migrate_collection_embeddings, collection, target_model)
+        return {"status": "started", "collection": collection.full_name, "target_model": target_model}
+    except Exception as e:
+        logging.error(f"Error starting embedding migration: {e}")
+        return JSONResponse(content={"error": f"Internal server error: {str(e)}"}, status_code=500)
+
+
+@app.get("/retrieval/stats")
+async def retrieval_stats():
+    """สถานะของ cache ที่ใช้ในการค้นหา (หน่วยความจำที่ใช้, hit/miss)"""
+    return {
+        "matrix_cache": matrix_cache.stats(),
+        "query_embedding_cache": query_embedding_cache.stats(),
+        "embedding_scheduler": embedding_scheduler.stats(),
+        "chunk_embedding_cache": chunk_embedding_cache.stats(),
+        "ingest_jobs": ingest_jobs.stats(),
+        "image_store": image_store.stats(),
+        "retrieval_batcher": retrieval_batcher.stats(),
+        "context_dedup": dedup_stats.stats(),
+        "vector_stores": vector_store_stats(),
+    }
+
+
 @app.post("/start_session")
 async def start_session(
     db_type: str = Form(...),
     index_name: str = Form(None),
     namespace: str = Form(None),
     db_name: str = Form(None),
-    collection_name: str = Form(None)
+    collection_name: str = Form(None),
+    engine: str = Form(None)
 ):
     try:
         # สร้าง session_id ใหม่
@@ -1032,12 +1061,27 @@ async def start_session(
             # สร้าง agent สำหรับ MongoDB หรือเตรียม retrieval
             # agents[session_id] = create_mongodb_agent(db_name, collection_name)
 
-            logs_collection.insert_one({
+            session_log = {
                 "session_id": session_id,
                 "db_type": "MongoDB",
                 "db_name": db_name,
                 "collection_name": collection_name,
                 "timestamp": pd.Timestamp.now().isoformat()
+            }
+            # engine ของ session นี้ ("faiss" | "brute") ถ้าไม่ระบุใช้ RETRIEVAL_ENGINE
+            if engine:
+                session_log["engine"] = engine
+            logs_collection.insert_one(session_log)
+
+        elif db_type == "Memory":
+            if not collection_name:
+                return JSONResponse(content={"error": "Missing collection_name for Memory store"}, status_code=400)
+
+            logs_collection.insert_one({
+                "session_id": session_id,
+                "db_type": "Memory",
+                "collection_name": collection_name,
+                "timestamp": pd.Timestamp.now().isoformat()
             })
 
         else:
@@ -1093,30 +1137,24 @@ async def process_chatbot_query(sender_id: str, user_message: str, emotional:str
             
             # ✅ SILENT: No logging for using existing session
 
-        db_type = log.get("db_type")
+        try:
+            store = get_vector_store(log, mongo_client)
+        except ValueError:
+            return "ขออภัย เกิดข้อผิดพลาดในการประมวลผล กรุณาลองใหม่อีกครั้ง"
 
-        if db_type == "Pinecone":
-            index_name = log["index_name"]
-            namespace = log["namespace"]
-            context = await retrieve_context_from_pinecone(user_message, index_name, namespace)
-                
-        elif db_type == "MongoDB":
-            db_name = log["db_name"]
-            collection_name = log["collection_name"]
-            file_db = mongo_client[db_name]
-            collection = file_db[collection_name]
-            
+        if isinstance(store, PineconeVectorStore):
+            context = await store.retrieve_context(user_message)
+        else:
             from stopword import extract_keywords_from_query
             keywords = extract_keywords_from_query(user_message)
             keyword_query = " ".join(keywords) if keywords else user_message
             print(f"keyword: {keyword_query}")
             # ✅ SILENT: No logging for keywords
-            context_bf = await retrieve_context_from_mongodb(collection, keyword_query)
+            # store ของ MongoDB รวมข้อความจากหลายผู้ส่งที่เข้ามาพร้อมกันเป็น batch เดียว (embed/scan ครั้งเดียว)
+            context_bf = await store.retrieve_context(keyword_query)
             num_tokens_context = count_tokens(context_bf, model="gpt-4o-mini")
             context = reduce_context(context_bf, num_tokens_context,keywords)
             # ✅ SILENT: No logging for context
-        else:
-            return "ขออภัย เกิดข้อผิดพลาดในการประมวลผล กรุณาลองใหม่อีกครั้ง"
 
         """  UPDATE MEMORY"""
         # print(f"context : {context}")
@@ -0,0 +1,241 @@
+import os
+import sys
+import time
+import logging
+import threading
+from collections import OrderedDict
+import numpy as np
+from collection_meta import get_collection_version, get_embedding_field
+from vector_codec import decode_embedding
+
+MATRIX_CACHE_MAX_MB = float(os.getenv("MATRIX_CACHE_MAX_MB", "512"))
+SCAN_BATCH_SIZE = int(os.getenv("SCAN_BATCH_SIZE", "2000"))
+# ความละเอียดของ matrix ที่เก็บใน cache: float32 | float16 | int8
+MATRIX_CACHE_PRECISION = os.getenv("MATRIX_CACHE_PRECISION", "float32")
+# float16/int8 ใช้คัด candidate รอบแรก แล้ว rescore ด้วย vector เต็มจำนวน top_k * ค่านี้
+RESCORE_CANDIDATES_FACTOR = int(os.getenv("RESCORE_CANDIDATES_FACTOR", "10"))
+SCORE_CHUNK_ROWS = 8192
+
+def normalize_rows(vectors):
+    matrix = np.ascontiguousarray(np.asarray(vectors, dtype=np.float32))
+    if matrix.ndim == 1:
+        matrix = matrix.reshape(1, -1)
+    norms = np.linalg.norm(matrix, axis=1, keepdims=True)
+    norms[norms == 0] = 1.0
+    return matrix / norms
+
+def top_k_indices(scores, top_k):
+    """หา index ของคะแนนสูงสุด k ตัว ด้วย argpartition แล้วเรียงเฉพาะ k ตัวนั้น"""
+    if top_k <= 0 or scores.size == 0:
+        return np.empty(0, dtype=np.int64)
+    if top_k < scores.size:
+        candidates = np.argpartition(-scores, top_k - 1)[:top_k]
+    else:
+        candidates = np.arange(scores.size)
+    return candidates[np.argsort(-scores[candidates], kind="stable")]
+
+def quantize_matrix(matrix, precision):
+    """
+    แปลง matrix float32 (normalize แล้ว) เป็นความละเอียดที่ต้องการ
+    int8 ใช้ scale ต่อ vector: v ~= q * scale
+    """
+    if precision == "float16":
+        return matrix.astype(np.float16), None
+    if precision == "int8":
+        max_abs = np.abs(matrix).max(axis=1)
+        max_abs[max_abs == 0] = 1.0
+        quantized = np.round(matrix / max_abs[:, None] * 127).astype(np.int8)
+        return quantized, (max_abs / 127).astype(np.float32)
+    return matrix, None
+
+def score_matrix(matrix, query, scales=None):
+    """
+    คำนวณ matrix @ query; float16/int8 แปลงทีละก้อนเพื่อไม่ให้เกิดสำเนา float32 ทั้ง matrix
+    query เป็น 1 มิติ (คำถามเดียว -> คะแนน shape [n]) หรือ [q, dim] (หลายคำถาม -> คะแนน shape [n, q])
+    """
+    queries = query.T if query.ndim == 2 else query
+    if matrix.dtype == np.float32:
+        scores = matrix @ queries
+    else:
+        scores = np.empty((matrix.shape[0],) + queries.shape[1:], dtype=np.float32)
+        for start in range(0, matrix.shape[0], SCORE_CHUNK_ROWS):
+            block = matrix[start:start + SCORE_CHUNK_ROWS].astype(np.float32)
+            scores[start:start + SCORE_CHUNK_ROWS] = block @ queries
+    if scales is not None:
+        scores *= scales if scores.ndim == 1 else scales[:, None]
+    return scores
+
+def search_entry_many(entry, query_vectors, top_k=4):
+    """หลายคำถามในการคูณ matrix-matrix ครั้งเดียว คืนค่า list ของ [(score, _id), ...] ตามลำดับคำถาม"""
+    queries = normalize_rows(query_vectors)
+    if entry["count"] == 0:
+        return [[] for _ in range(queries.shape[0])]
+    scores = score_matrix(entry["matrix"], queries, entry["scales"])
+    return [
+        [(float(scores[i, col]), entry["ids"][i]) for i in top_k_indices(scores[:, col], top_k)]
+        for col in range(queries.shape[0])
+    ]
+
+def rescore_many_with_full_vectors(collection, query_vectors, candidate_lists, top_k=4):
+    """
+    ดึง vector เต็มความละเอียดของ candidate จาก MongoDB มาคำนวณ cosine ใหม่
+    หลายคำถามดึง candidate ทั้งหมดด้วย $in ครั้งเดียว
+    """
+    wanted = {doc_id for candidates in candidate_lists for doc_id in candidates}
+    if not wanted:
+        return [[] for _ in candidate_lists]
+    field = get_embedding_field(collection)
+    vectors_by_id = {}
+    for doc in collection.find({"_id": {"$in": list(wanted)}}, {field: 1}):
+        vector = decode_embedding(doc.get(field))
+        if vector is None or vector.size == 0:
+            continue
+        vectors_by_id[doc["_id"]] = vector
+    queries = normalize_rows(query_vectors)
+    results = []
+    for query, candidates in zip(queries, candidate_lists):
+        ids = [doc_id for doc_id in candidates if doc_id in vectors_by_id]
+        if not ids:
+            results.append([])
+            continue
+        try:
+            scores = normalize_rows(np.stack([vectors_by_id[doc_id] for doc_id in ids])) @ query
+        except ValueError as e:
+            logging.error(f"Rescoring skipped, vector shapes differ: {e}")
+            results.append([])
+            continue
+        results.append([(float(scores[i]), ids[i]) for i in top_k_indices(scores, top_k)])
+    return results
+
+class EmbeddingMatrixCache:
+    """
+    Cache embedding ของแต่ละ collection เป็น matrix float32 ก้อนเดียว (normalize แล้ว) + array ของ _id
+    - โหลดใหม่เมื่อ version stamp ของ collection เปลี่ยน
+    - เกินงบหน่วยความจำจะไล่ collection ที่ใช้ล่าสุดนานที่สุดออกก่อน (LRU)
+    """
+
+    def __init__(self, max_bytes: int, precision: str = "float32"):
+        self.max_bytes = max_bytes
+        self.precision = precision
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def _load(self, collection, version, field=None):
+        ids, embeddings = [], []
+        dim = None
+        field = field or get_embedding_field(collection)
+        # อ่านเฉพาะ _id + embedding ไม่ดึง metadata/raw_text มาด้วย
+        for doc in collection.find({}, {field: 1}, batch_size=SCAN_BATCH_SIZE):
+            emb = decode_embedding(doc.get(field))
+            if emb is None or emb.size == 0:
+                continue
+            if dim is None:
+                dim = emb.size
+            if emb.size != dim:
+                continue
+            ids.append(doc["_id"])
+            embeddings.append(emb)
+        matrix = normalize_rows(np.stack(embeddings)) if embeddings else np.empty((0, 0), dtype=np.float32)
+        matrix, scales = quantize_matrix(matrix, self.precision)
+        id_array = np.array(ids, dtype=object)
+        return {
+            "version": version,
+            "precision": self.precision,
+            "matrix": matrix,
+            "scales": scales,
+            "ids": id_array,
+            "count": matrix.shape[0],
+            "dim": matrix.shape[1] if matrix.shape[0] else None,
+            # matrix + scale + pointer array + ตัว string ของ _id
+            "nbytes": matrix.nbytes + (scales.nbytes if scales is not None else 0)
+                      + id_array.nbytes + sum(sys.getsizeof(i) for i in ids),
+            "loaded_at": time.time(),
+        }
+
+    def _evict(self):
+        total = sum(entry["nbytes"] for entry in self._entries.values())
+        while self._entries and total > self.max_bytes:
+            key, entry = self._entries.popitem(last=False)
+            total -= entry["nbytes"]
+            self.evictions += 1
+            logging.info(f"Evicted embedding matrix of {key} ({entry['nbytes'] / 1024 / 1024:.1f} MB)")
+
+    def get(self, collection, field=None):
+        """field: ระบุเมื่อต้องการ matrix ของ field อื่น เช่น embedding_short"""
+        key = f"{collection.full_name}:{field}" if field else collection.full_name
+        version = get_collection_version(collection)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry["version"] == version:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return entry
+        self.misses += 1
+        entry = self._load(collection, version, field)
+        if entry["nbytes"] > self.max_bytes:
+            # ใหญ่เกินงบทั้งก้อน: ใช้ครั้งเดียวไม่เก็บไว้
+            logging.warning(f"Embedding matrix of {key} exceeds the cache budget, not cached")
+            return entry
+        with self._lock:
+            self._entries[key] = entry
+            self._entries.move_to_end(key)
+            self._evict()
+        return entry
+
+    def remove(self, collection, ids, previous_version, version):
+        """
+        ตัด vector ที่ถูกลบออกจาก matrix ที่ cache ไว้แล้วใช้ version ใหม่ (ไม่ต้องโหลดทั้ง collection ใหม่)
+        เฉพาะ matrix ที่ยังตรงกับ previous_version (ถ้ามีการเขียนจากที่อื่นก่อนหน้า ปล่อยให้โหลดใหม่ตามปกติ)
+        """
+        wanted = set(ids)
+        with self._lock:
+            for key, entry in list(self._entries.items()):
+                if key != collection.full_name and not key.startswith(f"{collection.full_name}:"):
+                    continue
+                if entry["version"] != previous_version:
+                    continue
+                keep = np.fromiter((doc_id not in wanted for doc_id in entry["ids"]), dtype=bool, count=len(entry["ids"]))
+                kept = int(keep.sum())
+                # สร้าง entry ใหม่ ไม่แก้ของเดิมที่การค้นอื่นอาจใช้อยู่
+                self._entries[key] = dict(
+                    entry,
+                    version=version,
+                    matrix=entry["matrix"][keep],
+                    scales=entry["scales"][keep] if entry["scales"] is not None else None,
+                    ids=entry["ids"][keep],
+                    count=kept,
+                    nbytes=int(entry["nbytes"] * kept / entry["count"]) if entry["count"] else 0,
+                )
+
+    def invalidate(self, collection):
+        with self._lock:
+            for key in list(self._entries):
+                if key == collection.full_name or key.startswith(f"{collection.full_name}:"):
+                    self._entries.pop(key, None)
+
+    def stats(self):
+        with self._lock:
+            collections = {
+                key: {
+                    "vectors": int(entry["count"]),
+                    "dimension": int(entry["dim"] or 0),
+                    "precision": entry["precision"],
+                    "bytes": int(entry["nbytes"]),
+                    "version": entry["version"],
+                }
+                for key, entry in self._entries.items()
+            }
+        return {
+            "used_bytes": sum(c["bytes"] for c in collections.values()),
+            "max_bytes": int(self.max_bytes),
+            "precision": self.precision,
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "collections": collections,
+        }
+
+matrix_cache = EmbeddingMatrixCache(max_bytes=int(MATRIX_CACHE_MAX_MB * 1024 * 1024), precision=MATRIX_CACHE_PRECISION)
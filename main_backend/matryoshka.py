@@ -0,0 +1,66 @@
+import os
+import argparse
+import logging
+from pathlib import Path
+import numpy as np
+from dotenv import load_dotenv
+from pymongo import MongoClient, UpdateOne
+from vector_codec import encode_embedding, decode_embedding
+from collection_meta import get_embedding_settings, bump_collection_version
+
+current_directory = os.getcwd()
+env_path = Path(current_directory).parent / 'venv' / '.env'
+load_dotenv(dotenv_path=env_path, override=True)
+
+# เก็บ vector สั้น (prefix ของ vector เต็ม) ไว้คัด candidate รอบแรก; 0 = ไม่ใช้
+SHORT_EMBEDDING_DIM = int(os.getenv("SHORT_EMBEDDING_DIM", "0"))
+SHORT_EMBEDDING_FIELD = "embedding_short"
+# จำนวน candidate จากรอบแรกที่นำไปจัดอันดับใหม่ด้วย vector เต็ม
+SHORTLIST_SIZE = int(os.getenv("SHORTLIST_SIZE", "100"))
+# model ที่ train แบบ Matryoshka (ตัด prefix แล้ว normalize ใหม่ได้ผลเท่ากับขอ dimensions จาก API)
+MATRYOSHKA_MODELS = {"text-embedding-3-small", "text-embedding-3-large"}
+
+def supports_short_embeddings(model, dim):
+    return bool(dim) and model in MATRYOSHKA_MODELS
+
+def short_vector(embedding, dim):
+    prefix = np.asarray(embedding, dtype=np.float32)[:dim]
+    norm = np.linalg.norm(prefix)
+    return prefix / norm if norm else prefix
+
+def build_short_embeddings(collection, dim, batch_size=1000):
+    """
+    สร้าง embedding_short จาก vector เต็มที่เก็บอยู่แล้ว (ไม่ต้องเรียก embeddings API)
+    ระหว่างสร้างปิดรอบแรกแบบสั้นไว้ก่อน แล้วเปิดเมื่อครบทุกเอกสาร
+    """
+    settings = get_embedding_settings(collection)
+    if not supports_short_embeddings(settings["model"], dim):
+        logging.warning(f"{settings['model']} does not support truncated embeddings, skipping")
+        return 0
+    bump_collection_version(collection, short_dimension=None)
+    field = settings["field"]
+    built = 0
+    operations = []
+    for doc in collection.find({field: {"$exists": True}}, {field: 1}, batch_size=batch_size):
+        vector = short_vector(decode_embedding(doc[field]), dim)
+        operations.append(UpdateOne({"_id": doc["_id"]}, {"$set": {SHORT_EMBEDDING_FIELD: encode_embedding(vector)}}))
+        if len(operations) >= batch_size:
+            collection.bulk_write(operations, ordered=False)
+            built += len(operations)
+            operations = []
+    if operations:
+        collection.bulk_write(operations, ordered=False)
+        built += len(operations)
+    bump_collection_version(collection, short_dimension=dim)
+    print(f"✅ Built {built} {dim}-d short embeddings for {collection.full_name}")
+    return built
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Build short (Matryoshka) prefix embeddings from stored full vectors")
+    parser.add_argument("--db", required=True)
+    parser.add_argument("--collection", required=True)
+    parser.add_argument("--dim", type=int, default=SHORT_EMBEDDING_DIM or 256)
+    args = parser.parse_args()
+
+    mongo_client = MongoClient(os.getenv("MONGO_URL"))
+    build_short_embeddings(mongo_client[args.db][args.collection], args.dim)
@@ -0,0 +1,145 @@
+import os
+import uuid
+import socket
+import asyncio
+import argparse
+import logging
+from datetime import datetime
+from pathlib import Path
+from dotenv import load_dotenv
+from pymongo import MongoClient, UpdateOne
+from embed_MongoDB import batch_process_embedding_async
+from vector_codec import encode_embedding
+from matryoshka import build_short_embeddings, SHORT_EMBEDDING_FIELD
+from collection_meta import (
+    get_collection_meta, get_embedding_settings, set_embedding_migration, bump_collection_version,
+    get_running_migration, touch_embedding_migration, MIGRATION_STALE_SECONDS
+)
+
+current_directory = os.getcwd()
+env_path = Path(current_directory).parent / 'venv' / '.env'
+load_dotenv(dotenv_path=env_path, override=True)
+
+MIGRATION_BATCH_SIZE = int(os.getenv("MIGRATION_BATCH_SIZE", "256"))
+# เขียน heartbeat ถี่กว่าเกณฑ์ stale หลายเท่า batch ที่ embed นานจึงไม่ถูกนับว่าหยุด
+MIGRATION_HEARTBEAT_SECONDS = MIGRATION_STALE_SECONDS / 4
+
+def migration_target_field(source_field):
+    # สลับใช้ 2 field เพื่อให้ field เดิมยังอ่านได้ตลอดช่วงที่ re-embed
+    return "embedding_next" if source_field == "embedding" else "embedding"
+
+def _pending_batch(collection, target_field, batch_size):
+    """เอกสารชุดถัดไปที่ยังไม่มี vector ใหม่"""
+    return list(collection.find({target_field: {"$exists": False}}, {"raw_text": 1}).limit(batch_size))
+
+def _write_batch(collection, operations, migration):
+    collection.bulk_write(operations, ordered=False)
+    set_embedding_migration(collection, migration)
+
+def _cutover(collection, settings, target_model, target_field, dimension, migration):
+    """สลับ field และ model พร้อมกันในเอกสาร meta เดียว แล้วเปลี่ยน version ให้ cache/index โหลดใหม่ และลบ field เก่า"""
+    # vector สั้นชุดเดิมมาจาก model เก่า ต้องปิดไว้จนกว่าจะสร้างใหม่จาก vector ชุดใหม่
+    bump_collection_version(
+        collection,
+        embedding_model=target_model,
+        dimension=dimension or settings["dimension"],
+        embedding_field=target_field,
+        short_dimension=None,
+        migration=migration
+    )
+    collection.update_many({settings["field"]: {"$exists": True}}, {"$unset": {settings["field"]: ""}})
+    if settings.get("short_dimension"):
+        if not build_short_embeddings(collection, settings["short_dimension"]):
+            collection.update_many({SHORT_EMBEDDING_FIELD: {"$exists": True}}, {"$unset": {SHORT_EMBEDDING_FIELD: ""}})
+
+async def migrate_collection_embeddings(collection, target_model, batch_size=MIGRATION_BATCH_SIZE):
+    """
+    Re-embed ทุกเอกสารใน collection ด้วย target_model
+
+    ระหว่าง migrate คำถามยังอ่าน field/model เดิม (dual-read) ส่วน vector ใหม่เขียนลงอีก field
+    เมื่อครบทุกเอกสารจึงสลับ embedding_field/embedding_model ใน collection_meta ครั้งเดียว
+    แล้วค่อยลบ field เก่าออก
+
+    migration บันทึก owner และ heartbeat_at ระหว่างรัน ถ้าถูกขัดจังหวะ (heartbeat ขาด) เรียกใหม่ด้วย model เดิม
+    จะทำต่อเฉพาะเอกสารที่ยังไม่มี vector ใหม่, model อื่นจะล้าง vector ที่ค้างแล้วเริ่มใหม่
+
+    งาน MongoDB (pymongo แบบ sync) ทำใน thread ไม่ให้ event loop ของ API ค้างระหว่าง migrate
+    """
+    settings = await asyncio.to_thread(get_embedding_settings, collection)
+    source_field = settings["field"]
+    target_field = migration_target_field(source_field)
+    if settings["model"] == target_model:
+        print(f"{collection.full_name} already uses {target_model}")
+        return {"migrated": 0, "model": target_model}
+
+    previous = (await asyncio.to_thread(get_collection_meta, collection)).get("migration") or {}
+    if previous.get("target_model") != target_model:
+        # vector ค้างจาก migration ครั้งก่อนที่เป็นคนละ model ใช้ต่อไม่ได้
+        await asyncio.to_thread(collection.update_many, {target_field: {"$exists": True}}, {"$unset": {target_field: ""}})
+
+    owner = f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}"
+    migration = {
+        "status": "running",
+        "owner": owner,
+        "source_model": settings["model"],
+        "target_model": target_model,
+        "source_field": source_field,
+        "target_field": target_field,
+        "migrated": 0,
+        "started_at": datetime.now(),
+        "heartbeat_at": datetime.now(),
+    }
+    await asyncio.to_thread(set_embedding_migration, collection, migration)
+
+    async def heartbeat():
+        while True:
+            await asyncio.sleep(MIGRATION_HEARTBEAT_SECONDS)
+            await asyncio.to_thread(touch_embedding_migration, collection, owner)
+
+    migrated = 0
+    dimension = None
+    ticker = asyncio.create_task(heartbeat())
+    try:
+        while True:
+            # วนจนไม่เหลือเอกสารที่ยังไม่มี vector ใหม่ (รวมเอกสารที่ถูกเพิ่มระหว่าง migrate)
+            batch = await asyncio.to_thread(_pending_batch, collection, target_field, batch_size)
+            if not batch:
+                break
+            texts = [doc.get("raw_text") or " " for doc in batch]
+            embeddings = await batch_process_embedding_async(texts, target_model)
+            operations = [
+                UpdateOne({"_id": doc["_id"]}, {"$set": {target_field: encode_embedding(emb)}})
+                for doc, emb in zip(batch, embeddings)
+            ]
+            dimension = dimension or len(embeddings[0])
+            migrated += len(operations)
+            migration["migrated"] = migrated
+            migration["heartbeat_at"] = datetime.now()
+            await asyncio.to_thread(_write_batch, collection, operations, migration)
+            print(f"Migrated {migrated} documents of {collection.full_name} to {target_model}")
+    except Exception as e:
+        migration["status"] = "failed"
+        migration["error"] = str(e)
+        await asyncio.to_thread(set_embedding_migration, collection, migration)
+        logging.error(f"Embedding migration of {collection.full_name} failed: {e}")
+        raise
+    finally:
+        ticker.cancel()
+
+    migration["status"] = "done"
+    migration["finished_at"] = datetime.now()
+    await asyncio.to_thread(_cutover, collection, settings, target_model, target_field, dimension, migration)
+    return {"migrated": migrated, "model": target_model, "field": target_field}
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Re-embed a MongoDB collection with a new embedding model")
+    parser.add_argument("--db", required=True)
+    parser.add_argument("--collection", required=True)
+    parser.add_argument("--model", required=True)
+    parser.add_argument("--batch-size", type=int, default=MIGRATION_BATCH_SIZE)
+    args = parser.parse_args()
+
+    mongo_client = MongoClient(os.getenv("MONGO_URL"))
+    target_collection = mongo_client[args.db][args.collection]
+    result = asyncio.run(migrate_collection_embeddings(target_collection, args.model, args.batch_size))
+    print(result)
@@ -0,0 +1,73 @@
+import os
+import time
+import asyncio
+import logging
+from concurrent.futures import ThreadPoolExecutor
+import bson
+from pymongo import UpdateOne
+from pymongo.errors import BulkWriteError
+
+# --- ตั้งค่าการเขียน chunk ลง MongoDB ---
+# ขนาด BSON รวมต่อ bulk_write (MongoDB รับ message ละไม่เกิน 48MB, document ละไม่เกิน 16MB)
+MONGO_BULK_BYTES = int(os.getenv("MONGO_BULK_BYTES", str(8 * 1024 * 1024)))
+MONGO_BULK_MAX_OPS = int(os.getenv("MONGO_BULK_MAX_OPS", "1000"))
+MONGO_WRITE_CONCURRENCY = int(os.getenv("MONGO_WRITE_CONCURRENCY", "4"))
+
+# pymongo เป็น synchronous จึงรัน bulk_write ใน thread pool ร่วมกันทั้ง process
+_executor = ThreadPoolExecutor(max_workers=MONGO_WRITE_CONCURRENCY, thread_name_prefix="mongo-bulk")
+
+def batch_by_bson_bytes(documents, max_bytes=MONGO_BULK_BYTES, max_ops=MONGO_BULK_MAX_OPS):
+    """แบ่ง document เป็น batch ตามขนาด BSON จริง (chunk ยาว/embedding ใหญ่ได้ batch เล็กลงเอง)"""
+    batch, batch_bytes = [], 0
+    for document in documents:
+        size = len(bson.encode(document))
+        if batch and (batch_bytes + size > max_bytes or len(batch) >= max_ops):
+            yield batch
+            batch, batch_bytes = [], 0
+        batch.append(document)
+        batch_bytes += size
+    if batch:
+        yield batch
+
+def _write_batch(collection, batch):
+    # unordered: document ที่ error ไม่ทำให้ตัวอื่นใน batch หยุดเขียน
+    operations = [
+        UpdateOne({"_id": document["_id"]}, {"$set": {k: v for k, v in document.items() if k != "_id"}}, upsert=True)
+        for document in batch
+    ]
+    try:
+        result = collection.bulk_write(operations, ordered=False)
+        return result.upserted_count, result.modified_count, []
+    except BulkWriteError as e:
+        details = e.details
+        failed = [batch[error["index"]]["_id"] for error in details.get("writeErrors", [])]
+        return details.get("nUpserted", 0), details.get("nModified", 0), failed
+
+async def bulk_upsert_documents(collection, documents, concurrency=MONGO_WRITE_CONCURRENCY, max_bytes=MONGO_BULK_BYTES):
+    """
+    upsert document ด้วย bulk_write แบบ unordered หลาย batch พร้อมกัน (จำกัดด้วย semaphore + thread pool)
+    คืน report: inserted (document ใหม่), modified (document เดิมที่เนื้อหาเปลี่ยน), failed และ failed_ids
+    """
+    loop = asyncio.get_running_loop()
+    semaphore = asyncio.Semaphore(concurrency)
+    batches = list(batch_by_bson_bytes(documents, max_bytes))
+    report = {"documents": len(documents), "batches": len(batches), "inserted": 0, "modified": 0, "failed": 0, "failed_ids": []}
+    started = time.perf_counter()
+
+    async def send(batch):
+        async with semaphore:
+            try:
+                inserted, modified, failed = await loop.run_in_executor(_executor, _write_batch, collection, batch)
+            except Exception as e:
+                logging.error(f"MongoDB bulk write of {len(batch)} documents to {collection.full_name} failed: {e}")
+                inserted, modified, failed = 0, 0, [document["_id"] for document in batch]
+        report["inserted"] += inserted
+        report["modified"] += modified
+        report["failed"] += len(failed)
+        report["failed_ids"].extend(failed)
+
+    await asyncio.gather(*(send(batch) for batch in batches))
+    report["seconds"] = round(time.perf_counter() - started, 3)
+    if report["failed"]:
+        logging.error(f"MongoDB upsert: {report['failed']} of {report['documents']} documents failed in {collection.full_name}")
+    return report
@@ -0,0 +1,91 @@
+import io
+import os
+import logging
+import pymupdf
+import pdfplumber
+
+# --- ตั้งค่าการอ่าน PDF ---
+# pymupdf: อ่านข้อความด้วย PyMuPDF (เร็วกว่าและตัดสระ/วรรณยุกต์ภาษาไทยถูกกว่า), pdfplumber: ข้อความแบบเดิม
+PDF_TEXT_ENGINE = os.getenv("PDF_TEXT_ENGINE", "pymupdf").lower()
+# หน้าที่มีเส้นแนวนอนและแนวตั้งอย่างละไม่ต่ำกว่านี้ถึงจะหาตาราง (find_tables ช้ากว่าอ่านข้อความหลายเท่า)
+# ค่า 3 = ตารางเล็กสุด 2x2 ช่อง, กรอบหน้ากระดาษ (2 เส้น/ทิศ) ไม่นับเป็นตาราง
+PDF_TABLE_MIN_LINES = int(os.getenv("PDF_TABLE_MIN_LINES", "3"))
+
+def open_pdf(source):
+    """เปิด PDF จาก path หรือจากเนื้อไฟล์ในหน่วยความจำ (bytes/memoryview) โดยไม่ต้องเขียนลงดิสก์"""
+    if isinstance(source, (bytes, bytearray, memoryview)):
+        return pymupdf.open(stream=source, filetype="pdf")
+    return pymupdf.open(source)
+
+def count_ruling_lines(page):
+    """นับเส้นตรงแนวนอน/แนวตั้งที่วาดบนหน้า (เส้นตารางแบบ lattice) คืน (แนวนอน, แนวตั้ง)"""
+    horizontal = vertical = 0
+    for drawing in page.get_drawings():
+        for item in drawing["items"]:
+            if item[0] == "l":
+                start, end = item[1], item[2]
+                if abs(start.y - end.y) < 1:
+                    horizontal += 1
+                elif abs(start.x - end.x) < 1:
+                    vertical += 1
+            elif item[0] == "re":
+                rect = item[1]
+                if rect.height < 2:
+                    horizontal += 1
+                elif rect.width < 2:
+                    vertical += 1
+                else:
+                    # สี่เหลี่ยมเต็มช่อง (เซลล์ที่วาดเป็นกรอบ) มีเส้นครบทั้งสองทิศ
+                    horizontal += 2
+                    vertical += 2
+    return horizontal, vertical
+
+def looks_tabular(page, min_lines=PDF_TABLE_MIN_LINES):
+    horizontal, vertical = count_ruling_lines(page)
+    return horizontal >= min_lines and vertical >= min_lines
+
+def iter_pdf_pages(source, page_range=None, tables=True, image_data=False):
+    """
+    เปิด PDF (path หรือ bytes/memoryview) ครั้งเดียวแล้วเดินทีละหน้า yield dict ต่อหน้า:
+    {"page": เลขหน้า (นับจาก 1), "text": ข้อความ, "tables": [ตารางเป็น list ของแถว], "images": [{"xref": ...}]}
+    tables=False ข้ามการหาตาราง (ingest ใช้แค่ข้อความ), image_data=True ใส่ "data" (bytes) และ "ext" ของรูปด้วย
+    เฉพาะครั้งแรกที่พบ xref นั้น (โลโก้ที่ใช้ซ้ำทุกหน้าเป็น xref เดียวกัน ถูกดึงครั้งเดียวต่อไฟล์)
+    page_range (start, end) อ่านเฉพาะหน้า [start, end) นับจาก 0
+    """
+    with open_pdf(source) as doc:
+        start, end = page_range or (0, doc.page_count)
+        extracted = set()
+        plumber = pdfplumber.open(source if isinstance(source, str) else io.BytesIO(source)) if PDF_TEXT_ENGINE == "pdfplumber" else None
+        try:
+            for page_index in range(start, min(end, doc.page_count)):
+                record = {"page": page_index + 1, "text": "", "tables": [], "images": []}
+                try:
+                    page = doc.load_page(page_index)
+                    if plumber is not None:
+                        plumber_page = plumber.pages[page_index]
+                        record["text"] = (plumber_page.extract_text() or "").strip()
+                        # ปล่อย object ของหน้าที่อ่านแล้ว ไม่ให้หน่วยความจำโตตามจำนวนหน้า
+                        plumber_page.close()
+                    else:
+                        record["text"] = page.get_text("text").strip()
+
+                    if tables and looks_tabular(page):
+                        record["tables"] = [table.extract() for table in page.find_tables().tables]
+
+                    for image in page.get_images(full=True):
+                        ref = {"xref": image[0]}
+                        if image_data and image[0] not in extracted:
+                            extracted.add(image[0])
+                            base_image = doc.extract_image(image[0])
+                            ref["data"], ref["ext"] = base_image["image"], base_image["ext"]
+                        record["images"].append(ref)
+                except Exception as e:
+                    logging.error(f"❌ Error processing page {page_index + 1}: {e}")
+                yield record
+        finally:
+            if plumber is not None:
+                plumber.close()
+
+def pdf_page_count(source):
+    with open_pdf(source) as doc:
+        return doc.page_count
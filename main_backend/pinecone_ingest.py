@@ -0,0 +1,103 @@
+import os
+import json
+import time
+import math
+import random
+import asyncio
+import logging
+from concurrent.futures import ThreadPoolExecutor
+from pinecone_local import PINECONE_MAX_REQUEST_BYTES, PINECONE_LOCAL
+
+# --- ตั้งค่าการ upsert เข้า Pinecone ---
+# เผื่อที่ไว้จากขนาดสูงสุดจริง (JSON ของ request มี overhead นอกเหนือจาก vector)
+PINECONE_BATCH_BYTES = int(os.getenv("PINECONE_BATCH_BYTES", str(int(PINECONE_MAX_REQUEST_BYTES * 0.9))))
+PINECONE_BATCH_MAX_VECTORS = int(os.getenv("PINECONE_BATCH_MAX_VECTORS", "1000"))
+PINECONE_UPSERT_CONCURRENCY = int(os.getenv("PINECONE_UPSERT_CONCURRENCY", "8"))
+PINECONE_UPSERT_RETRIES = int(os.getenv("PINECONE_UPSERT_RETRIES", "3"))
+# ตัวเลข float ใน JSON ยาวประมาณนี้ (เช่น "-0.012345678," )
+JSON_BYTES_PER_FLOAT = 20
+
+# index.upsert ของ client เป็น synchronous จึงรันใน thread pool ร่วมกันทั้ง process
+_executor = ThreadPoolExecutor(max_workers=PINECONE_UPSERT_CONCURRENCY, thread_name_prefix="pinecone-upsert")
+
+def clean_metadata(metadata):
+    """Pinecone รับ metadata เป็น str/number/bool/list ของ str เท่านั้น และไม่รับค่า null"""
+    cleaned = {}
+    for key, value in (metadata or {}).items():
+        if value is None or (isinstance(value, float) and math.isnan(value)):
+            continue
+        if isinstance(value, (str, bool, int, float)):
+            cleaned[str(key)] = value
+        elif isinstance(value, (list, tuple)):
+            cleaned[str(key)] = [str(item) for item in value]
+        else:
+            cleaned[str(key)] = str(value)
+    return cleaned
+
+def estimate_vector_bytes(vector):
+    metadata = vector.get("metadata")
+    metadata_bytes = len(json.dumps(metadata, ensure_ascii=False).encode("utf-8")) if metadata else 0
+    return len(vector["id"]) + len(vector["values"]) * JSON_BYTES_PER_FLOAT + metadata_bytes + 64
+
+def batch_by_bytes(vectors, max_bytes=PINECONE_BATCH_BYTES, max_vectors=PINECONE_BATCH_MAX_VECTORS):
+    """แบ่ง vector เป็น batch ตามขนาด payload (ไม่ใช่จำนวนคงที่) เพื่อไม่ให้ request เกินขนาดที่ Pinecone รับ"""
+    batch, batch_bytes = [], 0
+    for vector in vectors:
+        size = estimate_vector_bytes(vector)
+        if batch and (batch_bytes + size > max_bytes or len(batch) >= max_vectors):
+            yield batch
+            batch, batch_bytes = [], 0
+        batch.append(vector)
+        batch_bytes += size
+    if batch:
+        yield batch
+
+async def upsert_vectors(index, vectors, namespace=None, concurrency=PINECONE_UPSERT_CONCURRENCY,
+                         retries=PINECONE_UPSERT_RETRIES, max_bytes=PINECONE_BATCH_BYTES):
+    """
+    upsert แบบขนาน (จำกัดจำนวนพร้อมกันด้วย semaphore + thread pool)
+    batch ที่ล้มเหลวจะถูกส่งใหม่เฉพาะ batch นั้น (backoff แบบ exponential + jitter) จนครบ retries
+    """
+    loop = asyncio.get_running_loop()
+    semaphore = asyncio.Semaphore(concurrency)
+    batches = list(batch_by_bytes(vectors, max_bytes))
+    report = {"vectors": len(vectors), "batches": len(batches), "upserted": 0, "retries": 0, "failed_batches": 0, "failed_ids": []}
+    started = time.perf_counter()
+
+    async def send(batch):
+        for attempt in range(retries + 1):
+            try:
+                async with semaphore:
+                    await loop.run_in_executor(_executor, lambda: index.upsert(vectors=batch, namespace=namespace))
+                report["upserted"] += len(batch)
+                return
+            except Exception as e:
+                if attempt == retries:
+                    logging.error(f"Pinecone upsert of {len(batch)} vectors failed after {retries + 1} attempts: {e}")
+                    report["failed_batches"] += 1
+                    report["failed_ids"].extend(vector["id"] for vector in batch)
+                    return
+                report["retries"] += 1
+                await asyncio.sleep(min(0.5 * 2 ** attempt, 8) * (0.5 + random.random()))
+
+    await asyncio.gather(*(send(batch) for batch in batches))
+    report["seconds"] = round(time.perf_counter() - started, 3)
+    print(f"Pinecone upsert: {report['upserted']}/{report['vectors']} vectors in {report['batches']} batches "
+          f"({report['retries']} retries, {report['failed_batches']} failed) {report['seconds']}s")
+    return report
+
+def ensure_index(pc, index_name, dimension, metric="cosine", timeout=120):
+    """สร้าง serverless index ถ้ายังไม่มี แล้วรอจนพร้อมใช้งาน"""
+    if index_name not in pc.list_indexes().names():
+        spec = None
+        if not PINECONE_LOCAL:  # index จำลองไม่ต้องใช้ spec
+            from pinecone import ServerlessSpec
+            spec = ServerlessSpec(cloud="aws", region=os.getenv("PINECONE_ENV"))
+        pc.create_index(name=index_name, dimension=dimension, metric=metric, spec=spec)
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        status = pc.describe_index(index_name)["status"]
+        if status.get("ready"):
+            break
+        time.sleep(1)
+    return pc.Index(index_name)
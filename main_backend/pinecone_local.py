@@ -0,0 +1,129 @@
+import os
+import json
+import random
+import threading
+import numpy as np
+from matrix_cache import normalize_rows, top_k_indices
+
+# PINECONE_LOCAL=true ใช้ index จำลองใน process แทน Pinecone จริง (ทดสอบ ingest/ค้นหาแบบ offline)
+PINECONE_LOCAL = os.getenv("PINECONE_LOCAL", "false").lower() in ("1", "true", "yes")
+# ขนาด request สูงสุดที่ Pinecone รับต่อการ upsert หนึ่งครั้ง
+PINECONE_MAX_REQUEST_BYTES = int(os.getenv("PINECONE_MAX_REQUEST_BYTES", str(2 * 1024 * 1024)))
+
+class _IndexList(list):
+    def names(self):
+        return [index["name"] for index in self]
+
+class LocalPineconeIndex:
+    """
+    Index จำลองที่มี method เหมือน pinecone.Index (upsert/query/delete/describe_index_stats)
+    fail_rate ใช้จำลอง request ที่ล้มเหลวเพื่อทดสอบการ retry; request ที่ใหญ่เกิน max_request_bytes จะถูกปฏิเสธเหมือนของจริง
+    """
+
+    def __init__(self, name, dimension=None, fail_rate=0.0, max_request_bytes=PINECONE_MAX_REQUEST_BYTES, seed=None):
+        self.name = name
+        self.dimension = dimension
+        self.fail_rate = fail_rate
+        self.max_request_bytes = max_request_bytes
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+        self._namespaces = {}
+        self.upsert_requests = 0
+        self.failed_requests = 0
+
+    def upsert(self, vectors, namespace=None):
+        with self._lock:
+            self.upsert_requests += 1
+            if self.fail_rate and self._random.random() < self.fail_rate:
+                self.failed_requests += 1
+                raise ConnectionError("simulated Pinecone upsert failure")
+        size = len(json.dumps(vectors, ensure_ascii=False).encode("utf-8"))
+        if size > self.max_request_bytes:
+            raise ValueError(f"Request size {size} exceeds the maximum of {self.max_request_bytes} bytes")
+        with self._lock:
+            records = self._namespaces.setdefault(namespace or "", {})
+            for vector in vectors:
+                values = np.asarray(vector["values"], dtype=np.float32)
+                if self.dimension is None:
+                    self.dimension = len(values)
+                if len(values) != self.dimension:
+                    raise ValueError(f"Vector dimension {len(values)} does not match the index dimension {self.dimension}")
+                records[vector["id"]] = (values, vector.get("metadata") or {})
+        return {"upserted_count": len(vectors)}
+
+    def delete(self, ids=None, delete_all=False, namespace=None):
+        with self._lock:
+            records = self._namespaces.setdefault(namespace or "", {})
+            if delete_all:
+                records.clear()
+            for doc_id in ids or []:
+                records.pop(doc_id, None)
+        return {}
+
+    def query(self, vector, top_k=5, include_metadata=False, namespace=None, **kwargs):
+        with self._lock:
+            records = dict(self._namespaces.get(namespace or "", {}))
+        if not records:
+            return {"matches": [], "namespace": namespace or ""}
+        ids = list(records)
+        matrix = normalize_rows(np.stack([records[doc_id][0] for doc_id in ids]))
+        scores = matrix @ normalize_rows(vector)[0]
+        matches = []
+        for i in top_k_indices(scores, top_k):
+            match = {"id": ids[i], "score": float(scores[i])}
+            if include_metadata:
+                match["metadata"] = records[ids[i]][1]
+            matches.append(match)
+        return {"matches": matches, "namespace": namespace or ""}
+
+    def describe_index_stats(self):
+        with self._lock:
+            namespaces = {name: {"vector_count": len(records)} for name, records in self._namespaces.items()}
+        return {
+            "dimension": self.dimension,
+            "namespaces": namespaces,
+            "total_vector_count": sum(ns["vector_count"] for ns in namespaces.values()),
+        }
+
+class LocalPinecone:
+    """Client จำลองที่มี method ที่ backend ใช้จาก pinecone.Pinecone"""
+
+    def __init__(self, fail_rate=0.0):
+        self.fail_rate = fail_rate
+        self._indexes = {}
+        self._lock = threading.Lock()
+
+    def Index(self, name):
+        with self._lock:
+            index = self._indexes.get(name)
+            if index is None:
+                index = LocalPineconeIndex(name, fail_rate=self.fail_rate)
+                self._indexes[name] = index
+            return index
+
+    def list_indexes(self):
+        with self._lock:
+            return _IndexList({"name": name, "dimension": index.dimension} for name, index in self._indexes.items())
+
+    def create_index(self, name, dimension, metric="cosine", spec=None, **kwargs):
+        with self._lock:
+            self._indexes[name] = LocalPineconeIndex(name, dimension, fail_rate=self.fail_rate)
+
+    def delete_index(self, name):
+        with self._lock:
+            self._indexes.pop(name, None)
+
+    def describe_index(self, name):
+        return {"name": name, "status": {"ready": True}}
+
+_local_client = None
+
+def get_pinecone_client(api_key=None, environment=None):
+    """คืน Pinecone client จริง หรือ client จำลองตัวเดียวทั้ง process เมื่อ PINECONE_LOCAL=true"""
+    global _local_client
+    if PINECONE_LOCAL:
+        if _local_client is None:
+            _local_client = LocalPinecone()
+        return _local_client
+    from pinecone import Pinecone
+    return Pinecone(api_key=api_key or os.getenv("PINECONE_API_KEY"), environment=environment or os.getenv("PINECONE_ENV"))
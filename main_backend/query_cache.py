@@ -0,0 +1,212 @@
+import os
+import time
+import asyncio
+import hashlib
+import logging
+import threading
+import unicodedata
+from collections import OrderedDict
+from datetime import datetime, timedelta
+import numpy as np
+from openai import AsyncOpenAI
+from vector_codec import encode_embedding, decode_embedding
+from embedding_scheduler import embedding_scheduler, estimate_tokens, PRIORITY_QUERY
+
+# --- ตั้งค่า cache ของ vector คำถาม ---
+QUERY_CACHE_SIZE = int(os.getenv("QUERY_CACHE_SIZE", "2048"))
+QUERY_CACHE_TTL = int(os.getenv("QUERY_CACHE_TTL", "86400"))         # วินาที
+# เก็บลง MongoDB ด้วย (file_agent_db.query_embedding_cache) ให้ทุก worker และการ restart ใช้ร่วมกัน
+QUERY_CACHE_PERSIST = os.getenv("QUERY_CACHE_PERSIST", "false").lower() in ("1", "true", "yes")
+
+_client = None
+
+def get_openai_client():
+    """AsyncOpenAI ตัวเดียวทั้ง process (ใช้ connection pool เดิมแทนการสร้างใหม่ทุกคำถาม)"""
+    global _client
+    if _client is None:
+        _client = AsyncOpenAI()
+    return _client
+
+def reset_openai_client():
+    """เรียกหลัง reload .env เพื่อให้ client ตัวถัดไปใช้ API key ใหม่"""
+    global _client
+    _client = None
+
+def normalize_question(question):
+    # คำถามเดียวกันที่ต่างกันแค่ช่องว่าง/ตัวพิมพ์เล็กใหญ่ ให้ใช้ vector เดียวกัน
+    text = unicodedata.normalize("NFC", question or "")
+    return " ".join(text.split()).casefold()
+
+def _cache_key(model, question):
+    return hashlib.sha256(f"{model}\n{normalize_question(question)}".encode("utf-8")).hexdigest()
+
+class QueryEmbeddingCache:
+    """
+    Cache vector ของคำถาม: key = model + คำถามที่ normalize แล้ว
+    - ในหน่วยความจำเป็น LRU มีอายุ (TTL)
+    - ถ้าผูก MongoDB ไว้ จะอ่าน/เขียน vector ลง collection ด้วย (ลบอัตโนมัติด้วย TTL index)
+    """
+
+    def __init__(self, max_entries: int, ttl_seconds: int):
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_seconds
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self._pending = {}
+        self._store = None
+        self.hits = 0
+        self.store_hits = 0
+        self.misses = 0
+        self.embed_calls = 0
+        self.embed_ms_total = 0.0
+
+    def attach_store(self, store_collection):
+        try:
+            store_collection.create_index("created_at", expireAfterSeconds=self.ttl_seconds)
+        except Exception as e:
+            logging.warning(f"Could not create TTL index on {store_collection.full_name}: {e}")
+        self._store = store_collection
+
+    def _get_local(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            vector, expires_at = entry
+            if expires_at < time.time():
+                del self._entries[key]
+                return None
+            self._entries.move_to_end(key)
+            return vector
+
+    def _put_local(self, key, vector):
+        with self._lock:
+            self._entries[key] = (vector, time.time() + self.ttl_seconds)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def _get_stored(self, key):
+        if self._store is None:
+            return None
+        try:
+            doc = self._store.find_one({"_id": key}, {"embedding": 1, "created_at": 1})
+        except Exception as e:
+            logging.warning(f"Query embedding cache lookup failed: {e}")
+            return None
+        if not doc or doc["created_at"] < datetime.now() - timedelta(seconds=self.ttl_seconds):
+            return None
+        return decode_embedding(doc["embedding"])
+
+    def _put_stored(self, key, model, vector):
+        if self._store is None:
+            return
+        try:
+            self._store.replace_one(
+                {"_id": key},
+                {"_id": key, "model": model, "embedding": encode_embedding(vector, "binary"), "created_at": datetime.now()},
+                upsert=True
+            )
+        except Exception as e:
+            logging.warning(f"Query embedding cache write failed: {e}")
+
+    async def embed(self, question, model):
+        """คืน vector ของคำถาม (numpy float32 1 มิติ) จาก cache หรือเรียก embeddings API"""
+        return (await self.embed_many([question], model))[0]
+
+    async def embed_many(self, questions, model):
+        """
+        คืน vector ของหลายคำถามตามลำดับ
+        คำถามที่ไม่อยู่ใน cache ถูกส่งไปใน embeddings request เดียวกัน
+        """
+        keys = [_cache_key(model, question) for question in questions]
+        vectors = {}
+        waiting = {}
+        missing = {}
+        for key, question in zip(keys, questions):
+            if key in vectors or key in waiting or key in missing:
+                continue
+            vector = self._get_local(key)
+            if vector is not None:
+                self.hits += 1
+                vectors[key] = vector
+                continue
+            vector = self._get_stored(key)
+            if vector is not None:
+                self.store_hits += 1
+                self._put_local(key, vector)
+                vectors[key] = vector
+                continue
+            # คำถามเดียวกันที่กำลังถูก embed อยู่ในอีก request รอผลจากการเรียก API ครั้งนั้น
+            pending = self._pending.get(key)
+            if pending is not None:
+                self.hits += 1
+                waiting[key] = pending
+                continue
+            missing[key] = question
+
+        if missing:
+            loop = asyncio.get_running_loop()
+            futures = {key: loop.create_future() for key in missing}
+            self._pending.update(futures)
+            try:
+                started = time.perf_counter()
+                texts = list(missing.values())
+                # คำถามได้คิวก่อน batch ของการ ingest ที่ใช้งบ API เดียวกัน
+                response = await embedding_scheduler.run(
+                    lambda: get_openai_client().embeddings.create(model=model, input=texts),
+                    estimate_tokens(texts),
+                    PRIORITY_QUERY
+                )
+                self.embed_ms_total += (time.perf_counter() - started) * 1000
+                self.embed_calls += 1
+                self.misses += len(missing)
+                for key, item in zip(missing, response.data):
+                    vector = np.asarray(item.embedding, dtype=np.float32)
+                    vector.flags.writeable = False
+                    self._put_local(key, vector)
+                    self._put_stored(key, model, vector)
+                    vectors[key] = vector
+                    futures[key].set_result(vector)
+            except asyncio.CancelledError:
+                for future in futures.values():
+                    future.cancel()
+                raise
+            except Exception as e:
+                for future in futures.values():
+                    if not future.done():
+                        future.set_exception(e)
+                        # ไม่มีใครรอ future นี้ก็ไม่ต้องเตือน "exception was never retrieved"
+                        future.exception()
+                raise
+            finally:
+                for key in futures:
+                    self._pending.pop(key, None)
+
+        for key, pending in waiting.items():
+            vectors[key] = await asyncio.shield(pending)
+        return [vectors[key] for key in keys]
+
+    def stats(self):
+        lookups = self.hits + self.store_hits + self.misses
+        avg_embed_ms = self.embed_ms_total / self.embed_calls if self.embed_calls else 0.0
+        return {
+            "entries": len(self._entries),
+            "max_entries": self.max_entries,
+            "ttl_seconds": self.ttl_seconds,
+            "persisted": self._store is not None,
+            "hits": self.hits,
+            "store_hits": self.store_hits,
+            "misses": self.misses,
+            "embed_calls": self.embed_calls,
+            "hit_rate": round((self.hits + self.store_hits) / lookups, 4) if lookups else 0.0,
+            "avg_embed_ms": round(avg_embed_ms, 1),
+            # เวลาที่ไม่ต้องรอ embeddings API โดยประมาณ (จำนวน hit x เวลาเฉลี่ยของการเรียก API)
+            "saved_ms": round((self.hits + self.store_hits) * avg_embed_ms, 1),
+        }
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+query_embedding_cache = QueryEmbeddingCache(QUERY_CACHE_SIZE, QUERY_CACHE_TTL)
@@ -0,0 +1,91 @@
+import os
+import time
+import argparse
+from pathlib import Path
+import numpy as np
+from dotenv import load_dotenv
+from pymongo import MongoClient
+from matrix_cache import (
+    EmbeddingMatrixCache, quantize_matrix, score_matrix, top_k_indices, normalize_rows,
+    RESCORE_CANDIDATES_FACTOR
+)
+
+current_directory = os.getcwd()
+env_path = Path(current_directory).parent / 'venv' / '.env'
+load_dotenv(dotenv_path=env_path, override=True)
+
+def sample_queries(matrix, sample_size=200, noise=0.05, seed=0):
+    """
+    สร้างคำถามจำลองจาก vector ของเอกสารในคลัง + noise เล็กน้อย
+    (กันไม่ให้เอกสารต้นทางชนะอันดับ 1 แบบตายตัว)
+    """
+    rng = np.random.default_rng(seed)
+    rows = rng.choice(matrix.shape[0], size=min(sample_size, matrix.shape[0]), replace=False)
+    queries = matrix[rows] + rng.normal(scale=noise, size=(len(rows), matrix.shape[1])).astype(np.float32)
+    return normalize_rows(queries)
+
+def quantization_recall_report(collection, precisions=("float16", "int8"), top_k=4, sample_size=200,
+                               candidates_factor=RESCORE_CANDIDATES_FACTOR):
+    """
+    เทียบผลค้นหาของ matrix ที่ quantize แล้วกับ exact search (float32)
+    รายงาน recall@k ทั้งแบบรอบแรกอย่างเดียวและแบบ rescore ด้วย vector เต็ม, หน่วยความจำ และเวลาต่อคำถาม
+    """
+    exact_entry = EmbeddingMatrixCache(max_bytes=0)._load(collection, "recall-report")
+    exact = exact_entry["matrix"]
+    if exact_entry["count"] == 0:
+        return {"collection": collection.full_name, "vectors": 0, "results": []}
+    queries = sample_queries(exact, sample_size)
+    exact_top = [set(top_k_indices(exact @ q, top_k)) for q in queries]
+
+    results = []
+    for precision in ("float32",) + tuple(precisions):
+        stored, scales = quantize_matrix(exact, precision)
+        first_stage_hits, rescored_hits = 0, 0
+        started = time.perf_counter()
+        for q, truth in zip(queries, exact_top):
+            scores = score_matrix(stored, q, scales)
+            first_stage_hits += len(truth & set(top_k_indices(scores, top_k)))
+            # rescore: คำนวณใหม่ด้วย vector เต็มของ candidate เหมือนขั้นตอนตอนค้นจริง
+            candidates = top_k_indices(scores, top_k * candidates_factor)
+            rescored = candidates[top_k_indices(exact[candidates] @ q, top_k)]
+            rescored_hits += len(truth & set(rescored))
+        elapsed_ms = (time.perf_counter() - started) * 1000 / len(queries)
+        total = top_k * len(queries)
+        results.append({
+            "precision": precision,
+            "bytes": int(stored.nbytes + (scales.nbytes if scales is not None else 0)),
+            "recall_at_k": round(first_stage_hits / total, 4),
+            "recall_at_k_rescored": round(rescored_hits / total, 4),
+            "ms_per_query": round(elapsed_ms, 3),
+        })
+    return {
+        "collection": collection.full_name,
+        "vectors": int(exact_entry["count"]),
+        "dimension": int(exact_entry["dim"]),
+        "top_k": top_k,
+        "candidates": top_k * candidates_factor,
+        "queries": len(queries),
+        "results": results,
+    }
+
+def print_report(report):
+    print(f"{report['collection']}: {report['vectors']} vectors x {report.get('dimension')} dims, "
+          f"k={report.get('top_k')}, {report.get('queries')} queries")
+    print(f"{'precision':<10}{'MB':>10}{'recall@k':>12}{'rescored':>12}{'ms/query':>12}")
+    for row in report["results"]:
+        print(f"{row['precision']:<10}{row['bytes'] / 1024 / 1024:>10.1f}{row['recall_at_k']:>12.3f}"
+              f"{row['recall_at_k_rescored']:>12.3f}{row['ms_per_query']:>12.3f}")
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Recall@k of quantized embedding matrices compared to exact search")
+    parser.add_argument("--db", required=True)
+    parser.add_argument("--collection", required=True)
+    parser.add_argument("--k", type=int, default=4)
+    parser.add_argument("--sample", type=int, default=200)
+    parser.add_argument("--factor", type=int, default=RESCORE_CANDIDATES_FACTOR)
+    args = parser.parse_args()
+
+    mongo_client = MongoClient(os.getenv("MONGO_URL"))
+    print_report(quantization_recall_report(
+        mongo_client[args.db][args.collection], top_k=args.k, sample_size=args.sample, candidates_factor=args.factor
+    ))
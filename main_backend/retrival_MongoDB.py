@@ -1,9 +1,33 @@
+import os
+import asyncio
+import logging
 import numpy as np
 import tiktoken
 from sklearn.decomposition import PCA
+from faiss_index import faiss_available, search_index_many, get_index_dimension
+from matrix_cache import (
+    matrix_cache, search_entry_many, rescore_many_with_full_vectors,
+    RESCORE_CANDIDATES_FACTOR
+)
+from collection_meta import get_embedding_settings
+from matryoshka import short_vector, SHORT_EMBEDDING_FIELD, SHORTLIST_SIZE
+from bm25_index import search_bm25
+from query_cache import query_embedding_cache
+from vector_codec import decode_embedding
+from context_dedup import mmr_select, merge_adjacent_chunks, dedup_stats, MMR_LAMBDA, MMR_CANDIDATES_FACTOR, MERGE_ADJACENT_CHUNKS
 
 openai_tokenizer = tiktoken.encoding_for_model("text-embedding-3-large")
 
+# engine ที่ใช้ค้นหา: "faiss" (ANN index) หรือ "brute" (คำนวณ cosine ทุกเอกสารจาก matrix cache)
+RETRIEVAL_ENGINE = os.getenv("RETRIEVAL_ENGINE", "faiss")
+# น้ำหนักของคะแนน BM25 ตอนรวมกับคะแนน vector (0 = ใช้ vector อย่างเดียว, 1 = ใช้ BM25 อย่างเดียว)
+HYBRID_BM25_WEIGHT = float(os.getenv("HYBRID_BM25_WEIGHT", "0.3"))
+# จำนวน candidate จากแต่ละฝั่งที่นำมารวมคะแนน
+HYBRID_CANDIDATES = int(os.getenv("HYBRID_CANDIDATES", "20"))
+# micro-batch ของคำถามที่เข้ามาพร้อมกัน: รอไม่เกิน window (ms) หรือจนครบ max คำถาม
+RETRIEVAL_BATCH_WINDOW_MS = float(os.getenv("RETRIEVAL_BATCH_WINDOW_MS", "3"))
+RETRIEVAL_BATCH_MAX = int(os.getenv("RETRIEVAL_BATCH_MAX", "32"))
+
 def reduce_vector_dimension(vec, target_dim, pca_energy=None):
     """
     vec: numpy array (shape: [n_samples, n_features] or [n_features])
@@ -51,32 +75,249 @@ def cosine_similarity_2(vec1, vec2):
     return np.dot(vec1, vec2) / (np.linalg.norm(vec1) * np.linalg.norm(vec2))
 
 def reduce_token_with_openai(text, max_tokens=512):
+    return _reduce_tokens(text, max_tokens)[0]
+
+def _reduce_tokens(text, max_tokens=512):
+    """ตัดข้อความไม่ให้เกิน max_tokens คืน (ข้อความ, จำนวน token)"""
     tokens = openai_tokenizer.encode(text)
     if len(tokens) > max_tokens:
         tokens = tokens[:max_tokens]
-    return openai_tokenizer.decode(tokens)
-
-async def retrieve_context_from_mongodb(collection, question: str, top_k: int = 4, embedding_model="text-embedding-3-large"):
-    from openai import AsyncOpenAI
-    client = AsyncOpenAI()
-    # print(f"question{question}")
-    response = await client.embeddings.create(model=embedding_model, input=[question])
-    question_vector = np.array([response.data[0].embedding])
-    print(f"Question vector shape: {question_vector.shape}")
-    documents = list(collection.find())
-    similarities = []
-    for doc in documents:
-        doc_embedding = np.array(doc["embedding"]).flatten()
-        # ปรับขนาด embedding หากจำเป็น
-        if doc_embedding.shape[0] != question_vector.shape[1]:
-            doc_embedding = reduce_vector_dimension(doc_embedding, question_vector.shape[1])
-        score = cosine_similarity_2(question_vector, doc_embedding)
-        similarities.append((score, doc))
-    similarities.sort(reverse=True, key=lambda x: x[0])
-    reduced_texts = []
-    for score, doc in similarities[:top_k]:
-        reduced = reduce_token_with_openai(doc.get("raw_text", ""))
-        print(f"Top doc (score={score:.4f}): {reduced[:100]} ...")
-        reduced_texts.append(reduced)
-    # print(f"นี้คือช้อความที่ลดแล้ว : {reduced_texts}")
-    return "\n".join(reduced_texts)
+    return openai_tokenizer.decode(tokens), len(tokens)
+
+def _fit_query_dimension(question_vector, dim):
+    # ปกติคำถามถูก embed ด้วย model เดียวกับเอกสารจึงมีมิติตรงกันอยู่แล้ว
+    # เผื่อกรณีข้อมูลเก่าที่มิติไม่ตรง ให้ปรับที่คำถามแทนการปรับทุกเอกสาร
+    query = question_vector.flatten()
+    if query.shape[0] != dim:
+        logging.warning(f"Question vector has {query.shape[0]} dims but the collection has {dim}")
+        query = reduce_vector_dimension(query, dim)
+    return query
+
+def _fit_query_dimensions(question_vectors, dim):
+    return np.stack([_fit_query_dimension(vector, dim) for vector in np.atleast_2d(question_vectors)])
+
+def _short_first_hits_many(collection, question_vectors, short_dim, top_k=4):
+    """
+    รอบแรกสแกน vector สั้น (prefix ของ vector เต็ม) ได้ shortlist
+    แล้วจัดอันดับใหม่ด้วย vector เต็มเฉพาะ shortlist
+    """
+    entry = matrix_cache.get(collection, field=SHORT_EMBEDDING_FIELD)
+    if entry["count"] == 0:
+        return None
+    queries = np.atleast_2d(question_vectors)
+    short_queries = np.stack([short_vector(query, short_dim) for query in queries])
+    candidates = search_entry_many(entry, short_queries, max(SHORTLIST_SIZE, top_k))
+    return rescore_many_with_full_vectors(
+        collection, queries, [[doc_id for _, doc_id in hits] for hits in candidates], top_k
+    )
+
+def _brute_force_hits_many(collection, question_vectors, top_k=4, short_dim=None):
+    """ทุกคำถามถูกให้คะแนนกับ matrix ของ collection ในการคูณ matrix-matrix ครั้งเดียว"""
+    if short_dim:
+        hits = _short_first_hits_many(collection, question_vectors, short_dim, top_k)
+        if hits is not None:
+            return hits
+    entry = matrix_cache.get(collection)
+    if entry["count"] == 0:
+        return [[] for _ in np.atleast_2d(question_vectors)]
+    queries = _fit_query_dimensions(question_vectors, entry["dim"])
+    if entry["precision"] == "float32":
+        return search_entry_many(entry, queries, top_k)
+    # รอบแรกคัดด้วย vector ที่ quantize แล้ว รอบสองจัดอันดับใหม่ด้วย vector เต็มความละเอียด
+    candidates = search_entry_many(entry, queries, top_k * RESCORE_CANDIDATES_FACTOR)
+    return rescore_many_with_full_vectors(
+        collection, queries, [[doc_id for _, doc_id in hits] for hits in candidates], top_k
+    )
+
+def _faiss_hits_many(collection, question_vectors, top_k=4):
+    index_dim = get_index_dimension(collection)
+    if index_dim is None:
+        return [[] for _ in np.atleast_2d(question_vectors)]
+    return search_index_many(collection, _fit_query_dimensions(question_vectors, index_dim), top_k)
+
+def _min_max(scores):
+    if not scores:
+        return {}
+    low, high = min(scores.values()), max(scores.values())
+    if high == low:
+        return {doc_id: 1.0 for doc_id in scores}
+    return {doc_id: (score - low) / (high - low) for doc_id, score in scores.items()}
+
+def hybrid_fuse_many(collection, question_vectors, vector_hits, lexical_hits, top_k=4, weight=HYBRID_BM25_WEIGHT):
+    """
+    รวมคะแนน vector กับ BM25 ของหลายคำถามแบบถ่วงน้ำหนัก (normalize แต่ละฝั่งเป็น 0-1 ก่อน)
+    เอกสารที่มาจาก BM25 อย่างเดียวจะถูกคำนวณคะแนน vector จริงจาก vector เต็มของเอกสารนั้น
+    (ดึง vector ของทุกคำถามด้วย $in ครั้งเดียว) คำถามที่ไม่มีผล BM25 ใช้ผล vector เดิม
+    """
+    vector_scores = [{doc_id: score for score, doc_id in hits} for hits in vector_hits]
+    lexical_scores = [{doc_id: score for score, doc_id in hits} for hits in lexical_hits]
+    missing = [
+        [doc_id for doc_id in lexical if doc_id not in vector]
+        for vector, lexical in zip(vector_scores, lexical_scores)
+    ]
+    if any(missing):
+        rescored = rescore_many_with_full_vectors(
+            collection, question_vectors, missing, max(len(ids) for ids in missing)
+        )
+        for scores, question_rescored in zip(vector_scores, rescored):
+            scores.update((doc_id, score) for score, doc_id in question_rescored)
+    results = []
+    for hits, vector, lexical in zip(vector_hits, vector_scores, lexical_scores):
+        if not lexical:
+            results.append(hits)
+            continue
+        vector_norm, lexical_norm = _min_max(vector), _min_max(lexical)
+        fused = {
+            doc_id: (1 - weight) * vector_norm.get(doc_id, 0.0) + weight * lexical_norm.get(doc_id, 0.0)
+            for doc_id in set(vector_norm) | set(lexical_norm)
+        }
+        results.append(sorted(((score, doc_id) for doc_id, score in fused.items()), key=lambda hit: hit[0], reverse=True)[:top_k])
+    return results
+
+async def search_many(collection, questions, top_k: int = 4, embedding_model=None, engine=None):
+    """
+    ค้นหาหลายคำถามพร้อมกัน: embed ทุกคำถามใน request เดียว, ให้คะแนนกับ collection ในการคูณ matrix ครั้งเดียว
+    และดึง raw_text ของทุกคำถามด้วย $in ครั้งเดียว คืนค่า [(score, text), ...] ตามลำดับคำถาม
+    chunk ที่ซ้ำกันถูกคัดออกด้วย MMR และ chunk ที่อยู่ติดกันถูกรวมเป็นข้อความเดียว
+    """
+    if not questions:
+        return []
+    # ใช้ model เดียวกับที่ใช้ ingest collection นี้ เพื่อให้มิติของคำถามและเอกสารตรงกัน
+    settings = get_embedding_settings(collection, os.getenv("EMBEDDING_MODEL", os.getenv("EMBEDDING", "text-embedding-3-small")))
+    embedding_model = embedding_model or settings["model"]
+    question_vectors = np.stack(await query_embedding_cache.embed_many(questions, embedding_model))
+    print(f"Question vectors shape: {question_vectors.shape}")
+    engine = (engine or RETRIEVAL_ENGINE).lower()
+    lexical_hits = [[] for _ in questions]
+    if HYBRID_BM25_WEIGHT > 0:
+        try:
+            lexical_hits = [search_bm25(collection, question, max(HYBRID_CANDIDATES, top_k)) for question in questions]
+        except Exception as e:
+            logging.error(f"BM25 search failed, using vector scores only: {e}")
+    # MMR ต้องมี candidate มากกว่า top_k ให้เลือก; ถ้ามีผล BM25 ให้ฝั่ง vector ส่ง candidate มาอย่างน้อย HYBRID_CANDIDATES
+    candidate_k = top_k * MMR_CANDIDATES_FACTOR if MMR_LAMBDA < 1 else top_k
+    vector_k = max(HYBRID_CANDIDATES, candidate_k) if any(lexical_hits) else candidate_k
+    hits = [[] for _ in questions]
+    if engine == "faiss" and faiss_available():
+        try:
+            hits = _faiss_hits_many(collection, question_vectors, vector_k)
+        except Exception as e:
+            logging.error(f"FAISS search failed, falling back to brute force: {e}")
+    empty = [i for i, question_hits in enumerate(hits) if not question_hits]
+    if empty:
+        fallback = _brute_force_hits_many(collection, question_vectors[empty], vector_k, settings["short_dimension"])
+        for i, question_hits in zip(empty, fallback):
+            hits[i] = question_hits
+    if any(lexical_hits):
+        hits = hybrid_fuse_many(collection, question_vectors, hits, lexical_hits, candidate_k)
+    hits = [question_hits[:candidate_k] for question_hits in hits]
+
+    from embed_MongoDB import MAX_TOKEN_LENGTH, CHUNK_STRIDE
+    chunk_overlap_tokens = MAX_TOKEN_LENGTH - CHUNK_STRIDE
+
+    # ดึง raw_text (และ vector สำหรับ MMR) ของ candidate ทุกคำถามด้วย $in ครั้งเดียว
+    field = settings["field"]
+    projection = {"raw_text": 1, field: 1} if candidate_k > top_k else {"raw_text": 1}
+    wanted = list({doc_id for question_hits in hits for _, doc_id in question_hits})
+    docs_by_id = {doc["_id"]: doc for doc in collection.find({"_id": {"$in": wanted}}, projection)} if wanted else {}
+    results = []
+    for question_hits in hits:
+        question_hits = [hit for hit in question_hits if hit[1] in docs_by_id]
+        if candidate_k > top_k:
+            vectors_by_id = {doc_id: decode_embedding(docs_by_id[doc_id].get(field)) for _, doc_id in question_hits}
+            selected = mmr_select(question_hits, vectors_by_id, top_k)
+        else:
+            selected = question_hits[:top_k]
+        chunks = [(score, doc_id, docs_by_id[doc_id].get("raw_text", "")) for score, doc_id in selected]
+        if MERGE_ADJACENT_CHUNKS:
+            merged = merge_adjacent_chunks(chunks)
+        else:
+            merged = [(score, [doc_id], text) for score, doc_id, text in chunks]
+        passages = []
+        tokens_before = tokens_after = 0
+        for score, ids, text in merged:
+            # chunk ที่รวมกันแล้วยาวกว่าเดิม ให้โควตา token ตามจำนวน chunk ที่รวม
+            reduced, token_count = _reduce_tokens(text, max_tokens=512 * len(ids))
+            print(f"Top doc (score={score:.4f}, chunks={len(ids)}): {reduced[:100]} ...")
+            passages.append((score, reduced))
+            # ถ้าไม่รวม chunk ทุกรอยต่อจะมีส่วนที่ซ้อนกัน (window - stride token) ซ้ำอีกรอบ
+            tokens_after += token_count
+            tokens_before += token_count + (len(ids) - 1) * chunk_overlap_tokens
+        dedup_stats.record(tokens_before, tokens_after, len(chunks) - len(merged))
+        print(f"Context tokens: {tokens_after} (saved {tokens_before - tokens_after} of {tokens_before})")
+        results.append(passages)
+    return results
+
+async def retrieve_many(collection, questions, top_k: int = 4, embedding_model=None, engine=None):
+    """เหมือน search_many แต่คืน context (ข้อความต่อกัน) ของแต่ละคำถาม"""
+    results = await search_many(collection, questions, top_k, embedding_model, engine)
+    return ["\n".join(text for _, text in passages) for passages in results]
+
+class RetrievalBatcher:
+    """
+    รวมคำถามที่เข้ามาพร้อมกัน (เช่น webhook หลายผู้ส่ง) ไว้ภายใน window สั้นๆ แล้วค้นด้วย retrieve_many ครั้งเดียว
+    แยก batch ตาม collection, top_k และ engine; batch เต็ม max_batch จะถูกส่งทันทีไม่ต้องรอ window
+    """
+
+    def __init__(self, window_ms: float, max_batch: int):
+        self.window = window_ms / 1000
+        self.max_batch = max_batch
+        self._batches = {}
+        self._tasks = set()
+        self.batches = 0
+        self.questions = 0
+
+    async def retrieve(self, collection, question, top_k=4, engine=None):
+        """คืน context (ข้อความต่อกัน) ของคำถาม"""
+        passages = await self.search(collection, question, top_k, engine)
+        return "\n".join(text for _, text in passages)
+
+    async def search(self, collection, question, top_k=4, engine=None):
+        """คืน [(score, text), ...] ของคำถาม"""
+        loop = asyncio.get_running_loop()
+        key = (collection.full_name, top_k, engine)
+        batch = self._batches.get(key)
+        if batch is None:
+            batch = {"collection": collection, "top_k": top_k, "engine": engine, "items": []}
+            batch["timer"] = loop.call_later(self.window, self._schedule_flush, key, batch)
+            self._batches[key] = batch
+        future = loop.create_future()
+        batch["items"].append((question, future))
+        if len(batch["items"]) >= self.max_batch:
+            batch["timer"].cancel()
+            self._schedule_flush(key, batch)
+        return await future
+
+    def _schedule_flush(self, key, batch):
+        if self._batches.get(key) is not batch:
+            return
+        del self._batches[key]
+        task = asyncio.get_running_loop().create_task(self._flush(batch))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    async def _flush(self, batch):
+        questions = [question for question, _ in batch["items"]]
+        self.batches += 1
+        self.questions += len(questions)
+        try:
+            results = await search_many(batch["collection"], questions, batch["top_k"], engine=batch["engine"])
+        except Exception as e:
+            for _, future in batch["items"]:
+                if not future.done():
+                    future.set_exception(e)
+            return
+        for (_, future), passages in zip(batch["items"], results):
+            if not future.done():
+                future.set_result(passages)
+
+    def stats(self):
+        return {
+            "window_ms": self.window * 1000,
+            "max_batch": self.max_batch,
+            "batches": self.batches,
+            "questions": self.questions,
+            "avg_batch_size": round(self.questions / self.batches, 2) if self.batches else 0.0,
+        }
+
+retrieval_batcher = RetrievalBatcher(RETRIEVAL_BATCH_WINDOW_MS, RETRIEVAL_BATCH_MAX)
@@ -1,35 +1,59 @@
-from langchain_openai import OpenAIEmbeddings
-import os 
-from openai import AsyncOpenAI
-from pinecone import Pinecone
+import os
+import asyncio
+import threading
+from pinecone_local import get_pinecone_client
 
-# OpenAI API key setup
-OPENAI_API_KEY = os.getenv("OPENAI_API_KEY")
 # Pinecone setup (ensure correct initialization)
 PINECONE_API_KEY = os.getenv("PINECONE_API_KEY")
 PINECONE_ENV = os.getenv("PINECONE_ENV")
-pc = Pinecone(api_key=PINECONE_API_KEY, environment= PINECONE_ENV)
-
-# Embed model
-embed = os.getenv("EMBEDDING")
-
-client = AsyncOpenAI(api_key=OPENAI_API_KEY)
-
-async def retrieve_context_from_pinecone(question: str, index_name: str, namespace: str, top_k: int = 5):
-    embedder = OpenAIEmbeddings(openai_api_key=OPENAI_API_KEY)
-    question_vector = embedder.embed_query(question)
-
-    index = pc.Index(index_name)
-    result = index.query(
-        vector=question_vector,
-        top_k=top_k,
-        include_metadata=True,
-        namespace=namespace
-    )
-
-    context_chunks = []
-    for match in result['matches']:
-        metadata = match['metadata']
-        context_chunks.append(str(metadata))
-    
-    return "\n".join(context_chunks)
\ No newline at end of file
+pc = get_pinecone_client(PINECONE_API_KEY, PINECONE_ENV)
+
+# Embed model (ต้องตรงกับ model ที่ embed_pinecone ใช้ตอน ingest)
+embed = os.getenv("EMBEDDING") or "text-embedding-3-small"
+
+# handle ของแต่ละ index ถูกสร้างครั้งเดียวแล้วใช้ซ้ำ (pc.Index ต้องหา host ของ index และเปิด connection ใหม่ทุกครั้ง)
+_index_handles = {}
+_index_handles_lock = threading.Lock()
+
+def get_index(index_name):
+    with _index_handles_lock:
+        index = _index_handles.get(index_name)
+        if index is None:
+            index = pc.Index(index_name)
+            _index_handles[index_name] = index
+        return index
+
+def split_namespaces(namespace):
+    """namespace ของ session อาจเป็นหลายชื่อคั่นด้วย comma เช่น "faq,courses" (ค้นทุก namespace แล้วรวมผล)"""
+    if isinstance(namespace, (list, tuple)):
+        return list(namespace) or [None]
+    names = [name.strip() for name in (namespace or "").split(",") if name.strip()]
+    return names or [namespace]
+
+def match_text(metadata):
+    """ข้อความของ match: ใช้ field text ที่เก็บไว้ตอน ingest, ข้อมูลเก่าที่ไม่มีใช้ค่าของ metadata ต่อกัน"""
+    metadata = metadata or {}
+    text = metadata.get("text")
+    if text:
+        return text
+    return " ".join(str(value) for value in metadata.values() if value not in (None, ""))
+
+async def query_pinecone(question_vector, index_name, namespaces, top_k=5):
+    """
+    ค้นทุก namespace พร้อมกัน (client เป็น synchronous จึงรันใน thread) แล้วรวมเป็น top_k เดียว
+    คืน [(score, text)] เรียงจาก score มากไปน้อย
+    """
+    index = get_index(index_name)
+    vector = [float(x) for x in question_vector]
+
+    def run_query(namespace):
+        return index.query(vector=vector, top_k=top_k, include_metadata=True, namespace=namespace)
+
+    results = await asyncio.gather(*(asyncio.to_thread(run_query, namespace) for namespace in namespaces))
+    passages = [
+        (float(match["score"]), match_text(match["metadata"]))
+        for result in results
+        for match in result["matches"]
+    ]
+    passages.sort(key=lambda passage: passage[0], reverse=True)
+    return passages[:top_k]
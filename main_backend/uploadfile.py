@@ -1,144 +1,224 @@
+import io
 import os
-import base64
+import time
+import asyncio
+import hashlib
+import tempfile
+import threading
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
 from docx import Document
-import pdfplumber
-import fitz  # PyMuPDF
 import pandas as pd
-from fastapi.responses import JSONResponse
-from tempfile import TemporaryDirectory
-from cleasing import cleansing
+from pdf_engine import iter_pdf_pages, pdf_page_count
+from image_store import add_image
 import logging
 
-def read_docx(path):
-    doc = Document(path)
-    paragraphs = []
-    tables = []
-    images_b64 = []
-
-    # เก็บแต่ละ paragraph แยก
-    for para in doc.paragraphs:
-        if para.text.strip():
-            paragraphs.append(para.text.strip())
-
-    for table in doc.tables:
-        table_data = []
-        for row in table.rows:
-            table_data.append([cell.text.strip() for cell in row.cells])
-        tables.append(table_data)
-
+# --- อ่านไฟล์ทีละหน่วย (แถว/ย่อหน้า/หน้า) สำหรับ ingest แบบ streaming ---
+UPLOAD_READ_CHUNK_BYTES = int(os.getenv("UPLOAD_READ_CHUNK_BYTES", str(1024 * 1024)))
+# ไฟล์อัปโหลดที่เล็กกว่านี้อยู่ในหน่วยความจำทั้งไฟล์ parser อ่านจาก bytes ตรงๆ ใหญ่กว่านี้จึงเขียนลงไฟล์ชั่วคราว
+UPLOAD_SPOOL_BYTES = int(os.getenv("UPLOAD_SPOOL_BYTES", str(8 * 1024 * 1024)))
+CSV_CHUNK_ROWS = int(os.getenv("CSV_CHUNK_ROWS", "2000"))
+
+# --- parse ไฟล์ใน process pool (PyMuPDF/python-docx ใช้ CPU และถือ GIL ทำให้ request อื่นค้างถ้า parse ใน process หลัก) ---
+# 0 = ไม่ใช้ process pool (parse ใน thread แบบเดิม)
+PARSE_WORKERS = int(os.getenv("PARSE_WORKERS", str(min(4, os.cpu_count() or 1))))
+# PDF ถูกแบ่งเป็นงานละกี่หน้า (หลายช่วงหน้าของไฟล์เดียว parse พร้อมกันได้)
+PDF_PAGES_PER_TASK = int(os.getenv("PDF_PAGES_PER_TASK", "16"))
+
+_parse_executor = None
+_parse_executor_lock = threading.Lock()
+
+def _parse_mp_context():
+    # ไม่ fork process หลักตรงๆ (มี thread/connection ของ MongoDB เปิดอยู่)
+    # forkserver: worker fork จาก server process ที่ preload uploadfile ไว้แล้ว, spawn บน Windows
+    # (รันด้วย uvicorn main:app: worker ไม่ต้อง import main.py ที่โหลด CLIP)
+    if "forkserver" in multiprocessing.get_all_start_methods():
+        context = multiprocessing.get_context("forkserver")
+        context.set_forkserver_preload(["uploadfile"])
+        return context
+    return multiprocessing.get_context("spawn")
+
+def get_parse_executor():
+    global _parse_executor
+    if PARSE_WORKERS <= 0:
+        return None
+    with _parse_executor_lock:
+        if _parse_executor is None:
+            _parse_executor = ProcessPoolExecutor(max_workers=PARSE_WORKERS, mp_context=_parse_mp_context())
+        return _parse_executor
+
+async def run_parser(function, *args):
+    """เรียก function(*args) ใน parse worker process (หรือ thread ถ้า PARSE_WORKERS=0)"""
+    global _parse_executor
+    executor = get_parse_executor()
+    try:
+        return await asyncio.get_running_loop().run_in_executor(executor, function, *args)
+    except BrokenProcessPool:
+        # worker ตาย (เช่น PDF ที่ทำให้ library crash) สร้าง pool ใหม่ในครั้งถัดไป
+        with _parse_executor_lock:
+            if _parse_executor is executor:
+                _parse_executor = None
+        raise
+
+class SpooledUpload:
+    """
+    ไฟล์อัปโหลดที่อ่านทีละก้อน: เก็บในหน่วยความจำจนเกิน max_size แล้วจึงย้ายทั้งหมดลงไฟล์ชั่วคราว
+    (แบบ SpooledTemporaryFile แต่ไฟล์บนดิสก์มีชื่อ parse worker process จึงเปิดเองได้)
+    อยู่ต่อได้หลัง request จบ (job เบื้องหลังใช้ต่อ) ต้องเรียก close() เมื่อใช้เสร็จ
+    """
+
+    def __init__(self, filename, max_size=UPLOAD_SPOOL_BYTES):
+        self.filename = filename
+        self.max_size = max_size
+        self.size = 0
+        self.sha256 = None
+        # path ของไฟล์ชั่วคราวเมื่อเกิน max_size (None = อยู่ในหน่วยความจำ)
+        self.path = None
+        self._buffer = io.BytesIO()
+        self._disk = None
+
+    @classmethod
+    async def from_upload(cls, upload_file, max_size=UPLOAD_SPOOL_BYTES):
+        """อ่าน UploadFile ทีละ UPLOAD_READ_CHUNK_BYTES พร้อมคำนวณ sha256 (fingerprint ระดับไฟล์)"""
+        if isinstance(upload_file, cls):
+            return upload_file
+        spool = cls(upload_file.filename, max_size)
+        digest = hashlib.sha256()
+        try:
+            while True:
+                block = await upload_file.read(UPLOAD_READ_CHUNK_BYTES)
+                if not block:
+                    break
+                digest.update(block)
+                spool._write(block)
+            if spool._disk is not None:
+                spool._disk.close()
+                spool._disk = None
+        except Exception:
+            spool.close()
+            raise
+        spool.sha256 = digest.hexdigest()
+        return spool
+
+    def _write(self, block):
+        self.size += len(block)
+        if self._disk is None and self.size > self.max_size:
+            self._disk = tempfile.NamedTemporaryFile(prefix="upload-", suffix=os.path.splitext(self.filename)[1], delete=False)
+            self.path = self._disk.name
+            self._disk.write(self._buffer.getbuffer())
+            self._buffer = None
+        if self._disk is not None:
+            self._disk.write(block)
+        else:
+            self._buffer.write(block)
+
+    def spill(self):
+        """ย้ายไฟล์ที่อยู่ในหน่วยความจำลงไฟล์ชั่วคราว คืน path (ใช้เมื่อหลายงานใน process pool ต้องเปิดไฟล์เดียวกัน)"""
+        if self.path is None:
+            with tempfile.NamedTemporaryFile(prefix="upload-", suffix=os.path.splitext(self.filename)[1], delete=False) as disk:
+                self.path = disk.name
+                disk.write(self._buffer.getbuffer())
+            self._buffer = None
+        return self.path
+
+    @property
+    def source(self):
+        """สิ่งที่ส่งให้ parser: path ของไฟล์ชั่วคราว หรือ bytes ของไฟล์ (BytesIO.getvalue ไม่คัดลอก buffer)"""
+        return self.path if self.path is not None else self._buffer.getvalue()
+
+    def close(self):
+        self._buffer = None
+        if self._disk is not None:
+            self._disk.close()
+            self._disk = None
+        if self.path is not None:
+            try:
+                os.remove(self.path)
+            except OSError:
+                pass
+            self.path = None
+
+def as_file(source):
+    """source ของ parser: path ใช้ตามเดิม, bytes/memoryview ห่อเป็น file-like ในหน่วยความจำ"""
+    if isinstance(source, (bytes, bytearray, memoryview)):
+        return io.BytesIO(source)
+    return source
+
+def add_docx_images(doc, images):
+    """เพิ่มรูปที่แทรกใน DOCX ลง images (dict sha256 -> bytes)"""
     for shape in doc.inline_shapes:
         try:
             image = shape._inline.graphic.graphicData.pic.blipFill.blip.embed
             image_part = doc.part.related_parts[image]
-            image_bytes = image_part.blob
-            image_b64 = base64.b64encode(image_bytes).decode("utf-8")
-            images_b64.append(image_b64)
+            add_image(images, image_part.blob)
         except Exception as e:
             logging.error(f"❌ Error extracting DOCX image: {e}")
 
-    return paragraphs, tables, images_b64
-
-def read_pdf(path):
-    pages = []
-    tables = []
-    images_b64 = []
-
-    # อ่านข้อความแยกแต่ละหน้า
-    with pdfplumber.open(path) as pdf:
-        for page_num, page in enumerate(pdf.pages, start=1):
-            try:
-                page_text = page.extract_text()
-                if page_text:
-                    pages.append(page_text.strip())
-                page_tables = page.extract_tables()
-                if page_tables:
-                    tables.extend(page_tables)
-            except Exception as e:
-                logging.error(f"❌ Error processing page {page_num}: {e}")
-
-    # อ่านรูปจากทุกหน้า
-    doc = fitz.open(path)
-    for page_index in range(len(doc)):
-        page = doc.load_page(page_index)
-        images = page.get_images(full=True)
-        for img in images:
-            xref = img[0]
-            base_image = doc.extract_image(xref)
-            image_bytes = base_image["image"]
-            image_b64 = base64.b64encode(image_bytes).decode("utf-8")
-            images_b64.append(image_b64)
-
-    return pages, tables, images_b64
-
-async def Up_File(upload_files):
-    dfs = []
-    all_tables = []
-    all_images_b64 = []
-    all_paragraphs = []  # สำหรับ DOCX
-    all_pages = []       # สำหรับ PDF
-
-    with TemporaryDirectory() as tmpdir:
-        for upload_file in upload_files:
-            filename = upload_file.filename
-            file_path = os.path.join(tmpdir, filename)
-
-            # Save file to disk temporarily
-            with open(file_path, "wb") as f:
-                content = await upload_file.read()
-                f.write(content)
-
-            try:
-                if filename.endswith('.csv'):
-                    df = pd.read_csv(file_path)
-                    dfs.append(df)
-
-                elif filename.endswith('.xlsx'):
-                    excel_data = pd.read_excel(file_path, sheet_name=None)
-                    for sheet in excel_data.values():
-                        dfs.append(sheet)
-
-                elif filename.endswith('.docx'):
-                    paragraphs, tables, images = read_docx(file_path)
-                    all_paragraphs.extend(paragraphs)
-                    all_tables.extend(tables)
-                    all_images_b64.extend(images)
-
-                elif filename.endswith('.pdf'):
-                    pages, tables, images = read_pdf(file_path)
-                    all_pages.extend(pages)
-                    all_tables.extend(tables)
-                    all_images_b64.extend(images)
-
-            except Exception as e:
-                logging.error(f"❌ Error processing file {filename}: {e}")
-
-    df_combined = pd.DataFrame()  # default กรณีไม่มีอะไรเลย
-
-    if dfs:
-        try:
-            df_concat = pd.concat(dfs, ignore_index=True)
-            if df_concat.empty:
-                return JSONResponse(content={"error": "No valid data in CSV or Excel files"}, status_code=400)
-            df_combined = cleansing(df_concat)
-        except Exception as e:
-            logging.error(f"❌ Error during concat or cleansing: {e}")
-            return JSONResponse(content={"error": f"Error during concat or cleansing: {str(e)}"}, status_code=400)
-
-    elif all_paragraphs:
-        df_combined = pd.DataFrame({"paragraph": all_paragraphs})
-
-    elif all_pages:
-        df_combined = pd.DataFrame({"page": all_pages})
-
-    if df_combined is None or df_combined.empty:
-        return JSONResponse(content={"error": "No valid data after cleansing or file read"}, status_code=400)
-
-    result = {
-        "dataframe": df_combined.to_dict(orient="records"),
-        "tables": all_tables,
-        "images_b64": all_images_b64,
-        "paragraphs": all_paragraphs,  # DOCX
-        "pages": all_pages,            # PDF
-    }
-
-    return result
+def _iter_frame_rows(frames):
+    """แถวของ DataFrame ทีละก้อน: ตัดแถวที่มีค่าว่างและแถวซ้ำ (แบบเดียวกับ cleansing แต่ไม่ต้องรวมทุกก้อนก่อน)"""
+    seen = set()
+    for frame in frames:
+        frame = frame.dropna()
+        for row in frame.to_dict(orient="records"):
+            key = hash(tuple(row.items()))
+            if key in seen:
+                continue
+            seen.add(key)
+            yield row
+
+def iter_file_units(source, filename, page_range=None, images=None):
+    """
+    คืนข้อมูลของไฟล์ทีละหน่วยเป็น (metadata, row) โดย row คือ dict แบบแถวของ DataFrame เดิม
+    (CSV/Excel: แถวข้อมูล, DOCX: {"paragraph": ...}, PDF: {"page": ...}) เพื่อให้ข้อความของ chunk เหมือนเดิม
+    metadata ของ DOCX/PDF เก็บแค่ชื่อไฟล์กับลำดับ ไม่เก็บข้อความซ้ำ
+    page_range (start, end) อ่านเฉพาะหน้า [start, end) ของ PDF (นับจาก 0)
+    images (dict) ถ้าส่งมา รูปใน DOCX/PDF ถูกเพิ่มลงไป (sha256 -> bytes) ในรอบเดียวกับที่อ่านข้อความ
+    """
+    if filename.endswith('.csv'):
+        for row in _iter_frame_rows(pd.read_csv(as_file(source), chunksize=CSV_CHUNK_ROWS)):
+            yield {**row, "file": filename}, row
+
+    elif filename.endswith('.xlsx'):
+        excel_file = pd.ExcelFile(as_file(source))
+        frames = (excel_file.parse(sheet) for sheet in excel_file.sheet_names)
+        for row in _iter_frame_rows(frames):
+            yield {**row, "file": filename}, row
+
+    elif filename.endswith('.docx'):
+        doc = Document(as_file(source))
+        for number, para in enumerate(doc.paragraphs, start=1):
+            if para.text.strip():
+                yield {"file": filename, "paragraph": number}, {"paragraph": para.text.strip()}
+        if images is not None:
+            add_docx_images(doc, images)
+
+    elif filename.endswith('.pdf'):
+        for record in iter_pdf_pages(source, page_range, tables=False, image_data=images is not None):
+            for image in record["images"]:
+                if "data" in image:
+                    add_image(images, image["data"])
+            if record["text"]:
+                yield {"file": filename, "page": record["page"]}, {"page": record["text"]}
+
+def plan_file_parts(source, filename):
+    """
+    แบ่งไฟล์เป็นงาน parse สำหรับ process pool: PDF แบ่งตามช่วงหน้า, DOCX ทั้งไฟล์
+    CSV/Excel คืน None (pandas อ่านเป็นก้อนแบบ streaming ใน thread อยู่แล้ว)
+    """
+    if filename.endswith('.pdf'):
+        page_count = pdf_page_count(source)
+        return [(start, min(start + PDF_PAGES_PER_TASK, page_count)) for start in range(0, page_count, PDF_PAGES_PER_TASK)]
+    if filename.endswith('.docx'):
+        return [None]
+    return None
+
+def parse_file_part(source, filename, page_range=None, with_images=False):
+    """
+    รันใน parse worker process: คืน (units ของไฟล์หรือของช่วงหน้า, รูป sha256 -> bytes, วินาทีที่ใช้)
+    with_images=False ไม่ดึงรูป (คืน dict ว่าง)
+    """
+    started = time.perf_counter()
+    images = {}
+    units = list(iter_file_units(source, filename, page_range, images if with_images else None))
+    return units, images, time.perf_counter() - started
@@ -0,0 +1,29 @@
+import os
+import numpy as np
+from bson.binary import Binary
+
+# รูปแบบที่ใช้เก็บ embedding ใน MongoDB
+# - array : BSON array ของ double (แบบเดิม)
+# - binary: binData float32 little-endian (เล็กลงราว 2 เท่า และ decode ด้วย np.frombuffer)
+EMBEDDING_STORAGE_FORMAT = os.getenv("EMBEDDING_STORAGE_FORMAT", "array")
+
+def encode_embedding(embedding, storage_format=None):
+    storage_format = storage_format or EMBEDDING_STORAGE_FORMAT
+    if storage_format == "binary":
+        return Binary(np.asarray(embedding, dtype="<f4").tobytes())
+    return [float(x) for x in embedding]
+
+def decode_embedding(value):
+    """อ่านได้ทั้ง 2 รูปแบบ: binData -> np.frombuffer (ไม่ copy), array -> np.asarray"""
+    if value is None:
+        return None
+    if isinstance(value, (bytes, bytearray, memoryview)):
+        return np.frombuffer(value, dtype="<f4")
+    return np.asarray(value, dtype=np.float32)
+
+def embedding_length(value):
+    if value is None:
+        return 0
+    if isinstance(value, (bytes, bytearray, memoryview)):
+        return len(value) // 4
+    return len(value)
@@ -0,0 +1,526 @@
+import os
+import zlib
+import time
+import asyncio
+import logging
+import threading
+import numpy as np
+from collection_meta import (
+    get_embedding_settings, bump_collection_version, get_collection_version, get_running_migration, local_update
+)
+from vector_codec import encode_embedding
+from matryoshka import supports_short_embeddings, short_vector, SHORT_EMBEDDING_DIM, SHORT_EMBEDDING_FIELD
+from matrix_cache import matrix_cache, normalize_rows, top_k_indices
+from pinecone_ingest import upsert_vectors, clean_metadata
+from mongo_ingest import bulk_upsert_documents
+
+# embedder ของ store แบบ in-memory: hashing (offline ไม่ต้องเรียก API) หรือ openai
+MEMORY_STORE_EMBEDDER = os.getenv("MEMORY_STORE_EMBEDDER", "hashing")
+HASHING_EMBEDDING_DIM = int(os.getenv("HASHING_EMBEDDING_DIM", "512"))
+# ingest แบบ streaming: เพิ่ม chunk ที่เขียนแล้วเข้า FAISS/BM25 index อย่างน้อยทุกกี่วินาที
+INGEST_PUBLISH_SECONDS = float(os.getenv("INGEST_PUBLISH_SECONDS", "2"))
+
+def _default_embedding_model():
+    return os.getenv("EMBEDDING_MODEL", os.getenv("EMBEDDING", "text-embedding-3-small"))
+
+class HashingEmbedder:
+    """
+    Embedder แบบ offline: hash character n-gram ลง vector ขนาด dim (signed feature hashing)
+    ใช้กับภาษาไทยที่ไม่มีช่องว่างระหว่างคำได้โดยไม่ต้องตัดคำ เหมาะกับการทดสอบ/benchmark ไม่ใช่คุณภาพการค้นหา
+    """
+
+    def __init__(self, dim: int = HASHING_EMBEDDING_DIM, ngram: int = 3):
+        self.dim = dim
+        self.ngram = ngram
+        self.model = f"hashing-{dim}"
+
+    def embed_one(self, text):
+        vector = np.zeros(self.dim, dtype=np.float32)
+        text = " ".join((text or "").split()).casefold()
+        for i in range(max(len(text) - self.ngram + 1, 1)):
+            h = zlib.crc32(text[i:i + self.ngram].encode("utf-8"))
+            vector[h % self.dim] += 1.0 if h & 0x80000000 else -1.0
+        return normalize_rows(vector)[0]
+
+    async def embed(self, texts):
+        return [self.embed_one(text) for text in texts]
+
+    async def embed_chunks(self, chunks):
+        return await self.embed([chunk["text"] for chunk in chunks])
+
+class OpenAIEmbedder:
+    def __init__(self, model=None):
+        self.model = model or _default_embedding_model()
+        # จำนวน chunk ที่ได้จาก chunk_embedding_cache / ต้องเรียก API ของ embedder ตัวนี้
+        self.cache_stats = {"hits": 0, "misses": 0}
+
+    async def embed(self, texts):
+        from embed_MongoDB import batch_process_embedding_async
+        return await batch_process_embedding_async(list(texts), self.model, self.cache_stats)
+
+    async def embed_chunks(self, chunks):
+        # chunk จาก ingest_pipeline มี token ids อยู่แล้ว ไม่ต้อง encode ใหม่
+        from embed_MongoDB import embed_token_lists
+        return await embed_token_lists([chunk["tokens"] for chunk in chunks], self.model, self.cache_stats)
+
+class VectorStore:
+    """
+    Interface ของที่เก็บ vector ที่ใช้ตอบคำถาม
+    - upsert(ids, texts, embeddings=None, metadata=None, publish=True): เพิ่ม/แทนที่ chunk (ไม่ส่ง embeddings มา store จะ embed เอง)
+      publish=False ให้ store เลื่อนงานที่แพง (เช่นเขียน index ลงดิสก์) ไปรวมทำทีเดียว ต้องเรียก publish() เมื่อเขียนครบ
+      คืน report ของการเขียนครั้งนั้น (dict ที่มี "upserted" = จำนวน chunk ที่เขียนสำเร็จ)
+    - publish(): ทำให้ chunk ที่เขียนแล้วค้นเจอได้ทั้งหมด
+    - clear(): ลบข้อมูลทั้งหมดของ store (ก่อน /upload ใหม่)
+    - delete(ids): ลบ chunk
+    - existing_ids(ids) / all_ids() / ids_for_file(file, file_hash): id ที่มีอยู่แล้ว ใช้ ingest เฉพาะส่วนที่เปลี่ยน
+      (คืน None ถ้า store ตอบไม่ได้ ผู้เรียกจะเขียนทุก chunk แทน)
+    - search(question, top_k): คืน [(score, text), ...] เรียงจากคะแนนมากไปน้อย
+    - stats(): สถานะของ store
+    """
+
+    backend = "base"
+
+    async def upsert(self, ids, texts, embeddings=None, metadata=None, publish=True):
+        raise NotImplementedError
+
+    def publish(self):
+        return None
+
+    def clear(self):
+        raise NotImplementedError
+
+    async def delete(self, ids):
+        raise NotImplementedError
+
+    def existing_ids(self, ids):
+        return None
+
+    def all_ids(self):
+        return None
+
+    def ids_for_file(self, file, file_hash):
+        return None
+
+    async def search(self, question, top_k=4):
+        raise NotImplementedError
+
+    def stats(self):
+        raise NotImplementedError
+
+    async def retrieve_context(self, question, top_k=4):
+        return "\n".join(text for _, text in await self.search(question, top_k))
+
+class MongoScanVectorStore(VectorStore):
+    """MongoDB collection ที่ค้นด้วยการสแกน matrix cache (brute force) + BM25"""
+
+    backend = "mongo-scan"
+    engine = "brute"
+
+    def __init__(self, collection):
+        self.collection = collection
+        # chunk ที่เขียนลง collection แล้วแต่ยังไม่ได้เปลี่ยน version/เพิ่มเข้า index (ingest แบบ streaming)
+        self._unpublished = []
+        self._publish_fields = {}
+        self._published_at = 0.0
+        # index ในหน่วยความจำมี chunk ที่ยังไม่ได้เขียนลงไฟล์ index บนดิสก์
+        self._unpersisted = False
+        self._fingerprint_index = False
+
+    async def upsert(self, ids, texts, embeddings=None, metadata=None, publish=True):
+        collection = self.collection
+        # ใช้ model/field เดียวกับข้อมูลเดิมใน collection
+        settings = get_embedding_settings(collection, _default_embedding_model())
+        if embeddings is None:
+            embeddings = await OpenAIEmbedder(settings["model"]).embed(texts)
+        embedding_field = settings["field"]
+        # collection ว่างใช้ค่า SHORT_EMBEDDING_DIM จาก env, collection เดิมใช้ค่าที่บันทึกไว้
+        short_dim = settings["short_dimension"]
+        if settings["dimension"] is None and supports_short_embeddings(settings["model"], SHORT_EMBEDDING_DIM):
+            short_dim = SHORT_EMBEDDING_DIM
+
+        # ถ้ากำลัง migrate model อยู่ ให้เขียน vector ของ model ใหม่ไปพร้อมกัน
+        migration = get_running_migration(collection)
+        migration_embeddings = None
+        if migration:
+            migration_embeddings = await OpenAIEmbedder(migration["target_model"]).embed(texts)
+
+        documents = []
+        for idx, (doc_id, embedding, raw_text) in enumerate(zip(ids, embeddings, texts)):
+            document = {
+                "_id": doc_id,
+                embedding_field: encode_embedding(embedding),
+                "metadata": metadata[idx] if metadata else {},
+                "raw_text": raw_text
+            }
+            if short_dim:
+                document[SHORT_EMBEDDING_FIELD] = encode_embedding(short_vector(embedding, short_dim))
+            if migration_embeddings is not None:
+                document[migration["target_field"]] = encode_embedding(migration_embeddings[idx])
+            documents.append(document)
+
+        # upsert: insert ถ้าใหม่, update ถ้าซ้ำ (bulk_write ทีละหลายร้อย document แทนการเขียนทีละตัว)
+        report = await bulk_upsert_documents(collection, documents)
+        failed = set(report["failed_ids"])
+        report["upserted"] = len(documents) - len(failed)
+
+        self._unpublished.extend(
+            (d["_id"], embedding, d["raw_text"]) for d, embedding in zip(documents, embeddings) if d["_id"] not in failed
+        )
+        self._publish_fields = {
+            "embedding_model": settings["model"],
+            "dimension": len(embeddings[0]) if len(embeddings) else settings["dimension"],
+            "embedding_field": embedding_field,
+            "short_dimension": short_dim,
+        }
+        # ระหว่าง streaming ยังเปลี่ยน version เป็นระยะ เพื่อให้ chunk แรกๆ ค้นเจอได้ก่อน ingest เสร็จ
+        # (เพิ่มเข้า index ในหน่วยความจำอย่างเดียว เขียนไฟล์ index ครั้งเดียวตอน publish() สุดท้าย)
+        if publish or time.perf_counter() - self._published_at >= INGEST_PUBLISH_SECONDS:
+            await asyncio.to_thread(self.publish, publish)
+        return report
+
+    def publish(self, persist=True):
+        """
+        เปลี่ยน version stamp ให้ cache ของทุก worker โหลดใหม่ แล้วเพิ่ม chunk ที่ค้างอยู่เข้า ANN/BM25 index
+        persist=False ไม่เขียนไฟล์ index ลงดิสก์ (publish ระหว่าง streaming), persist=True เขียนรวมทีเดียว
+        ทำงาน sync (เขียนไฟล์/อัปเดต index) ผู้เรียกจาก async ควรเรียกผ่าน asyncio.to_thread
+        """
+        from faiss_index import add_to_index, persist_index
+        from bm25_index import add_to_bm25, persist_bm25
+        collection = self.collection
+        version = None
+        if self._unpublished:
+            items, self._unpublished = self._unpublished, []
+            ids = [doc_id for doc_id, _, _ in items]
+            with local_update(collection):
+                version = bump_collection_version(collection, **self._publish_fields)
+                try:
+                    add_to_index(collection, ids, [embedding for _, embedding, _ in items], version, persist=False)
+                except Exception as index_error:
+                    logging.error(f"Error updating FAISS index: {index_error}")
+                try:
+                    add_to_bm25(collection, ids, [raw_text for _, _, raw_text in items], version, persist=False)
+                except Exception as index_error:
+                    logging.error(f"Error updating BM25 index: {index_error}")
+            self._unpersisted = True
+            self._published_at = time.perf_counter()
+        if persist and self._unpersisted:
+            self._unpersisted = False
+            try:
+                persist_index(collection)
+            except Exception as index_error:
+                logging.error(f"Error saving FAISS index: {index_error}")
+            try:
+                persist_bm25(collection)
+            except Exception as index_error:
+                logging.error(f"Error saving BM25 index: {index_error}")
+        return version
+
+    def clear(self):
+        """ล้าง collection, index บนดิสก์ และข้อมูล model เดิม (ข้อมูลใหม่จะบันทึก model/มิติเอง)"""
+        from faiss_index import drop_index
+        from bm25_index import drop_bm25
+        self.collection.delete_many({})
+        self._unpublished = []
+        self._unpersisted = False
+        drop_index(self.collection)
+        drop_bm25(self.collection)
+        bump_collection_version(
+            self.collection,
+            embedding_model=None,
+            dimension=None,
+            embedding_field="embedding",
+            short_dimension=None,
+            migration=None
+        )
+
+    async def delete(self, ids):
+        ids = list(ids)
+        if not ids:
+            return 0
+        # ลบและปรับ index ใน thread ไม่ให้คำถามอื่นค้างระหว่างรอ
+        return await asyncio.to_thread(self._delete, ids)
+
+    def _delete(self, ids):
+        from faiss_index import remove_from_index
+        from bm25_index import remove_from_bm25
+        collection = self.collection
+        result = collection.delete_many({"_id": {"$in": ids}})
+        if not result.deleted_count:
+            return 0
+        previous_version = get_collection_version(collection)
+        # ตัดเอกสารที่ลบออกจาก matrix cache, FAISS และ BM25 index เดิม แล้วใช้ version ใหม่
+        # (ถ้าแค่เปลี่ยน version การค้นครั้งถัดไปจะสร้าง index ใหม่จากทั้ง collection)
+        with local_update(collection):
+            version = bump_collection_version(collection)
+            matrix_cache.remove(collection, ids, previous_version, version)
+            try:
+                remove_from_index(collection, ids, version)
+            except Exception as index_error:
+                logging.error(f"Error updating FAISS index: {index_error}")
+            try:
+                remove_from_bm25(collection, ids, version)
+            except Exception as index_error:
+                logging.error(f"Error updating BM25 index: {index_error}")
+        return result.deleted_count
+
+    def existing_ids(self, ids):
+        return {doc["_id"] for doc in self.collection.find({"_id": {"$in": list(ids)}}, {"_id": 1})}
+
+    def all_ids(self):
+        return {doc["_id"] for doc in self.collection.find({}, {"_id": 1})}
+
+    def ids_for_file(self, file, file_hash):
+        if not self._fingerprint_index:
+            try:
+                self.collection.create_index([("metadata.file", 1), ("metadata.file_hash", 1)])
+            except Exception as e:
+                logging.warning(f"Could not create fingerprint index on {self.collection.full_name}: {e}")
+            self._fingerprint_index = True
+        query = {"metadata.file": file}
+        if file_hash is not None:
+            query["metadata.file_hash"] = file_hash
+        return {doc["_id"] for doc in self.collection.find(query, {"_id": 1})}
+
+    async def search(self, question, top_k=4):
+        from retrival_MongoDB import retrieval_batcher
+        # คำถามที่เข้ามาพร้อมกันถูกรวมเป็น batch เดียว (embed/scan ครั้งเดียว)
+        return await retrieval_batcher.search(self.collection, question, top_k, self.engine)
+
+    def stats(self):
+        settings = get_embedding_settings(self.collection, _default_embedding_model())
+        return {
+            "backend": self.backend,
+            "collection": self.collection.full_name,
+            "documents": self.collection.estimated_document_count(),
+            "version": get_collection_version(self.collection),
+            "embedding_model": settings["model"],
+            "dimension": settings["dimension"],
+        }
+
+class FaissVectorStore(MongoScanVectorStore):
+    """MongoDB collection ที่ค้นผ่าน FAISS index (ถ้าใช้ไม่ได้จะ fallback เป็นการสแกน)"""
+
+    backend = "faiss"
+    engine = "faiss"
+
+class PineconeVectorStore(VectorStore):
+    backend = "pinecone"
+
+    def __init__(self, index_name, namespace, model=None):
+        from retrival_Pinecone import get_index, split_namespaces
+        self.index_name = index_name
+        # ค้นได้หลาย namespace พร้อมกัน; upsert/delete ใช้ namespace แรก
+        self.namespaces = split_namespaces(namespace)
+        self.namespace = self.namespaces[0]
+        self.index = get_index(index_name)
+        self.embedder = OpenAIEmbedder(model or os.getenv("EMBEDDING") or "text-embedding-3-small")
+
+    async def upsert(self, ids, texts, embeddings=None, metadata=None, publish=True):
+        if embeddings is None:
+            embeddings = await self.embedder.embed(texts)
+        vectors = [
+            {
+                "id": str(doc_id),
+                "values": [float(x) for x in embedding],
+                "metadata": {**clean_metadata(metadata[idx] if metadata else {}), "text": text},
+            }
+            for idx, (doc_id, text, embedding) in enumerate(zip(ids, texts, embeddings))
+        ]
+        report = await upsert_vectors(self.index, vectors, self.namespace)
+        if report["failed_batches"]:
+            raise RuntimeError(
+                f"{len(report['failed_ids'])} of {len(vectors)} vectors could not be upserted to {self.index_name}"
+            )
+        return report
+
+    def clear(self):
+        try:
+            self.index.delete(delete_all=True, namespace=self.namespace)
+        except Exception as e:
+            # namespace ที่ยังไม่มีข้อมูลจะ error ได้ ไม่ถือเป็นความผิดพลาด
+            logging.info(f"Pinecone namespace {self.namespace!r} was not cleared: {e}")
+
+    async def delete(self, ids):
+        ids = [str(doc_id) for doc_id in ids]
+        if ids:
+            # Pinecone client เป็นแบบ sync เรียกใน thread ไม่ให้ event loop ค้างระหว่างรอ
+            await asyncio.to_thread(self.index.delete, ids=ids, namespace=self.namespace)
+        return len(ids)
+
+    async def search(self, question, top_k=4):
+        from query_cache import query_embedding_cache
+        from retrival_Pinecone import query_pinecone
+        question_vector = await query_embedding_cache.embed(question, self.embedder.model)
+        return await query_pinecone(question_vector, self.index_name, self.namespaces, top_k)
+
+    def stats(self):
+        try:
+            described = self.index.describe_index_stats()
+            described_namespaces = described.get("namespaces") or {}
+            vectors = sum(described_namespaces.get(name or "", {}).get("vector_count", 0) for name in self.namespaces)
+        except Exception as e:
+            logging.warning(f"Could not read Pinecone index stats: {e}")
+            vectors = None
+        return {
+            "backend": self.backend,
+            "index_name": self.index_name,
+            "namespaces": self.namespaces,
+            "vectors": vectors,
+            "embedding_model": self.embedder.model,
+        }
+
+class InMemoryVectorStore(VectorStore):
+    """
+    Store ใน process ล้วน (numpy) ไม่ต้องมี MongoDB/Pinecone/OpenAI เมื่อใช้ HashingEmbedder
+    ใช้รัน ingest -> query ทั้งเส้นทางแบบ offline และ benchmark; ข้อมูลหายเมื่อ process จบ
+    """
+
+    backend = "memory"
+
+    def __init__(self, name="default", embedder=None):
+        self.name = name
+        self.embedder = embedder or HashingEmbedder()
+        self._lock = threading.Lock()
+        self._positions = {}
+        self._ids, self._texts, self._metadata, self._vectors = [], [], [], []
+        self._matrix = None
+        self.searches = 0
+        self.search_ms_total = 0.0
+
+    async def upsert(self, ids, texts, embeddings=None, metadata=None, publish=True):
+        if embeddings is None:
+            embeddings = await self.embedder.embed(texts)
+        with self._lock:
+            for idx, (doc_id, text, embedding) in enumerate(zip(ids, texts, embeddings)):
+                vector = np.asarray(embedding, dtype=np.float32)
+                item_metadata = metadata[idx] if metadata else {}
+                pos = self._positions.get(doc_id)
+                if pos is None:
+                    self._positions[doc_id] = len(self._ids)
+                    self._ids.append(doc_id)
+                    self._texts.append(text)
+                    self._metadata.append(item_metadata)
+                    self._vectors.append(vector)
+                else:
+                    self._texts[pos], self._metadata[pos], self._vectors[pos] = text, item_metadata, vector
+            self._matrix = None
+        return {"upserted": len(ids)}
+
+    async def delete(self, ids):
+        deleted = 0
+        with self._lock:
+            for doc_id in ids:
+                pos = self._positions.pop(doc_id, None)
+                if pos is None:
+                    continue
+                # ย้ายตัวสุดท้ายมาแทนตำแหน่งที่ลบ
+                last = len(self._ids) - 1
+                if pos != last:
+                    for items in (self._ids, self._texts, self._metadata, self._vectors):
+                        items[pos] = items[last]
+                    self._positions[self._ids[pos]] = pos
+                for items in (self._ids, self._texts, self._metadata, self._vectors):
+                    items.pop()
+                deleted += 1
+            if deleted:
+                self._matrix = None
+        return deleted
+
+    def existing_ids(self, ids):
+        with self._lock:
+            return {doc_id for doc_id in ids if doc_id in self._positions}
+
+    def all_ids(self):
+        with self._lock:
+            return set(self._positions)
+
+    def ids_for_file(self, file, file_hash):
+        with self._lock:
+            return {
+                doc_id for doc_id, metadata in zip(self._ids, self._metadata)
+                if metadata.get("file") == file and file_hash in (None, metadata.get("file_hash"))
+            }
+
+    def clear(self):
+        with self._lock:
+            self._positions = {}
+            self._ids, self._texts, self._metadata, self._vectors = [], [], [], []
+            self._matrix = None
+
+    def _get_matrix(self):
+        with self._lock:
+            if self._matrix is None and self._vectors:
+                self._matrix = normalize_rows(np.stack(self._vectors))
+            return self._matrix, list(self._texts)
+
+    async def search(self, question, top_k=4):
+        query = (await self.embedder.embed([question]))[0]
+        started = time.perf_counter()
+        matrix, texts = self._get_matrix()
+        if matrix is None:
+            return []
+        scores = matrix @ normalize_rows(query)[0]
+        passages = [(float(scores[i]), texts[i]) for i in top_k_indices(scores, top_k)]
+        self.searches += 1
+        self.search_ms_total += (time.perf_counter() - started) * 1000
+        return passages
+
+    def stats(self):
+        return {
+            "backend": self.backend,
+            "name": self.name,
+            "vectors": len(self._ids),
+            "dimension": int(self._vectors[0].shape[0]) if self._vectors else None,
+            "embedding_model": self.embedder.model,
+            "bytes": int(sum(vector.nbytes for vector in self._vectors)),
+            "searches": self.searches,
+            "avg_search_ms": round(self.search_ms_total / self.searches, 3) if self.searches else 0.0,
+        }
+
+# store ที่สร้างแล้วของแต่ละ session (หลาย session ที่ชี้ไปที่ข้อมูลเดียวกันใช้ store เดียวกัน)
+_stores = {}
+_stores_lock = threading.Lock()
+
+def _memory_embedder():
+    if MEMORY_STORE_EMBEDDER == "openai":
+        return OpenAIEmbedder()
+    return HashingEmbedder()
+
+def get_vector_store(log, mongo_client):
+    """
+    เลือก store จาก log ของ session
+    - db_type "Pinecone": index_name + namespace
+    - db_type "MongoDB" : db_name + collection_name; engine ("faiss" | "brute") จาก log หรือ RETRIEVAL_ENGINE
+    - db_type "Memory"  : collection_name ใช้เป็นชื่อ store ใน process
+    """
+    db_type = log.get("db_type")
+    if db_type == "Pinecone":
+        key = ("pinecone", log["index_name"], log.get("namespace"))
+        factory = lambda: PineconeVectorStore(log["index_name"], log.get("namespace"))
+    elif db_type == "MongoDB":
+        engine = (log.get("engine") or os.getenv("RETRIEVAL_ENGINE", "faiss")).lower()
+        store_class = FaissVectorStore if engine == "faiss" else MongoScanVectorStore
+        key = (store_class.backend, log["db_name"], log["collection_name"])
+        factory = lambda: store_class(mongo_client[log["db_name"]][log["collection_name"]])
+    elif db_type == "Memory":
+        key = ("memory", log["collection_name"])
+        factory = lambda: InMemoryVectorStore(log["collection_name"], _memory_embedder())
+    else:
+        raise ValueError(f"Unsupported db_type: {db_type}")
+    with _stores_lock:
+        store = _stores.get(key)
+        if store is None:
+            store = factory()
+            _stores[key] = store
+        return store
+
+def vector_store_stats():
+    with _stores_lock:
+        stores = dict(_stores)
+    stats = {}
+    for key, store in stores.items():
+        try:
+            stats["/".join(str(part) for part in key)] = store.stats()
+        except Exception as e:
+            stats["/".join(str(part) for part in key)] = {"backend": store.backend, "error": str(e)}
+    return stats